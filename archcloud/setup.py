@@ -19,6 +19,7 @@ setup(
         "gradescope_utils",
         "packet-python",
         "flask",
+        "gunicorn",
         "requests",
         "matplotlib",
         "pyperformance"
@@ -29,6 +30,7 @@ setup(
         'console_scripts' :[
             'runlab=ArchLab.runlab:main',
             'runlab.d=ArchLab.runlab_daemon:main',
+            'runlab.worker=ArchLab.DockerPool:worker_main',
             'runlab_proxy=ArchLab.runlab_proxy:main',
             'labtool=ArchLab.labtool:main',
             'gradescope=ArchLab.GradeScope:main',
@@ -42,6 +44,8 @@ setup(
             'sort-csv=ArchLab.csvsort:main',
             'show-grades=ArchLab.showgrades:main',
             'qdcache=ArchLab.QDCache:main',
+            'capability-probes=ArchLab.Probes:main',
+            'startup-bench=ArchLab.StartupBench:main',
 #            'gradelab=ArchLab.GradeLab:main'  # I dont think this exists.
         ]
     }
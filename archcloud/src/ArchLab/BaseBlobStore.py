@@ -1,8 +1,14 @@
-import pytest
 
 class NotFound(Exception):
     pass
 
+class UnknownUser(Exception):
+    """
+    We couldn't give someone access to a file, because the blob store
+    doesn't know who they are.
+    """
+    pass
+
 class BaseBlobStore(object):
     pass
 
@@ -19,3 +25,26 @@ def do_test_blob_store(BlobStoreType):
     
     with pytest.raises(NotFound):
         bs.read_file("fail")
+
+    import tempfile, os
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "src")
+        with open(src, "wb") as f:
+            f.write(b"\x00\xffbinary")
+        bs.upload_file("binary-1", src)
+        assert bs.read_file("binary-1") == b"\x00\xffbinary"
+        dst = os.path.join(d, "dst")
+        bs.download_file("binary-1", dst)
+        with open(dst, "rb") as f:
+            assert f.read() == b"\x00\xffbinary"
+        with pytest.raises(NotFound):
+            bs.download_file("fail", dst)
+
+    bs.write_file("dir/test-4", "hello")
+    assert "dir/test-4" in [n for n, t in bs.list_files("dir/")]
+    assert bs.touch("dir/test-4")
+    assert not bs.touch("fail")
+    bs.delete_file("dir/test-4")
+    assert "dir/test-4" not in [n for n, t in bs.list_files("dir/")]
+    with pytest.raises(NotFound):
+        bs.delete_file("dir/test-4")
@@ -2,6 +2,7 @@ import logging as log
 import datetime
 import pytz
 import platform
+from contextlib import contextmanager
 
 class BaseDataStore(object):
     def alloc_job(self, job_id):
@@ -17,7 +18,8 @@ class BaseDataStore(object):
 	     job_id,
 	     output,
 	     status,
-             username
+             username,
+             reply_topic=None
     ):
         job = self.alloc_job(job_id)
 
@@ -31,15 +33,20 @@ class BaseDataStore(object):
         job['submitted_host'] = platform.node()
         job['runner_host'] = ""
         job['username'] = username
+        job['reply_topic'] = reply_topic or ""
         #job['zip_archive'] = ""
         
         self.put_job(job)
 
-    def update(self,
-	       job_id,
-	       **kwargs):
-        log.debug(f"Updating {job_id} with {kwargs}")
-        job = self.pull(job_id)
+    @contextmanager
+    def locked(self, job_id):
+        """
+        Hold this while you read, change, and write back `job_id`, so no
+        one else's change to it gets lost in between.
+        """
+        yield
+
+    def clip_fields(self, kwargs):
         for k,v in kwargs.items(): 
             if isinstance(v, datetime.datetime):
                 pass
@@ -49,9 +56,22 @@ class BaseDataStore(object):
             elif isinstance(v, str) or isinstance(v, bytes):
                 if len(v) > 1500: # Google data store field size limit.
                     kwargs[k] = v[:1500]
-                
-        job.update(**kwargs)
-        self.put_job(job)
+        return kwargs
+
+    def update(self,
+	       job_id,
+	       **kwargs):
+        """
+        Change just these fields of `job_id`.  Several processes can
+        update the same job at once (e.g., its runner's heartbeat and a
+        submitter recording a timeout) without undoing each other.
+        """
+        log.debug(f"Updating {job_id} with {kwargs}")
+        kwargs = self.clip_fields(kwargs)
+        with self.locked(job_id):
+            job = self.pull(job_id)
+            job.update(**kwargs)
+            self.put_job(job)
 
     def pull(self, job_id):
         return self.get_job(job_id)
@@ -98,3 +118,21 @@ def do_test_datastore(DataStoreType):
     # The entities are not json serializable by default,
     # convert_to_dict should make them so.
     json.dumps(ds.convert_to_dict(ds.pull(str(id2))))
+
+    # Updates of different fields at once all stick, and readers always
+    # see the job.
+    import threading
+    missing = []
+    def updater(name):
+        for i in range(10):
+            ds.update(job_id=str(id2), **{f"{name}{i}": i})
+            if ds.pull(str(id2)) is None:
+                missing.append(i)
+    threads = [threading.Thread(target=updater, args=(name,)) for name in ["a", "b", "c"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    job = ds.pull(str(id2))
+    assert all(job[f"{name}{i}"] == i for name in ["a", "b", "c"] for i in range(10))
+    assert missing == []
@@ -1,6 +1,11 @@
 import os
+import time
+import threading
+import traceback
+import concurrent.futures
 import logging as log
 from uuid import uuid4 as uuid
+from contextlib import contextmanager
 
 class AlreadyExists(Exception):
     pass
@@ -9,6 +14,138 @@ class NotFound(Exception):
 class DeadlineExceeded(Exception):
     pass
 
+class Lease(object):
+    """
+    A message you've pulled but haven't acknowledged.  If you don't
+    acknowledge it before its ack deadline, it'll be delivered again.
+    `extend()` pushes the deadline back.
+    """
+    def __init__(self, subscriber, message):
+        self.subscriber = subscriber
+        self.message = message
+        self.data = message.data.decode("utf8")
+        # Backends that don't count deliveries say 0 or None.
+        self.delivery_attempt = getattr(message, "delivery_attempt", None) or None
+        self.acknowledged = False
+        # True while something (kept(), or a streaming pull) is extending it for us.
+        self.kept_alive = False
+
+    @property
+    def redelivered(self):
+        return (self.delivery_attempt or 1) > 1
+
+    def acknowledge(self):
+        self.subscriber.acknowledge([self])
+
+    def extend(self, seconds):
+        """
+        Give us `seconds` more before it's delivered again.
+        """
+        self.subscriber.do_modify_ack_deadline(self.subscriber.subscription_path, self.message, seconds)
+
+    def nack(self):
+        """
+        Give it back, to be delivered again right away.
+        """
+        try:
+            self.extend(0)
+        except Exception as e:
+            log.debug(f"Couldn't give back {self.data}: {e}")
+
+    @contextmanager
+    def kept(self, seconds):
+        """
+        Keep extending the lease, `seconds` at a time, until the with block ends.
+        """
+        if self.kept_alive:
+            yield self
+            return
+        self.kept_alive = True
+        done = threading.Event()
+        def keep():
+            while not self.acknowledged:
+                try:
+                    self.extend(seconds)
+                except Exception as e:
+                    log.warning(f"Couldn't extend the lease on {self.data}: {e}")
+                if done.wait(seconds/3):
+                    return
+        t = threading.Thread(target=keep, daemon=True)
+        t.start()
+        try:
+            yield self
+        finally:
+            done.set()
+            t.join()
+            self.kept_alive = False
+
+def deliver(callback, lease):
+    """
+    Run `callback(lease)`.  If it doesn't acknowledge the message, give
+    it back.
+    """
+    try:
+        callback(lease)
+    except Exception as e:
+        log.error(f"Callback for {lease.data} failed: {e}\n{traceback.format_exc()}")
+    finally:
+        if not lease.acknowledged:
+            lease.nack()
+
+# How long each pull in a StreamingPull waits before checking whether
+# it's been cancelled.
+STREAM_PULL_WAIT_SEC = 1
+
+class StreamingPull(object):
+    """
+    What `BaseSubscriber.subscribe()` returns.  A thread pulls messages
+    whenever there's a worker free to take them, and hands them to the
+    callback in the workers, keeping their leases while it runs.
+    `cancel()` stops pulling, and `join()` waits for the callbacks that
+    are running to finish.
+    """
+    def __init__(self, subscriber, callback, max_outstanding, lease_sec):
+        self.subscriber = subscriber
+        self.callback = callback
+        self.lease_sec = lease_sec
+        self.slots = threading.Semaphore(max_outstanding)
+        self.stopped = threading.Event()
+        self.workers = concurrent.futures.ThreadPoolExecutor(max_workers=max_outstanding, thread_name_prefix="subscriber")
+        self.thread = threading.Thread(target=self._pull, daemon=True)
+        self.thread.start()
+
+    def _pull(self):
+        while not self.stopped.is_set():
+            if not self.slots.acquire(timeout=1):
+                continue
+            free = 1
+            while self.slots.acquire(blocking=False):
+                free += 1
+            try:
+                leases = self.subscriber.pull_leased(max_messages=free, timeout=STREAM_PULL_WAIT_SEC)
+            except Exception as e:
+                log.error(f"Pulling from {self.subscriber.subscription_path} failed: {e}.  Trying again in 10 seconds.")
+                leases = []
+                self.stopped.wait(10)
+            for i in range(free - len(leases)):
+                self.slots.release()
+            for lease in leases:
+                self.workers.submit(self._deliver, lease)
+
+    def _deliver(self, lease):
+        try:
+            with lease.kept(self.lease_sec):
+                deliver(self.callback, lease)
+        finally:
+            self.slots.release()
+
+    def cancel(self):
+        self.stopped.set()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        self.workers.shutdown(wait=True)
+
 class PubSubAgent(object):
 
     def add_namespace(self, name, prefix):
@@ -25,7 +162,7 @@ class PubSubAgent(object):
         
 
 class BasePublisher(PubSubAgent):
-    def __init__(self, topic, private_topic=False, **kwargs):
+    def __init__(self, topic, private_topic=False, create_if_missing=True, **kwargs):
         log.debug("BasePublisher Constructor")        
 
         if private_topic:
@@ -41,6 +178,12 @@ class BasePublisher(PubSubAgent):
         self.publisher = self.create_publisher()
         self.topic_path = self.compose_path(self.project, self._topic_name)
 
+        if not create_if_missing:
+            # The topic belongs to someone else, and if it's gone, they
+            # aren't listening anymore.  Don't bring it back.
+            log.debug(f"Not creating topic {self.topic_path}")
+            return
+        
         try:
             log.debug(f"Trying to create topic {self.topic_path}")
             self.topic_object = self.create_topic(self.topic_path, **kwargs)
@@ -57,6 +200,19 @@ class BasePublisher(PubSubAgent):
                                message.encode("utf8"),
                                **kwargs)
 
+    def publish_many(self, messages, **kwargs):
+        """
+        Publish all of `messages`, in as few round trips as the backend allows.
+        """
+        log.debug(f"Publishing {len(messages)} messages to {self._topic_name}")
+        return self.do_publish_many(self.topic_path,
+                                    [m.encode("utf8") for m in messages],
+                                    **kwargs)
+
+    def do_publish_many(self, path, messages, **kwargs):
+        for m in messages:
+            self.do_publish(path, m, **kwargs)
+
 
     def delete_topic(self, force=False):
         if self.private_topic or force:
@@ -111,26 +267,65 @@ class BaseSubscriber(PubSubAgent):
             log.debug(f"Not creating subscription {self.subscription_path}.  It exists")
 
             
-    def pull(self, max_messages=1, **kwargs):
+    def _pull(self, max_messages, deadline, kwargs):
         log.debug(f"Pulling on {self.subscription_path} from {self.topic_path}")
+        if deadline is not None:
+            kwargs['timeout'] = max(0, deadline - time.time())
         try:
             messages = self.do_pull(self.subscription_path, max_messages, **kwargs)
         except DeadlineExceeded:
             log.debug(f"Pulling on {self.subscription_path} timedout")
             return []
-
         if len(messages) > 0:
             log.debug(f"Pulling on {self.subscription_path} provided {len(messages)} messages")
-            r = []
-            for msg in messages:
-                payload = msg.data.decode("utf8")
-                r.append(payload)
-                log.debug(f"Received {payload}")
-                log.debug(f"Acking message {payload}")
-                self.do_acknowledge(self.subscription_path, msg)
-            return r
-        else:
-            return []
+        return messages
+
+    def pull(self, max_messages=1, deadline=None, **kwargs):
+        """
+        Returns up to `max_messages` messages.  Waits until `timeout`
+        seconds pass (or until `deadline`, a time.time()) for them.
+        """
+        messages = self._pull(max_messages, deadline, kwargs)
+        r = []
+        for msg in messages:
+            payload = msg.data.decode("utf8")
+            r.append(payload)
+            log.debug(f"Received {payload}")
+        if messages:
+            log.debug(f"Acking {len(messages)} messages")
+            self.do_acknowledge_many(self.subscription_path, messages)
+        return r
+
+    def pull_leased(self, max_messages=1, deadline=None, **kwargs):
+        """
+        Like `pull()`, but returns Leases and doesn't acknowledge them.
+        """
+        return [Lease(self, msg) for msg in self._pull(max_messages, deadline, kwargs)]
+
+    def acknowledge(self, leases):
+        """
+        Acknowledge `leases` (from `pull_leased()`) all at once.
+        """
+        leases = [l for l in leases if not l.acknowledged]
+        if leases:
+            log.debug(f"Acking {', '.join(l.data for l in leases)}")
+            self.do_acknowledge_many(self.subscription_path, [l.message for l in leases])
+        for l in leases:
+            l.acknowledged = True
+
+    def do_acknowledge_many(self, path, msgs):
+        for msg in msgs:
+            self.do_acknowledge(path, msg)
+
+    def subscribe(self, callback, max_outstanding=1, lease_sec=60):
+        """
+        Call `callback(lease)` for each message as it arrives, in up to
+        `max_outstanding` worker threads at once.  Leases are extended,
+        `lease_sec` at a time, while the callback runs, and messages it
+        doesn't acknowledge are delivered again.  Returns a handle with
+        `cancel()` and `join()`.
+        """
+        return StreamingPull(self, callback, max_outstanding, lease_sec)
 
     def delete_subscription(self, force=False):
 
@@ -230,6 +425,47 @@ def do_test_subscriber(SubscriberType, PublisherType):
                 break
         assert len(missing2) == 0
 
+        with SubscriberType(topic=topic.topic) as batch:
+            topic.publish_many(["a", "b", "c"])
+            got = []
+            for i in range(0,30):
+                got += batch.pull(timeout=1, max_messages=3)
+                if len(got) == 3:
+                    break
+            assert sorted(got) == ["a", "b", "c"]
+            assert batch.pull(timeout=1) == []
+
+        with SubscriberType(topic=topic.topic) as streamed:
+            lock = threading.Lock()
+            running = []
+            most_running = [0]
+            got = []
+            def callback(lease):
+                with lock:
+                    running.append(lease.data)
+                    most_running[0] = max(most_running[0], len(running))
+                time.sleep(0.2)
+                with lock:
+                    running.remove(lease.data)
+                    if lease.data == "again" and not lease.redelivered and "again" not in got:
+                        got.append("again")
+                        return # without acking it, so it comes back.
+                    got.append(lease.data)
+                lease.acknowledge()
+
+            stream = streamed.subscribe(callback, max_outstanding=2)
+            topic.publish_many(["x", "y", "z", "again"])
+            for i in range(0, 100):
+                with lock:
+                    if len(got) == 5:
+                        break
+                time.sleep(0.2)
+            stream.cancel()
+            stream.join()
+            assert sorted(got) == ["again", "again", "x", "y", "z"]
+            assert most_running[0] <= 2
+            assert streamed.pull(timeout=1) == []
+
         with SubscriberType(topic=topic.topic) as s5:
             assert SubscriberType.subscription_exists(s5.subscription_path)
             s5_path = s5.subscription_path
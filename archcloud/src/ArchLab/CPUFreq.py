@@ -34,6 +34,14 @@ def set_freq_cli(argv=None):
     set_freq(target_MHz)
     
 def get_freqs():
+    """
+    The clock speeds (in MHz) we can set, fastest first.  We only ask
+    cpupower once per boot (see Probes.py).
+    """
+    from .Probes import probe_result
+    return list(probe_result("cpu_freqs"))
+
+def read_freqs():
     try:
         if subprocess.call(['which', 'cpupower'], stdout=subprocess.PIPE) != 0:
             log.warning("cpupower utility is not available.  Clock speed setting will not work.")
@@ -1,4 +1,4 @@
-from .Runner import LabSpec, build_submission, run_submission_locally, run_submission_remotely, environment, UserError
+from .Runner import LabSpec, build_submission, run_submission_locally, run_submission_remotely, environment, UserError, cd
 import unittest
 import logging as log
 import os
@@ -13,6 +13,12 @@ import importlib
 import fnmatch
 import json
 import textwrap
+import shutil
+import fcntl
+from contextlib import contextmanager
+from .CSVTable import csv_table
+from .GTest import run_gtests, gtest_report
+from .Probes import probe_result
 
 # this is for parameterizing tests
 def crossproduct(a,b):
@@ -128,11 +134,7 @@ class CSE141Lab(LabSpec):
         
     @classmethod
     def does_papi_work(cls):
-        try:
-            subprocess.check_call(['archlab_check', '--engine', 'papi'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return True
-        except:
-            return False
+        return probe_result("papi")
         
     class EasyFileAccess(object):
         
@@ -153,6 +155,9 @@ class CSE141Lab(LabSpec):
                 except UnicodeDecodeError:
                     self.assertFalse(f"{name} should be a text file, but it's not.")
             
+        def read_csv_table(self, name, root=None):
+            return csv_table(self.read_text_file(name, root))
+
         def read_binary_file(self, name, root=None):
             with self.open_file(name, root, mode="b") as f:
                 return f.read()
@@ -179,30 +184,27 @@ class CSE141Lab(LabSpec):
             unittest.TestCase.run(self, result) # call superclass run method
 
         def assert_success_so_far(self,msg=None):
-            errors = len(self.currentResult.failures) + len(self.currentResult.errors)
+            # When the tests run in parallel, failures in the tests this one depends on are in prior_failures.
+            errors = len(self.currentResult.failures) + len(self.currentResult.errors) + getattr(self.currentResult, "prior_failures", 0)
             if errors != 0:
                 raise Exception(wrap_message(msg if msg is not None else f"Test failed because {errors} error have already occurred.  These are usually things like the regressions didn't pass.  Please check above for the original error."))
 
         def check_gtest_regression(self, label, filename):
-            with open(filename) as testjson:
-                results = json.load(testjson)
-
             cmd = ["./run_tests.exe", f"--gtest_filter=*{label}*"]
+            self._check_gtest_results(gtest_report(filename).matching(label), cmd)
 
-            for suite in results['testsuites']:
-                for test in suite['testsuite']:
-                    fullname = f"{test['classname']}.{test['name']}"
-                    if fnmatch.fnmatch(fullname, f"*{label}*"):
-                        print(f"Test name: {fullname}")
-                        if test['result'] != "COMPLETED":
-                            self.assertEqual(test['result'],"COMPLETED", "This test did not complete.  Not sure why.  Ask on piazza.  Provide a link to your gradescope build.")
-                        failures = test.get('failures')
-                        if failures:
-                            print(f"The test failed.  You can reproduce this with {' '.join(cmd)}:\n")
-                            print("\n\n".join(map(lambda x: x['failure'], failures)))
-                            self.assertTrue(False, "Test failed")
-                        else:
-                            print("The test passed!")
+        def _check_gtest_results(self, tests, cmd):
+            for fullname, test in tests:
+                print(f"Test name: {fullname}")
+                if test['result'] != "COMPLETED":
+                    self.assertEqual(test['result'],"COMPLETED", "This test did not complete.  Not sure why.  Ask on piazza.  Provide a link to your gradescope build.")
+                failures = test.get('failures')
+                if failures:
+                    print(f"The test failed.  You can reproduce this with {' '.join(cmd)}:\n")
+                    print("\n\n".join(map(lambda x: x['failure'], failures)))
+                    self.assertTrue(False, "Test failed")
+                else:
+                    print("The test passed!")
 
         # TODO: REMOVE THIS FUNCTION
         def go_run_tests(self, label, cwd=None):
@@ -213,7 +215,25 @@ class CSE141Lab(LabSpec):
             log.debug(f"Runing regression {label} {self.regression_count}")
             if not os.path.exists("./run_tests.exe"):
                 self.skipTest("Regression not run, since run_tests.exe was not built.  This is probably because either compilation or running your job failed.")
-                
+
+            # Run all the tests once, and look this label up in the report.
+            cmd = ["./run_tests.exe", f"--gtest_filter=*{label}*"]
+            try:
+                run = run_gtests("./run_tests.exe")
+            except OSError as e:
+                self.assertTrue(False, f"Something went wrong running the regressions.  If run_tests.exe runs for you locally, this is probably a bug in the autograder: {repr(e)}.")
+
+            if run.report is None:
+                # It crashed or hung, so we don't know which tests are to blame.  Run this label's by itself.
+                log.debug(f"Running all the tests didn't work (exit code {run.returncode}).  Running {label} alone.")
+                return self._go_run_one_label(label)
+
+            self.regressions_passed += 1
+            log.debug(f"Passed {self.regressions_passed}")
+            sys.stdout.write(f"To reproduce: make run_test.exe; {' '.join(cmd)}\n")
+            self._check_gtest_results(run.report.matching(label), cmd)
+
+        def _go_run_one_label(self, label):
             try:
                 timedout = False
                 log.debug(f"PWD={os.getcwd()}")
@@ -262,6 +282,41 @@ class CSE141Lab(LabSpec):
             return precise, approximate
         
         
+        @contextmanager
+        def build_directory(self, solution, flags):
+            """
+            When the meta regressions run in parallel (see
+            ParallelTests.MetaRegressionRunner), each configuration runs in
+            a copy of the lab, shared with the other configurations that
+            build the same thing (same solution, devel, gprof, and
+            public_lab), which take turns with it.  Yields whether it's
+            already been built.  Timing runs get pinned to the core the
+            runner gave us.
+            """
+            root = os.environ.get('META_REGRESSION_WORKDIRS')
+            if not root:
+                yield False
+                return
+
+            if not flags.devel and 'META_REGRESSION_CORE' in os.environ:
+                os.sched_setaffinity(0, {int(os.environ['META_REGRESSION_CORE'])})
+
+            key = f"{solution.replace('/', '_')}-{flags.devel}-{flags.gprof}-{flags.public_lab}"
+            workdir = os.path.join(root, key)
+            with open(f"{workdir}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(workdir):
+                        shutil.copytree(".", workdir, symlinks=True)
+                    built = os.path.exists(f"{workdir}.built")
+                    with cd(workdir):
+                        yield built
+                    if not flags.pristine and not flags.remote: # the others build somewhere else.
+                        with open(f"{workdir}.built", "w"):
+                            pass
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
         def run_solution(self, solution, flags):
             tag = f"{solution}-{'pristine' if flags.pristine else ''}-{'devel' if flags.devel else ''}-{'gprof' if flags.gprof else ''}-{'remote' if flags.remote else ''}-{'public' if flags.public_lab else ''}"
             log.info(f"=========================== Starting {tag} in {self.id()} in {os.getcwd()} ==========================================")
@@ -289,7 +344,7 @@ class CSE141Lab(LabSpec):
             else:
                 env['GPROF'] = 'no'
                 
-            with environment(**env):
+            with environment(**env), self.build_directory(solution, flags) as built:
                 submission = build_submission(".",
                                               solution,
                                               None,
@@ -304,7 +359,8 @@ class CSE141Lab(LabSpec):
                     result = run_submission_locally(submission,
                                                     run_in_docker=False,
                                                     docker_image=os.environ['DOCKER_RUNNER_IMAGE'],
-                                                    run_pristine=flags.pristine)
+                                                    run_pristine=flags.pristine,
+                                                    clean=not built)
                     
                 log.debug(f"results={result.results}")
             log.info(f"=========================== Finished {tag} as {self.id()} in {os.getcwd()}  ==========================================")
@@ -0,0 +1,13 @@
+import os
+
+def archlab_cache_dir(*parts):
+    """
+    Return (and create) a directory for per-host caches.  Everything lives
+    under $ARCHLAB_CACHE_DIR, which defaults to ~/.cache/archlab.  It's
+    always safe to delete.
+    """
+    root = os.environ.get("ARCHLAB_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "archlab"))
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
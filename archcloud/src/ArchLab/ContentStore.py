@@ -0,0 +1,173 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import logging as log
+
+from .CacheDir import archlab_cache_dir
+from .BaseBlobStore import NotFound
+
+class ContentStore(object):
+    """
+    Content-addressed file bodies in a blob store.
+
+    Each body is stored once, as `content/<sha256>`, and envelopes refer
+    to it by hash.  So, when a student resubmits the same files, we don't
+    upload them again, and runners that have seen them before read them
+    from a local cache instead of downloading them.
+
+    Bodies nothing refers to are removed by `collect_garbage()` (see
+    `labtool gc-blobs`).  To keep it from deleting a body that someone
+    is about to refer to, `put()` refreshes the body's timestamp, and
+    `collect_garbage()` leaves anything newer than `grace_sec` alone.
+    """
+    PREFIX = "content/"
+
+    # How long we trust that a body we've seen is still there.  This must
+    # be much shorter than the garbage collector's grace period.
+    KNOWN_TTL_SEC = 3600
+
+    _known = {} # (bucket, digest) -> time we last saw it.
+    _known_lock = threading.Lock()
+
+    def __init__(self, blobstore, cache_dir=None):
+        self.blobstore = blobstore
+        self.cache_dir = cache_dir if cache_dir is not None else archlab_cache_dir("content")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def digest(cls, contents):
+        return hashlib.sha256(contents).hexdigest()
+
+    def blob_name(self, digest):
+        return f"{self.PREFIX}{digest}"
+
+    def _cache_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _key(self, digest):
+        return (getattr(self.blobstore, "directory", None) or getattr(self.blobstore, "bucket_name", None), digest)
+
+    def _recently_seen(self, digest):
+        with self._known_lock:
+            return time.time() - self._known.get(self._key(digest), 0) < self.KNOWN_TTL_SEC
+
+    def _seen(self, digest):
+        with self._known_lock:
+            self._known[self._key(digest)] = time.time()
+
+    def _write_cache(self, digest, contents):
+        path = self._cache_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            f.write(contents)
+        os.rename(f.name, path)
+
+    def put(self, contents):
+        """
+        Store `contents` (bytes), if it's not already there, and return its digest.
+        """
+        digest = self.digest(contents)
+        if not self._recently_seen(digest):
+            if not self.blobstore.touch(self.blob_name(digest)):
+                log.debug(f"Uploading {len(contents)} bytes as {digest}")
+                with tempfile.NamedTemporaryFile() as f:
+                    f.write(contents)
+                    f.flush()
+                    self.blobstore.upload_file(self.blob_name(digest), f.name)
+            self._seen(digest)
+        self._write_cache(digest, contents)
+        return digest
+
+    def get(self, digest):
+        """
+        Return the contents with `digest`.  Raises NotFound if there are none.
+        """
+        path = self._cache_path(digest)
+        try:
+            with open(path, "rb") as f:
+                contents = f.read()
+            os.utime(path) # so it's easy to prune the oldest by hand.
+            return contents
+        except FileNotFoundError:
+            pass
+
+        with tempfile.NamedTemporaryFile() as f:
+            self.blobstore.download_file(self.blob_name(digest), f.name)
+            with open(f.name, "rb") as r:
+                contents = r.read()
+        if self.digest(contents) != digest:
+            raise NotFound(f"Content {digest} is corrupt")
+        # Not _seen(): reading a body doesn't keep it from being
+        # collected, so the next put() of it still has to touch() it.
+        self._write_cache(digest, contents)
+        return contents
+
+    def collect_garbage(self, referenced_by, grace_sec=24*3600, dry_run=False):
+        """
+        Mark and sweep.  `referenced_by(name)` returns the digests the
+        blob `name` refers to.  Returns the names of the bodies it deleted.
+        """
+        marked = set()
+        for name, mtime in self.blobstore.list_files():
+            if not name.startswith(self.PREFIX):
+                marked.update(referenced_by(name))
+
+        deleted = []
+        now = time.time()
+        for name, mtime in self.blobstore.list_files(self.PREFIX):
+            digest = name[len(self.PREFIX):]
+            if digest in marked or now - mtime < grace_sec:
+                continue
+            log.info(f"Deleting unreferenced {name}")
+            if not dry_run:
+                try:
+                    self.blobstore.delete_file(name)
+                except NotFound:
+                    pass
+            deleted.append(name)
+
+        with self._known_lock:
+            for name in deleted:
+                self._known.pop(self._key(name[len(self.PREFIX):]), None)
+        return deleted
+
+def test_content_store():
+    from .BlobStore import BlobStore
+    if "EMULATION_DIR" not in os.environ:
+        import pytest
+        pytest.skip()
+
+    with tempfile.TemporaryDirectory() as d:
+        bs = BlobStore(f"content-test-{os.getpid()}")
+        cs = ContentStore(bs, cache_dir=os.path.join(d, "a"))
+        digest = cs.put(b"hello")
+        assert cs.put(b"hello") == digest
+        assert cs.get(digest) == b"hello"
+
+        # Someone else gets it from the blob store.
+        other = ContentStore(bs, cache_dir=os.path.join(d, "b"))
+        with cs._known_lock:
+            cs._known.clear()
+        assert other.get(digest) == b"hello"
+
+        # Getting it doesn't touch it, so a put() afterwards has to.
+        touched = []
+        touch = bs.touch
+        bs.touch = lambda name: touched.append(name) or touch(name)
+        other.put(b"hello")
+        assert touched == [cs.blob_name(digest)]
+        bs.touch = touch
+
+        garbage = cs.put(b"garbage")
+        assert cs.collect_garbage(lambda name: [], grace_sec=3600) == []
+        deleted = cs.collect_garbage(lambda name: [], grace_sec=0)
+        assert set(deleted) == {cs.blob_name(digest), cs.blob_name(garbage)}
+
+        # Once it's collected, put() uploads it again.
+        cs.put(b"hello")
+        assert ContentStore(bs, cache_dir=os.path.join(d, "c")).get(digest) == b"hello"
+        bs.delete_file(cs.blob_name(digest))
@@ -1,7 +1,7 @@
 import os
 import logging as log
 
-if os.environ["CLOUD_MODE"] == "EMULATION":
+if os.environ["CLOUD_MODE"] in ["EMULATION", "EMULATION_SQLITE"]:
     from .LocalDataStore import LocalDataStore as DataStore
 else:
     from .GoogleDataStore import GoogleDataStore as DataStore
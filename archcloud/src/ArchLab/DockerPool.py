@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""
+A pool of warm docker containers for running jobs.
+
+Starting a container and importing ArchLab inside it takes several
+seconds per job.  Instead, we start containers ahead of time.  Each runs
+`runlab.worker`, which imports runlab once and then waits for requests
+on a channel: a directory in /staging, which the daemon's container and
+the runners share.  For each request, the worker forks, and the child
+runs runlab, so every job starts from the same clean process state.
+Afterwards, the worker kills everything the job started and empties the
+container's scratch directories, so the next job starts from a clean
+container too.
+
+The pool checks that a container is alive (and its worker is
+heartbeating) before using it, replaces containers after
+`recycle_after` jobs, and kills any container whose job times out (or
+that couldn't clean up after a job).  If
+no warm container is available, the caller falls back to a cold `docker
+run`.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import signal
+import argparse
+import platform
+import threading
+import subprocess
+import logging as log
+from uuid import uuid4 as uuid
+
+HEARTBEAT_SEC = 1
+HEALTHY_HEARTBEAT_SEC = 10
+BOOT_SEC = 60
+POLL_SEC = 0.05
+
+def my_container_id():
+    cgroup = subprocess.check_output("tail -1 /proc/self/cgroup".split())
+    container_id = cgroup.decode("utf8").split("/")[-1].strip()
+    if container_id == "":
+        log.error(f"Couldn't get my container id.  Output was: {cgroup}")
+        log.error("cat /proc/self/cgroup: ")
+        log.error(subprocess.check_output("cat /proc/self/cgroup".split()))
+    return container_id
+
+def docker_run_options():
+    """
+    The options every runner container needs: the same view of /staging
+    (and everything else) that we have.
+    """
+    return (["--hostname", f"{platform.node()}-runner",
+             "--volumes-from", my_container_id(),
+             "--privileged"] +
+            (["--volume", "/home/swanson/cse141pp-archlab/archcloud/src:/course/cse141pp-archlab/archcloud/src"] if "USE_LOCAL_ARCHCLOUD" in os.environ else []))
+
+def _atomic_write_json(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.rename(f"{path}.tmp", path)
+
+class Channel(object):
+    """
+    The dispatcher's end of a worker's channel.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def heartbeat_age(self):
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.path, "heartbeat"))
+        except FileNotFoundError:
+            return float("inf")
+
+    def dispatch(self, argv, env, cwd, out, timeout=None):
+        """
+        Run runlab with `argv` in the worker, and copy its output to `out`
+        (e.g., an OutputSpool, whose limits the worker applies too).
+        Returns the exit code and whether the worker could clean up after
+        the job.  Raises subprocess.TimeoutExpired if it takes too long.
+        """
+        request_id = str(uuid())
+        response_path = os.path.join(self.path, f"response-{request_id}.json")
+        output = os.path.join(self.path, f"output-{request_id}")
+        _atomic_write_json(os.path.join(self.path, "request.json"),
+                           dict(id=request_id, argv=argv, env=env, cwd=cwd,
+                                max_bytes=getattr(out, "max_bytes", None), tail_bytes=getattr(out, "tail_bytes", None)))
+        deadline = time.time() + timeout if timeout else None
+        try:
+            while not os.path.exists(response_path):
+                if deadline and time.time() > deadline:
+                    raise subprocess.TimeoutExpired(argv, timeout)
+                time.sleep(POLL_SEC)
+            with open(response_path) as f:
+                response = json.load(f)
+        finally:
+            if os.path.exists(output):
+                with open(output, "rb") as f:
+                    out.pump(f)
+            for p in [response_path, output, os.path.join(self.path, "request.json")]:
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+        return response['exit_code'], response.get('clean', True)
+
+class WarmContainer(object):
+    def __init__(self, name, channel):
+        self.name = name
+        self.channel = channel
+        self.jobs = 0
+        self.broken = False
+        self.started = time.time()
+
+class DockerPool(object):
+    def __init__(self, size, docker_image, recycle_after=20, channel_root="/staging/pool"):
+        self.size = size
+        self.docker_image = docker_image
+        self.recycle_after = recycle_after
+        self.channel_root = channel_root
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.containers = []
+        self.serial = 0
+
+    def _docker(self, *args):
+        return subprocess.run(["docker"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def start(self):
+        for i in range(self.size):
+            c = self._launch()
+            if c:
+                self.idle.put(c)
+
+    def _launch(self):
+        with self.lock:
+            self.serial += 1
+            name = f"runner-pool-{platform.node()}-{os.getpid()}-{self.serial}"
+        channel = Channel(os.path.join(self.channel_root, name))
+        log.info(f"Starting warm runner {name}")
+        try:
+            p = self._docker("run", "-d", "--name", name,
+                             *docker_run_options(),
+                             self.docker_image,
+                             "runlab.worker", "--channel", channel.path, "--scratch", "/tmp", "--scratch", "/var/tmp")
+        except OSError as e:
+            log.error(f"Couldn't start warm runner {name}: {e}")
+            return None
+        if p.returncode != 0:
+            log.error(f"Couldn't start warm runner {name}: {p.stdout.decode('utf8', errors='replace')}")
+            return None
+        c = WarmContainer(name, channel)
+        with self.lock:
+            self.containers.append(c)
+        return c
+
+    def _retire(self, c):
+        log.info(f"Retiring warm runner {c.name} after {c.jobs} jobs")
+        self._docker("rm", "-f", c.name)
+        shutil.rmtree(c.channel.path, ignore_errors=True)
+        with self.lock:
+            if c in self.containers:
+                self.containers.remove(c)
+
+    def state(self, c):
+        """
+        "ready", "booting", or "dead".
+        """
+        if c.broken:
+            return "dead"
+        p = self._docker("inspect", "-f", "{{.State.Running}}", c.name)
+        if p.returncode != 0 or p.stdout.decode("utf8").strip() != "true":
+            return "dead"
+        age = c.channel.heartbeat_age()
+        if age <= HEALTHY_HEARTBEAT_SEC:
+            return "ready"
+        if age == float("inf") and time.time() - c.started < BOOT_SEC:
+            return "booting"
+        return "dead"
+
+    def acquire(self, wait=1):
+        """
+        Get a healthy idle container, or None.
+        """
+        deadline = time.time() + wait
+        while True:
+            try:
+                c = self.idle.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return None
+            state = self.state(c)
+            if state == "ready":
+                return c
+            elif state == "booting":
+                self.idle.put(c)
+                if time.time() >= deadline:
+                    return None
+                time.sleep(POLL_SEC)
+            else:
+                log.warning(f"Warm runner {c.name} is unhealthy.  Replacing it.")
+                self._replace(c)
+
+    def _replace(self, c):
+        self._retire(c)
+        n = self._launch()
+        if n:
+            self.idle.put(n)
+
+    def release(self, c):
+        if c.broken or c.jobs >= self.recycle_after:
+            # Do it in the background, so the job can finish.
+            threading.Thread(target=self._replace, args=(c,), daemon=True).start()
+        else:
+            self.idle.put(c)
+
+    def run(self, argv, env, cwd, out, timeout=None):
+        """
+        Run runlab with `argv` in a warm container.  Returns the exit
+        code, or None if there wasn't a warm container available.
+        Raises subprocess.TimeoutExpired if the job times out.
+        """
+        c = self.acquire()
+        if c is None:
+            return None
+        try:
+            c.jobs += 1
+            exit_code, clean = c.channel.dispatch(argv, env, cwd, out, timeout=timeout)
+            if not clean:
+                log.warning(f"Couldn't clean up {c.name} after a job.  Replacing it.")
+                c.broken = True
+            return exit_code
+        except:
+            c.broken = True
+            raise
+        finally:
+            self.release(c)
+
+    def shutdown(self):
+        with self.lock:
+            containers = list(self.containers)
+        for c in containers:
+            self._retire(c)
+
+def _job_main(request):
+    """
+    Run the request's runlab (in the forked child).  Returns the exit code.
+    """
+    os.environ.update(request['env'])
+    os.chdir(request['cwd'])
+    # Let runlab set up logging its own way.
+    for h in log.root.handlers[:]:
+        log.root.removeHandler(h)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from . import runlab
+    try:
+        runlab.main(request['argv'])
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+
+def _become_subreaper():
+    # Then anything the job leaves behind gets reparented to us instead
+    # of escaping to init, so we can find it and kill it.
+    try:
+        import ctypes
+        PR_SET_CHILD_SUBREAPER = 36
+        return ctypes.CDLL(None, use_errno=True).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+def _children():
+    r = []
+    me = os.getpid()
+    try:
+        pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+    except FileNotFoundError:
+        return r
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses, and can contain anything.
+        if int(stat[stat.rindex(")") + 2:].split()[1]) == me:
+            r.append(pid)
+    return r
+
+def _reset(pgid, scratch, timeout=10):
+    """
+    Get the container back to how it was before the job: kill everything
+    the job started, and empty the `scratch` directories.  Returns False
+    if we couldn't.
+    """
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+    deadline = time.time() + timeout
+    while True:
+        children = _children()
+        if not children:
+            break
+        if time.time() > deadline:
+            log.error(f"Couldn't kill processes {children} left over from the last job.")
+            return False
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    clean = True
+    for d in scratch:
+        if os.path.ismount(d):
+            # It's shared with someone else (e.g., a volume), so it isn't
+            # ours to empty.
+            log.warning(f"Not cleaning {d}, since it's a mount point.")
+            continue
+        for f in os.listdir(d):
+            path = os.path.join(d, f)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                log.error(f"Couldn't remove {path} left over from the last job: {e}")
+                clean = False
+    return clean
+
+def _run_request(request, channel, scratch=()):
+    from .OutputSpool import OutputSpool
+    # The job writes to a pipe rather than straight to the file, so the
+    # file is capped the same way the dispatcher's spool is.
+    spool = OutputSpool(os.path.join(channel, f"output-{request['id']}"),
+                        **{k: request[k] for k in ["max_bytes", "tail_bytes"] if request.get(k) is not None})
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # Our own process group, so we can kill everything the job starts.
+            os.setsid()
+            os.close(r)
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.close(w)
+            sys.stdout = os.fdopen(1, "w", buffering=1)
+            sys.stderr = os.fdopen(2, "w", buffering=1)
+            code = _job_main(request)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    os.close(w)
+    with os.fdopen(r, "rb") as output:
+        pump = spool.start_pump(output)
+        _, status = os.waitpid(pid, 0)
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        clean = _reset(pid, scratch)
+        spool.finish_pump(pump)
+    spool.close()
+    _atomic_write_json(os.path.join(channel, f"response-{request['id']}.json"), dict(exit_code=code, clean=clean))
+
+def worker_main(argv=None):
+    """
+    Run inside a warm container: wait for requests on the channel, and run them.
+    """
+    parser = argparse.ArgumentParser(description='Wait for runlab jobs and run them.')
+    parser.add_argument('--channel', required=True, help="Directory to get requests from")
+    parser.add_argument('--scratch', action='append', default=[], help="Directory to empty after each job (e.g., /tmp)")
+    parser.add_argument('-v', action='store_true', dest="verbose", default=False, help="Be verbose")
+    if argv == None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if args.verbose else "%(levelname)-8s %(message)s",
+                    level=log.DEBUG if args.verbose else log.INFO)
+
+    from . import runlab # This is the import we are here to avoid repeating.
+
+    if not _become_subreaper():
+        log.warning("Couldn't become a subreaper.  Processes that jobs leave behind might survive.")
+    os.makedirs(args.channel, exist_ok=True)
+    heartbeat = os.path.join(args.channel, "heartbeat")
+    request_path = os.path.join(args.channel, "request.json")
+    last_beat = 0
+    while True:
+        if time.time() - last_beat > HEARTBEAT_SEC:
+            with open(heartbeat, "w"):
+                pass
+            last_beat = time.time()
+        try:
+            with open(request_path) as f:
+                request = json.load(f)
+        except FileNotFoundError:
+            time.sleep(POLL_SEC)
+            continue
+        os.remove(request_path)
+        log.info(f"Running {request['argv']} in {request['cwd']}")
+        _run_request(request, args.channel, args.scratch)
+
+def test_channel():
+    import tempfile
+    from .OutputSpool import OutputSpool
+    with tempfile.TemporaryDirectory() as d:
+        channel = Channel(os.path.join(d, "channel"))
+        worker = subprocess.Popen([sys.executable, "-c", "from ArchLab.DockerPool import worker_main; worker_main()", "--channel", channel.path])
+        try:
+            env = dict(DOCKER_RUNNER_IMAGE="none")
+            out = OutputSpool(os.path.join(d, "out"))
+            assert channel.dispatch(["--help"], env, d, out, timeout=60) == (0, True)
+            assert "usage" in out.view()
+            assert channel.heartbeat_age() < HEALTHY_HEARTBEAT_SEC
+
+            # Failures come back as exit codes.
+            out = OutputSpool(os.path.join(d, "out2"))
+            assert channel.dispatch(["--no-such-flag"], env, d, out, timeout=60)[0] != 0
+            assert "unrecognized arguments" in out.view()
+        finally:
+            worker.terminate()
+            worker.wait()
+
+def test_reset():
+    import tempfile
+    from .OutputSpool import OutputSpool
+    # A job that leaves a process and some files behind, and prints a lot.
+    job = """
+import os, sys, subprocess
+from ArchLab import DockerPool
+def job(request):
+    subprocess.Popen(["sleep", "4242"], start_new_session=True)
+    open(os.path.join(request['cwd'], 'scratch', 'junk'), 'w').close()
+    os.makedirs(os.path.join(request['cwd'], 'scratch', 'dir'))
+    sys.stdout.write("x" * 100000)
+    return 3
+DockerPool._job_main = job
+DockerPool.worker_main()
+"""
+    def leftovers():
+        return subprocess.run(["pgrep", "-f", "^sleep 4242$"], stdout=subprocess.DEVNULL).returncode == 0
+
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, "scratch"))
+        channel = Channel(os.path.join(d, "channel"))
+        worker = subprocess.Popen([sys.executable, "-c", job, "--channel", channel.path, "--scratch", os.path.join(d, "scratch")])
+        try:
+            out = OutputSpool(os.path.join(d, "out"), max_bytes=1000, tail_bytes=100)
+            assert channel.dispatch([], {}, d, out, timeout=60) == (3, True)
+            assert not leftovers()
+            assert os.listdir(os.path.join(d, "scratch")) == []
+            assert "omitted" in out.view()
+            assert os.path.getsize(out.path) < 2000
+        finally:
+            worker.terminate()
+            worker.wait()
+            subprocess.run(["pkill", "-f", "^sleep 4242$"])
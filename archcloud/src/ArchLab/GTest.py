@@ -0,0 +1,179 @@
+"""
+Run a lab's googletest regressions once, and look up results by label.
+
+Labs check their regressions one label at a time.  Instead of running
+`run_tests.exe --gtest_filter=*label*` (and parsing its report) for each
+one, `run_gtests()` runs all of them once, keeps the JSON report in the
+archlab cache dir (not the student's directory), and reuses it until the
+executable changes.  An fcntl lock makes sure that graded tests running
+in parallel wait for the same run instead of starting their own.
+`gtest_report()` parses a report once and indexes it by label.
+
+The whole run gets GTEST_TIMEOUT_SEC (120 by default), rather than the
+30 seconds each label used to get, since it's one run instead of one per
+label.  If it times out, callers fall back to running labels one at a
+time.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import fnmatch
+import hashlib
+import subprocess
+import logging as log
+
+from .CacheDir import archlab_cache_dir
+
+# Results for executables we haven't looked at in this long get deleted.
+GTEST_RESULTS_MAX_AGE_SEC = 24*3600
+
+class GTestReport(object):
+    """
+    A parsed googletest JSON report (`--gtest_output=json`).
+    """
+    def __init__(self, data):
+        self.tests = []
+        for suite in data.get('testsuites', []):
+            for test in suite.get('testsuite', []):
+                self.tests.append((f"{test['classname']}.{test['name']}", test))
+        self.by_label = {}
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(json.load(f))
+
+    def matching(self, label):
+        """
+        The (full name, test) pairs that `--gtest_filter=*label*` would run.
+        """
+        if label not in self.by_label:
+            self.by_label[label] = [(n, t) for n, t in self.tests if fnmatch.fnmatch(n, f"*{label}*")]
+        return self.by_label[label]
+
+_reports = {}
+
+def gtest_report(filename):
+    """
+    The GTestReport in `filename`, parsed once (until the file changes).
+    """
+    s = os.stat(filename)
+    key = (os.path.abspath(filename), s.st_mtime_ns, s.st_size)
+    if key not in _reports:
+        _reports[key] = GTestReport.load(filename)
+    return _reports[key]
+
+class GTestRun(object):
+    """
+    The outcome of running all the tests: the report (None if the run
+    didn't finish, e.g., because it crashed or timed out) and the output.
+    """
+    def __init__(self, report, output, returncode):
+        self.report = report
+        self.output = output
+        self.returncode = returncode
+
+def _results_dir(exe):
+    # One directory per build of each executable, so a new build (or a
+    # new job's checkout) never sees an old build's results.
+    s = os.stat(exe)
+    key = f"{os.path.abspath(exe)} {s.st_dev} {s.st_ino} {s.st_mtime_ns} {s.st_size}"
+    root = archlab_cache_dir("gtest")
+    now = time.time()
+    for d in os.listdir(root):
+        path = os.path.join(root, d)
+        try:
+            if now - os.path.getmtime(path) > GTEST_RESULTS_MAX_AGE_SEC:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+    path = os.path.join(root, hashlib.sha1(key.encode("utf8")).hexdigest())
+    os.makedirs(path, exist_ok=True)
+    os.utime(path)
+    return path
+
+def run_gtests(exe="./run_tests.exe", timeout=None):
+    """
+    Run all of `exe`'s tests, or reuse the results of the last run if
+    `exe` hasn't changed since.  Returns a GTestRun.
+    """
+    if timeout is None:
+        timeout = int(os.environ.get("GTEST_TIMEOUT_SEC", 120))
+    results = _results_dir(exe)
+    report_path = os.path.join(results, "report.json")
+    output_path = os.path.join(results, "output")
+    returncode_path = os.path.join(results, "returncode")
+
+    with open(os.path.join(results, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(returncode_path):
+                log.debug(f"Reusing test results for {exe}")
+                with open(returncode_path) as f:
+                    cached = f.read()
+                returncode = None if cached == "None" else int(cached)
+            else:
+                log.debug(f"Running all the tests in {exe}")
+                if os.path.exists(report_path):
+                    os.remove(report_path)
+                with open(output_path, "wb") as out:
+                    try:
+                        returncode = subprocess.run([exe, f"--gtest_output=json:{report_path}"],
+                                                    stdout=out, stderr=subprocess.STDOUT, timeout=timeout).returncode
+                    except subprocess.TimeoutExpired:
+                        out.write(f"\n===========Execution timed out after {timeout} seconds.================\n".encode("utf8"))
+                        returncode = None
+                with open(returncode_path, "w") as f:
+                    f.write(f"{returncode}")
+
+            with open(output_path, "rb") as f:
+                output = f.read().decode("utf8", errors="replace")
+            # A test that crashed takes the report (and the rest of the tests) with it.
+            report = gtest_report(report_path) if returncode is not None and returncode >= 0 and os.path.exists(report_path) else None
+            return GTestRun(report, output, returncode)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def test_run_gtests():
+    import sys
+    import tempfile
+    from .Runner import environment
+    with tempfile.TemporaryDirectory() as d, environment(ARCHLAB_CACHE_DIR=os.path.join(d, "results")):
+        exe = os.path.join(d, "run_tests.exe")
+        with open(exe, "w") as f:
+            f.write(f"""#!{sys.executable}
+import os, sys, json
+with open(os.path.join({d!r}, "runs"), "a") as f:
+    f.write("x")
+suites = [dict(name="Alu", testsuite=[dict(classname="Alu", name="add", result="COMPLETED"),
+                                      dict(classname="Alu", name="sub", result="COMPLETED", failures=[dict(failure="1 != 2")])]),
+          dict(name="Mem", testsuite=[dict(classname="Mem", name="load", result="COMPLETED")])]
+with open(sys.argv[1].split(":", 1)[1], "w") as f:
+    json.dump(dict(testsuites=suites), f)
+print("ran them")
+sys.exit(1)
+""")
+        os.chmod(exe, 0o755)
+
+        r = run_gtests(exe)
+        assert r.returncode == 1
+        assert "ran them" in r.output
+        assert [n for n, t in r.report.matching("Alu")] == ["Alu.add", "Alu.sub"]
+        assert [n for n, t in r.report.matching("load")] == ["Mem.load"]
+        assert r.report.matching("nope") == []
+
+        # The second time, we reuse the results.
+        again = run_gtests(exe)
+        assert again.report is r.report
+        assert open(os.path.join(d, "runs")).read() == "x"
+
+        # Until the executable changes.
+        with open(exe, "a") as f:
+            f.write("\n")
+        run_gtests(exe)
+        assert open(os.path.join(d, "runs")).read() == "xx"
+
+        # None of it ends up next to the executable.
+        assert sorted(os.listdir(d)) == ["results", "run_tests.exe", "runs"]
@@ -1,28 +1,45 @@
 from google.cloud import storage
 import google.cloud
+import google.api_core
 import os
-from .BaseBlobStore import BaseBlobStore, do_test_blob_store, NotFound
+import time
+from . import GoogleClients
+from .BaseBlobStore import BaseBlobStore, do_test_blob_store, NotFound, UnknownUser
     
 class GoogleBlobStore(object):
     def __init__(self, bucket):
         self.project = os.environ['GOOGLE_CLOUD_PROJECT']
-        self.client = storage.client.Client(self.project)
+        self.client = GoogleClients.storage(self.project)
         self.bucket_name = f"{os.environ['GOOGLE_RESOURCE_PREFIX']}-{bucket}".lower()
-        try:
-            self.bucket = self.client.get_bucket(self.bucket_name)
-        except google.cloud.exceptions.NotFound:
+        if GoogleClients.exists("bucket", self.bucket_name, lambda: self.client.lookup_bucket(self.bucket_name) is not None):
+            self.bucket = self.client.bucket(self.bucket_name)
+        else:
             self.bucket = self.client.create_bucket(self.bucket_name)
+            GoogleClients.remember("bucket", self.bucket_name)
 
 
     def write_file(self, filename, contents, content_disposition=None, content_type=None, owner=None):
+        return self._upload(filename, lambda blob: blob.upload_from_string(contents, content_type=content_type),
+                            content_disposition=content_disposition, owner=owner)
+
+    def upload_file(self, filename, path, content_disposition=None, content_type=None, owner=None):
+        return self._upload(filename, lambda blob: blob.upload_from_filename(path, content_type=content_type),
+                            content_disposition=content_disposition, owner=owner)
+
+    def _upload(self, filename, upload, content_disposition=None, owner=None):
         blob = self.bucket.blob(filename)
         if content_disposition:
             blob.content_disposition = content_disposition
         acl = blob.acl
-        blob.upload_from_string(contents, content_type=content_type)
-        if owner:
-            acl.user(owner).grant_read()
-            acl.save()
+        try:
+            upload(blob)
+            if owner:
+                acl.user(owner).grant_read()
+                acl.save()
+        except google.api_core.exceptions.BadRequest as e:
+            if "Unknown user" in repr(e):
+                raise UnknownUser(owner) from e
+            raise
         return self.get_url(filename)
     
     def read_file(self, filename):
@@ -34,6 +51,30 @@ class GoogleBlobStore(object):
         except UnicodeDecodeError:
             return blob.download_as_string()
 
+    def download_file(self, filename, path):
+        blob = self.bucket.get_blob(filename)
+        if not blob:
+            raise NotFound
+        blob.download_to_filename(path)
+
+    def touch(self, filename):
+        blob = self.bucket.get_blob(filename)
+        if not blob:
+            return False
+        # Patching the metadata bumps `updated`.
+        blob.metadata = dict(touched=str(time.time()))
+        blob.patch()
+        return True
+
+    def delete_file(self, filename):
+        try:
+            self.bucket.delete_blob(filename)
+        except google.cloud.exceptions.NotFound:
+            raise NotFound
+
+    def list_files(self, prefix=""):
+        return [(b.name, b.updated.timestamp()) for b in self.client.list_blobs(self.bucket_name, prefix=prefix)]
+
     def get_url(self, filename):
         return f"https://storage.cloud.google.com/{self.bucket_name}/{filename}"
 
@@ -0,0 +1,125 @@
+"""
+One of each Google Cloud client per process.
+
+Every client we make sets up its own channel and authenticates, so
+rather than making one for each Publisher, Subscriber, DataStore, and
+BlobStore (and each existence check), get them from here.  They're made
+the first time someone asks and shared by every thread after that (the
+clients are thread-safe).  A forked child makes its own, since gRPC
+channels don't survive a fork.
+
+`exists()` remembers which topics, subscriptions, and buckets we've seen,
+so we don't ask again for `EXISTS_TTL_SEC`.
+"""
+import os
+import time
+import threading
+import logging as log
+
+# How long we believe something exists after we've seen it.
+EXISTS_TTL_SEC = 600
+
+_lock = threading.RLock()
+_pid = None
+_clients = {}
+_existing = {}
+
+def _reset_after_fork():
+    global _pid
+    if _pid != os.getpid():
+        _clients.clear()
+        _existing.clear()
+        _pid = os.getpid()
+
+def get_client(key, make):
+    """
+    The client for `key`, made with `make()` the first time.
+    """
+    with _lock:
+        _reset_after_fork()
+        if key not in _clients:
+            log.debug(f"Making Google client {key}")
+            _clients[key] = make()
+        return _clients[key]
+
+def publisher():
+    from google.cloud import pubsub_v1
+    return get_client(("publisher",), pubsub_v1.PublisherClient)
+
+def subscriber():
+    from google.cloud import pubsub_v1
+    return get_client(("subscriber",), pubsub_v1.SubscriberClient)
+
+def datastore(project, namespace):
+    from google.cloud import datastore
+    return get_client(("datastore", project, namespace), lambda: datastore.Client(project=project, namespace=namespace))
+
+def storage(project):
+    from google.cloud import storage
+    return get_client(("storage", project), lambda: storage.client.Client(project))
+
+def exists(kind, name, check, now=None):
+    """
+    Does `name` (a `kind` of thing) exist?  If we haven't seen it lately,
+    `check()` says.  We don't remember that things are missing, since
+    someone could make them any time.
+    """
+    if now is None:
+        now = time.time()
+    with _lock:
+        _reset_after_fork()
+        if _existing.get((kind, name), 0) > now:
+            return True
+    if not check():
+        return False
+    remember(kind, name, now)
+    return True
+
+def remember(kind, name, now=None):
+    """
+    We know `name` exists (e.g., we just made it).
+    """
+    with _lock:
+        _reset_after_fork()
+        _existing[(kind, name)] = (now if now is not None else time.time()) + EXISTS_TTL_SEC
+
+def forget(kind, name):
+    """
+    `name` is gone (e.g., we just deleted it).
+    """
+    with _lock:
+        _existing.pop((kind, name), None)
+
+def test_get_client():
+    made = []
+    def make():
+        time.sleep(0.1)
+        made.append(1)
+        return object()
+
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(get_client(("test",), make))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(made) == 1
+    assert all(c is clients[0] for c in clients)
+    assert get_client(("test", "other"), make) is not clients[0]
+
+def test_exists():
+    checks = []
+    def check(answer):
+        checks.append(answer)
+        return answer
+
+    assert not exists("thing", "a", lambda: check(False), now=0)
+    assert exists("thing", "a", lambda: check(True), now=0)
+    assert exists("thing", "a", lambda: check(True), now=1)
+    assert len(checks) == 2 # the second time, we knew.
+
+    assert exists("thing", "a", lambda: check(False), now=EXISTS_TTL_SEC + 1) == False # we looked again.
+    remember("thing", "b", now=0)
+    assert exists("thing", "b", lambda: check(False), now=1)
+    forget("thing", "b")
+    assert not exists("thing", "b", lambda: check(False), now=1)
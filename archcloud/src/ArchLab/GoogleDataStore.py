@@ -1,11 +1,13 @@
 import os
 import logging as log
-import pytest
 from google.cloud import datastore
 import google.oauth2
+import google.api_core.exceptions
 import datetime
+import time
 import pytz
 
+from . import GoogleClients
 from .BaseDataStore import BaseDataStore, do_test_datastore
 
 class GoogleDataStore(BaseDataStore):
@@ -13,8 +15,7 @@ class GoogleDataStore(BaseDataStore):
         super(GoogleDataStore, self).__init__()
         self.namespace = namespace if namespace is not None else os.environ['GOOGLE_RESOURCE_PREFIX']
         self.project = os.environ['GOOGLE_CLOUD_PROJECT']
-        self.datastore_client = datastore.Client(project=self.project,
-                                                 namespace=self.namespace)
+        self.datastore_client = GoogleClients.datastore(self.project, self.namespace)
         self.kind = "ArchLabJob"
 
     def alloc_job(self, job_id):
@@ -30,6 +31,26 @@ class GoogleDataStore(BaseDataStore):
         log.debug(f"Putting job {job['job_id']}: {job}")
         self.datastore_client.put(job)
 
+    def update(self, job_id, **kwargs):
+        # In a transaction, so concurrent updates don't undo each other.
+        # If someone else changes the job first, ours aborts, and we try again.
+        log.debug(f"Updating {job_id} with {kwargs}")
+        kwargs = self.clip_fields(kwargs)
+        key = self.datastore_client.key(self.kind, job_id)
+        attempts = 5
+        for attempt in range(attempts):
+            try:
+                with self.datastore_client.transaction():
+                    job = self.datastore_client.get(key)
+                    job.update(**kwargs)
+                    self.datastore_client.put(job)
+                return
+            except google.api_core.exceptions.Conflict as e:
+                if attempt == attempts - 1:
+                    raise
+                log.debug(f"Update of {job_id} conflicted with another one ({e}).  Trying again.")
+                time.sleep(0.1 * 2**attempt)
+
     def get_job(self, job_id):
         # import traceback
         # for line in traceback.format_stack():
@@ -64,6 +85,15 @@ class GoogleDataStore(BaseDataStore):
         log.debug(f"found {len(r)} recently completed jobs")
         return r
 
+    def query_time_range(self, field, after=None, before=None, **kwargs):
+        query = self.datastore_client.query(kind=self.kind)
+        if after is not None:
+            query.add_filter(field, ">", after)
+        if before is not None:
+            query.add_filter(field, "<", before)
+        # Filtering on other fields too would need a composite index.
+        return [j for j in query.fetch() if all(j.get(k) == v for k, v in kwargs.items())]
+
         
 def test_google_data_store():
     do_test_datastore(GoogleDataStore)
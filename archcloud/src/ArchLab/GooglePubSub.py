@@ -1,6 +1,5 @@
 import os
 import logging as log
-import pytest
 from google.cloud import pubsub_v1
 import google.oauth2
 import google.api_core
@@ -8,7 +7,15 @@ from uuid import uuid4 as uuid
 from contextlib import contextmanager
 from collections import namedtuple
 
-from .BasePubSub import BasePublisher, BaseSubscriber, AlreadyExists, NotFound, DeadlineExceeded, do_test_publisher, do_test_subscriber
+from . import GoogleClients
+from .BasePubSub import BasePublisher, BaseSubscriber, Lease, deliver, AlreadyExists, NotFound, DeadlineExceeded, do_test_publisher, do_test_subscriber
+
+# The most ack ids we send in one request.
+ACK_BATCH_SIZE = 1000
+
+# How long a streaming pull will keep extending a message's lease.  This
+# should be longer than any job runs.
+MAX_LEASE_SEC = 4*60*60
 
 def test_subscriber():
     do_test_subscriber(GoogleSubscriber, GooglePublisher)
@@ -20,17 +27,18 @@ class GooglePublisher(BasePublisher):
 
     @classmethod
     def get_publisher(cls):
-        return pubsub_v1.PublisherClient()
+        return GoogleClients.publisher()
 
     @classmethod
     def topic_exists(cls, path):
-        publisher = cls.get_publisher()
-        try:
-            publisher.get_topic(topic=path)
-        except google.api_core.exceptions.NotFound:
-            return False
-        else:
-            return True
+        def check():
+            try:
+                cls.get_publisher().get_topic(topic=path)
+            except google.api_core.exceptions.NotFound:
+                return False
+            else:
+                return True
+        return GoogleClients.exists("topic", path, check)
     
     def __init__(self, topic, private_topic=False, **kwargs):
         super(GooglePublisher, self).__init__(topic, private_topic=private_topic, **kwargs)
@@ -45,13 +53,23 @@ class GooglePublisher(BasePublisher):
         try:
             self.publisher.create_topic(name=topic, **kwargs)
         except google.api_core.exceptions.AlreadyExists as e:
+            GoogleClients.remember("topic", topic)
             raise AlreadyExists(repr(e))
+        GoogleClients.remember("topic", topic)
         
     def do_publish(self, path, message, **kwargs):
         self.publisher.publish(path,
                                message,
                                **kwargs)
+
+    def do_publish_many(self, path, messages, **kwargs):
+        # The client batches these into as few requests as it can.
+        futures = [self.publisher.publish(path, m, **kwargs) for m in messages]
+        for f in futures:
+            f.result()
+
     def do_delete_topic(self, path):
+        GoogleClients.forget("topic", path)
         self.publisher.delete_topic(topic=path)
         
         
@@ -60,23 +78,24 @@ class GoogleSubscriber(BaseSubscriber):
 
     @classmethod
     def get_subscriber(cls):
-        return pubsub_v1.SubscriberClient()
+        return GoogleClients.subscriber()
 
     @classmethod
     def subscription_exists(cls, path):
-        subscriber = cls.get_subscriber()
-        try:
-            subscriber.get_subscription(subscription = path)
-        except google.api_core.exceptions.NotFound:
-            return False
-        else:
-            return True
+        def check():
+            try:
+                cls.get_subscriber().get_subscription(subscription = path)
+            except google.api_core.exceptions.NotFound:
+                return False
+            else:
+                return True
+        return GoogleClients.exists("subscription", path, check)
 
     def __init__(self, topic, name=None, **kwargs):
         super(GoogleSubscriber, self).__init__(topic, name=name, **kwargs)
 
     def create_subscriber(self):
-        return pubsub_v1.SubscriberClient()
+        return GoogleSubscriber.get_subscriber()
 
     def compose_subscription_path(self, project, name):
         return self.subscriber.subscription_path(project, name)
@@ -92,23 +111,29 @@ class GoogleSubscriber(BaseSubscriber):
 
     def create_subscription(self, sub_path, topic_path, **kwargs):
 
-        try:
-            GooglePublisher.get_publisher().create_topic(name=topic_path)
-        except google.api_core.exceptions.AlreadyExists:
-            pass
+        # Make sure the topic exists, unless we know it does.
+        if not GoogleClients.exists("topic", topic_path, lambda: False):
+            try:
+                GooglePublisher.get_publisher().create_topic(name=topic_path)
+            except google.api_core.exceptions.AlreadyExists:
+                pass
+            GoogleClients.remember("topic", topic_path)
 
         try:
-            return self.subscriber.create_subscription(name=sub_path, topic = topic_path, **kwargs)
+            r = self.subscriber.create_subscription(name=sub_path, topic = topic_path, **kwargs)
         except google.api_core.exceptions.AlreadyExists as e: 
+            GoogleClients.remember("subscription", sub_path)
             raise AlreadyExists(repr(e))
+        GoogleClients.remember("subscription", sub_path)
+        return r
             
 
     
-    PulledMessage = namedtuple("PulledMessage",  "data ack_id")
+    PulledMessage = namedtuple("PulledMessage",  "data ack_id delivery_attempt")
     def do_pull(self, path, max_messages=1, **kwargs):
         try:
             resp = self.subscriber.pull(subscription=path, max_messages=max_messages, **kwargs)
-            t = [GoogleSubscriber.PulledMessage(r.message.data, r.ack_id) for r in resp.received_messages]
+            t = [GoogleSubscriber.PulledMessage(r.message.data, r.ack_id, r.delivery_attempt) for r in resp.received_messages]
             return t
         except google.api_core.exceptions.DeadlineExceeded:
             raise DeadlineExceeded
@@ -119,5 +144,69 @@ class GoogleSubscriber(BaseSubscriber):
         except:
             pass
 
+    def do_acknowledge_many(self, path, msgs):
+        ack_ids = [m.ack_id for m in msgs]
+        for i in range(0, len(ack_ids), ACK_BATCH_SIZE):
+            try:
+                self.subscriber.acknowledge(subscription=path, ack_ids=ack_ids[i:i+ACK_BATCH_SIZE])
+            except:
+                pass
+
+    def do_modify_ack_deadline(self, path, msg, seconds):
+        self.subscriber.modify_ack_deadline(subscription=path, ack_ids=[msg.ack_id], ack_deadline_seconds=seconds)
+
     def do_delete_subscription(self, path):
+        GoogleClients.forget("subscription", path)
         self.subscriber.delete_subscription(subscription=path)
+
+    def subscribe(self, callback, max_outstanding=1, lease_sec=None):
+        """
+        Like `BaseSubscriber.subscribe()`, but with a streaming pull, so
+        messages arrive as soon as they're published, and we don't spend
+        a request on each empty pull.  The client library extends the
+        leases (so `lease_sec` doesn't matter), and flow control keeps it
+        from leasing more than `max_outstanding` messages at once.
+        """
+        import concurrent.futures
+        from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+        future = self.subscriber.subscribe(self.subscription_path,
+                                           lambda message: deliver(callback, StreamedLease(self, message)),
+                                           flow_control=pubsub_v1.types.FlowControl(max_messages=max_outstanding,
+                                                                                    max_lease_duration=MAX_LEASE_SEC),
+                                           scheduler=ThreadScheduler(concurrent.futures.ThreadPoolExecutor(max_workers=max_outstanding,
+                                                                                                          thread_name_prefix="subscriber")),
+                                           await_callbacks_on_shutdown=True)
+        return GoogleStreamingPull(future)
+
+class StreamedLease(Lease):
+    """
+    A message from a streaming pull.  The client library is already
+    extending its lease, and acks and nacks go back through the stream.
+    """
+    def __init__(self, subscriber, message):
+        super(StreamedLease, self).__init__(subscriber, message)
+        self.kept_alive = True
+
+    def acknowledge(self):
+        if not self.acknowledged:
+            self.message.ack()
+            self.acknowledged = True
+
+    def extend(self, seconds):
+        self.message.modify_ack_deadline(seconds)
+
+    def nack(self):
+        self.message.nack()
+
+class GoogleStreamingPull(object):
+    def __init__(self, future):
+        self.future = future
+
+    def cancel(self):
+        self.future.cancel()
+
+    def join(self, timeout=None):
+        try:
+            self.future.result(timeout)
+        except Exception as e:
+            log.debug(f"Streaming pull ended with {e!r}")
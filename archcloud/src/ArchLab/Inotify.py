@@ -0,0 +1,116 @@
+"""
+Wait for files to show up in a directory without polling it.
+
+`DirectoryWatcher` uses Linux's inotify (through ctypes, so there's
+nothing to install) to sleep until something is written or renamed
+into the directory.  Where there's no inotify, it falls back to polling
+every `poll_interval` seconds.
+"""
+import os
+import time
+import select
+import ctypes
+import ctypes.util
+import logging as log
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+_libc = None
+
+def _inotify():
+    """
+    libc, if it has inotify, or None.
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+class DirectoryWatcher(object):
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd = None
+
+        libc = _inotify()
+        if libc:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        if self.fd is None:
+            log.debug(f"Can't use inotify on {path}.  Polling it instead.")
+
+    @property
+    def polling(self):
+        return self.fd is None
+
+    def wait(self, timeout):
+        """
+        Sleep until something lands in the directory, or `timeout` seconds
+        pass.  It may return early, so check the directory when it does.
+        """
+        if timeout <= 0:
+            return
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            self._drain()
+
+    def _drain(self):
+        # We don't care what the events were, just that there were some.
+        try:
+            while os.read(self.fd, 64*1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+def test_directory_watcher():
+    import tempfile
+    import threading
+
+    with tempfile.TemporaryDirectory() as d:
+        for poll in [False, True]:
+            w = DirectoryWatcher(d)
+            if poll:
+                w.close()
+            else:
+                assert not w.polling
+
+            start = time.time()
+            w.wait(0.3)
+            assert time.time() - start >= (0.1 if poll else 0.3)
+
+            def write():
+                time.sleep(0.2)
+                with open(os.path.join(d, ".tmp"), "w") as f:
+                    f.write("hello")
+                os.rename(os.path.join(d, ".tmp"), os.path.join(d, f"file-{poll}"))
+
+            t = threading.Thread(target=write)
+            start = time.time()
+            t.start()
+            while f"file-{poll}" not in os.listdir(d):
+                w.wait(10)
+            assert time.time() - start < 2
+            t.join()
+            w.close()
@@ -1,6 +1,6 @@
 import os
+import shutil
 from .BaseBlobStore import NotFound, BaseBlobStore, do_test_blob_store
-import pytest
 from pathlib import Path
 
 class LocalBlobStore(BaseBlobStore):
@@ -11,21 +11,66 @@ class LocalBlobStore(BaseBlobStore):
                                       bucket)
         os.makedirs(self.directory, exist_ok=True)
 
+    def _path(self, filename):
+        path = os.path.join(self.directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    
     def write_file(self, filename, contents, content_disposition=None, content_type=None, owner=None):
         try:
-            with open(os.path.join(self.directory, filename), "w") as f:
+            with open(self._path(filename), "w") as f:
                 f.write(contents)
         except TypeError:
-            with open(os.path.join(self.directory, filename), "wb") as f:
+            with open(self._path(filename), "wb") as f:
                 f.write(contents)
         return self.get_url(filename)
     
     def read_file(self, filename):
         try:
-            with open(os.path.join(self.directory, filename)) as f:
-                return f.read()
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                contents = f.read()
+        except FileNotFoundError:
+            raise NotFound
+        try:
+            return contents.decode("utf8")
+        except UnicodeDecodeError:
+            return contents
+
+    def upload_file(self, filename, path, content_disposition=None, content_type=None, owner=None):
+        # Copy, then rename, so readers never see a partial file.
+        tmp = self._path(f"{filename}.tmp-{os.getpid()}")
+        shutil.copyfile(path, tmp)
+        os.rename(tmp, self._path(filename))
+        return self.get_url(filename)
+
+    def download_file(self, filename, path):
+        try:
+            shutil.copyfile(os.path.join(self.directory, filename), path)
         except FileNotFoundError:
             raise NotFound
+    def touch(self, filename):
+        try:
+            os.utime(os.path.join(self.directory, filename))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete_file(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            raise NotFound
+
+    def list_files(self, prefix=""):
+        r = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                name = os.path.relpath(path, self.directory)
+                if name.startswith(prefix):
+                    r.append((name, os.path.getmtime(path)))
+        return r
+
     def get_url(self, filename):
         return f"file://{os.path.abspath(os.path.join(self.directory, filename))}"
 
@@ -36,5 +81,6 @@ class LocalBlobStore(BaseBlobStore):
     
 def test_local_blob_store():
     if "EMULATION_DIR" not in os.environ:
+        import pytest
         pytest.skip()
     do_test_blob_store(LocalBlobStore)
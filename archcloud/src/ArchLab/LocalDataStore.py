@@ -1,38 +1,155 @@
 import os
+import fcntl
 import logging as log
-from pathlib import Path
 import pickle
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import quote
 from .BaseDataStore import BaseDataStore, do_test_datastore
 import datetime
 import pytz
 
+# Fields we keep indexes on, so queries on them only read the jobs that
+# match.  Queries on the first kind match values exactly, and ones on
+# the second take a time range.
+EQUALITY_INDEXES = ["status", "username"]
+TIME_INDEXES = ["submitted_utc", "completed_utc"]
+
+# The time indexes are grouped into buckets this long, so a range query
+# only lists the buckets it overlaps.
+TIME_BUCKET_SEC = 60*60
+
 class LocalDataStore(BaseDataStore):
+    """
+    Each job is a pickle in `directory`.  The indexes live in
+    `index_root`: `<field>/<value>/<job_id>` for EQUALITY_INDEXES and
+    `<field>/<bucket>/<timestamp>_<job_id>` for TIME_INDEXES, all empty
+    files.  An index can name jobs that don't match (e.g., if two
+    processes update a job at once), so we check each job we read.
+    """
     def __init__(self, namespace=None):
         super(LocalDataStore, self).__init__()
-        self.directory = os.path.join(os.environ["EMULATION_DIR"],
-                                      os.environ['GOOGLE_CLOUD_PROJECT'],
-                                      "datastore",
-                                      namespace if namespace is not None else os.environ["GOOGLE_RESOURCE_PREFIX"])
+        namespace = namespace if namespace is not None else os.environ["GOOGLE_RESOURCE_PREFIX"]
+        root = os.path.join(os.environ["EMULATION_DIR"], os.environ['GOOGLE_CLOUD_PROJECT'])
+        self.directory = os.path.join(root, "datastore", namespace)
+        self.index_root = os.path.join(root, "datastore_index", namespace)
+        # Jobs get written here and then renamed into `directory`, so no
+        # one ever reads half of one.
+        self.tmp_directory = os.path.join(root, "datastore_tmp", namespace)
+        self.lock_directory = os.path.join(root, "datastore_locks", namespace)
         os.makedirs(self.directory, exist_ok=True)
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        os.makedirs(self.lock_directory, exist_ok=True)
+        if not os.path.exists(os.path.join(self.index_root, ".built")):
+            self.build_index()
 
-    def query(self, **kwargs):
-        log.debug(f"querying with {kwargs}")
+    def build_index(self):
+        """
+        Index the jobs that were stored before there was an index.
+        """
+        log.debug(f"Building the datastore index in {self.index_root}")
+        for job_id in os.listdir(self.directory):
+            job = self.get_job(job_id)
+            if job:
+                self._update_index(None, job)
+        os.makedirs(self.index_root, exist_ok=True)
+        open(os.path.join(self.index_root, ".built"), "w").close()
+
+    def _value_key(self, value):
+        # Different values can share a key (e.g., "" and "_"), which is
+        # fine, since we check the jobs we read.
+        return quote(str(value), safe="@")[:200] or "_"
+
+    def _index_entries(self, job):
+        r = []
+        for field in EQUALITY_INDEXES:
+            if field in job:
+                r.append(os.path.join(field, self._value_key(job[field]), job['job_id']))
+        for field in TIME_INDEXES:
+            t = job.get(field)
+            if isinstance(t, datetime.datetime):
+                ts = t.timestamp()
+                r.append(os.path.join(field, str(int(ts // TIME_BUCKET_SEC)), f"{ts:.6f}_{job['job_id']}"))
+        return r
+
+    def _update_index(self, old_job, job):
+        new = self._index_entries(job)
+        old = self._index_entries(old_job) if old_job else []
+        # Add the new entries before removing the old ones, so the job
+        # is always findable.
+        for e in new:
+            if e not in old:
+                path = os.path.join(self.index_root, e)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "w").close()
+        for e in old:
+            if e not in new:
+                try:
+                    os.remove(os.path.join(self.index_root, e))
+                except FileNotFoundError:
+                    pass
+
+    def _ids_equal(self, field, value):
+        try:
+            return set(os.listdir(os.path.join(self.index_root, field, self._value_key(value))))
+        except FileNotFoundError:
+            return set()
+
+    def _ids_in_range(self, field, after=None, before=None):
+        root = os.path.join(self.index_root, field)
+        after = after.timestamp() if after is not None else None
+        before = before.timestamp() if before is not None else None
+        r = set()
+        try:
+            buckets = os.listdir(root)
+        except FileNotFoundError:
+            return r
+        for bucket in buckets:
+            if after is not None and int(bucket) < after // TIME_BUCKET_SEC:
+                continue
+            if before is not None and int(bucket) > before // TIME_BUCKET_SEC:
+                continue
+            for entry in os.listdir(os.path.join(root, bucket)):
+                ts, _, job_id = entry.partition("_")
+                if (after is None or float(ts) >= after) and (before is None or float(ts) <= before):
+                    r.add(job_id)
+        return r
+
+    def _read(self, job_ids, **kwargs):
         r = []
-        for p in Path(self.directory).iterdir():
-            log.debug(f"examining {p}")
-            with open(p, 'rb') as f:
-                job = pickle.load(f)
-                log.debug(f"read {job}")
-                if len(kwargs) == 0 or all(map(lambda kv: job[kv[0]] == kv[1], kwargs.items())):
-                    log.debug("It matched!")
-                    r.append(job)
-                else:
-                    log.debug("It didn't match")
+        for job_id in sorted(job_ids):
+            job = self.get_job(job_id)
+            if job is not None and all(job.get(k) == v for k, v in kwargs.items()):
+                r.append(job)
         return r
 
+    def query(self, limit=None, **kwargs):
+        log.debug(f"querying with {kwargs}")
+        if 'job_id' in kwargs:
+            job_ids = {kwargs['job_id']}
+        elif any(k in EQUALITY_INDEXES for k in kwargs):
+            job_ids = set.intersection(*[self._ids_equal(k, v) for k, v in kwargs.items() if k in EQUALITY_INDEXES])
+        else:
+            job_ids = os.listdir(self.directory)
+        r = self._read(job_ids, **kwargs)
+        return r[:limit] if limit is not None else r
+
+    def query_time_range(self, field, after=None, before=None, **kwargs):
+        """
+        Jobs whose `field` (one of TIME_INDEXES) is between `after` and
+        `before` (datetimes, either of which can be None), and that match
+        `kwargs`.
+        """
+        job_ids = self._ids_in_range(field, after, before)
+        for k, v in kwargs.items():
+            if k in EQUALITY_INDEXES:
+                job_ids &= self._ids_equal(k, v)
+        return [j for j in self._read(job_ids, **kwargs)
+                if (after is None or j[field] > after) and (before is None or j[field] < before)]
+
     def alloc_job(self, job_id):
         return dict(job_id=job_id)
-    
+
     def get_job(self, job_id):
         path = os.path.join(self.directory, str(job_id))
         try:
@@ -41,19 +158,57 @@ class LocalDataStore(BaseDataStore):
         except:
             return None
 
+    @contextmanager
+    def locked(self, job_id):
+        with open(os.path.join(self.lock_directory, str(job_id)), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
     def put_job(self, job):
         path = os.path.join(self.directory, job['job_id'])
-        with open(path, "wb") as f:
+        old_job = self.get_job(job['job_id'])
+        with tempfile.NamedTemporaryFile(dir=self.tmp_directory, delete=False) as f:
             pickle.dump(job, f)
+        os.rename(f.name, path)
+        self._update_index(old_job, job)
 
     def get_recently_completed_jobs(self, seconds_ago):
-        r = []
-        for obj in os.listdir(self.directory):
-            with open(os.path.join(self.directory, obj), "rb") as f:
-                o = pickle.load(f)
-            if o['submitted_utc'] > datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds = seconds_ago) and o['status'] == "COMPLETED":
-                r.append(o)
-        return r
+        return self.query_time_range("submitted_utc",
+                                     after=datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds = seconds_ago),
+                                     status="COMPLETED")
 
 def test_local_data_store():
     do_test_datastore(LocalDataStore)
+
+def test_indexes():
+    import shutil
+    from uuid import uuid4 as uuid
+    namespace = f"index-test-{uuid()}"
+    ds = LocalDataStore(namespace=namespace)
+    now = datetime.datetime.now(pytz.utc)
+    for i in range(6):
+        ds.push(job_id=f"job-{i}", output="", status="SUBMITTED", username=f"user{i % 2}@x")
+    for i in range(3):
+        ds.update(f"job-{i}", status="COMPLETED", completed_utc=now - datetime.timedelta(hours=i))
+
+    assert [j['job_id'] for j in ds.query(status="SUBMITTED")] == ["job-3", "job-4", "job-5"]
+    assert [j['job_id'] for j in ds.query(status="COMPLETED", username="user0@x")] == ["job-0", "job-2"]
+    assert ds.query(status="COMPLETED", username="nobody") == []
+    assert len(ds.query(limit=2)) == 2
+    assert [j['job_id'] for j in ds.get_recently_completed_jobs(60)] == ["job-0", "job-1", "job-2"]
+    assert [j['job_id'] for j in ds.query_time_range("completed_utc", after=now - datetime.timedelta(minutes=90))] == ["job-0", "job-1"]
+
+    # Queries on indexed fields only read the jobs in the index.
+    os.remove(os.path.join(ds.index_root, "status", "COMPLETED", "job-1"))
+    assert [j['job_id'] for j in ds.query(status="COMPLETED")] == ["job-0", "job-2"]
+
+    # We can index a datastore that predates the index.
+    shutil.rmtree(ds.index_root)
+    ds = LocalDataStore(namespace=namespace)
+    assert [j['job_id'] for j in ds.query(status="COMPLETED")] == ["job-0", "job-1", "job-2"]
+
+    shutil.rmtree(ds.index_root)
+    shutil.rmtree(ds.directory)
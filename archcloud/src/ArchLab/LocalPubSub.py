@@ -1,21 +1,105 @@
 import os
 import logging as log
 from pathlib import Path
-import pytest
 import tempfile
 import time
 from uuid import uuid4 as uuid
 from collections import namedtuple
 import shutil
+import json
+import re
 
+from .Inotify import DirectoryWatcher
 from .BasePubSub import BasePublisher, BaseSubscriber, AlreadyExists, NotFound, DeadlineExceeded, do_test_publisher, do_test_subscriber
 
+# How long a subscriber has to acknowledge a message before we deliver it again.
+ACK_DEADLINE_SEC = 60
+
+# Messages are named by uuid, plus how many times they've been delivered.
+MESSAGE_NAME = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(\.[0-9]+)?")
+
 def test_subscriber():
     do_test_subscriber(LocalSubscriber, LocalPublisher)
 
 def test_publisher():
     do_test_publisher(LocalPublisher)
 
+def test_pull_wakes_up():
+    import threading
+    with LocalPublisher(f"wake-test-topic-{uuid()}", private_topic=True) as topic:
+        with LocalSubscriber(topic=topic.topic) as s:
+            start = time.time()
+            assert s.pull(timeout=0.5) == []
+            assert time.time() - start >= 0.5
+
+            t = threading.Timer(0.2, lambda: topic.publish("hello"))
+            start = time.time()
+            t.start()
+            assert s.pull(timeout=10) == ["hello"]
+            assert time.time() - start < 2
+            t.join()
+
+            for i in range(5):
+                topic.publish(str(i))
+            batch = s.pull(max_messages=3, timeout=0)
+            assert len(batch) == 3
+            rest = s.pull(max_messages=3, deadline=time.time() + 1)
+            assert sorted(batch + rest) == [str(i) for i in range(5)]
+
+def test_topic_index():
+    with LocalPublisher(f"index-test-topic-{uuid()}", private_topic=True) as topic:
+        s1 = LocalSubscriber(topic=topic.topic)
+        s2 = LocalSubscriber(topic=topic.topic)
+        index = os.path.join(LocalPubSubAgent.get_index_root(), topic.topic_path)
+        assert sorted(os.listdir(index)) == sorted([s1.subscription_path, s2.subscription_path])
+
+        s2.delete_subscription()
+        assert os.listdir(index) == [s1.subscription_path]
+        topic.publish("hello")
+        assert s1.pull(timeout=1) == ["hello"]
+
+        # Subscriptions that vanish without telling us drop out of the index.
+        shutil.rmtree(os.path.join(s1.subscriptions_root, s1.subscription_path))
+        topic.publish("hello")
+        assert os.listdir(index) == []
+
+        # We index subscriptions that predate the index.
+        s3 = LocalSubscriber(topic=topic.topic)
+        os.remove(os.path.join(index, s3.subscription_path))
+        os.remove(os.path.join(LocalPubSubAgent.get_index_root(), ".built"))
+        LocalPubSubAgent()
+        assert os.listdir(index) == [s3.subscription_path]
+        s3.delete_subscription()
+
+def test_leases():
+    import pytest
+    with LocalPublisher(f"lease-test-topic-{uuid()}", private_topic=True) as topic:
+        with LocalSubscriber(topic=topic.topic, ack_deadline_seconds=1, max_delivery_attempts=2) as s:
+            topic.publish("job")
+            lease, = s.pull_leased(timeout=1)
+            assert lease.data == "job" and not lease.redelivered
+
+            # Extending the lease keeps it ours.
+            with lease.kept(1):
+                time.sleep(1.5)
+                assert s.pull_leased(timeout=0) == []
+
+            # Until it runs out, and someone else gets it.
+            again, = s.pull_leased(timeout=3)
+            assert again.data == "job" and again.redelivered
+            with pytest.raises(NotFound):
+                lease.extend(10)
+
+            # We give up on it after two tries.
+            assert s.pull_leased(timeout=1.5) == []
+            assert s.dead_letters() == ["job"]
+
+            topic.publish("done")
+            lease, = s.pull_leased(timeout=1)
+            lease.acknowledge()
+            assert s.pull_leased(timeout=1.5) == []
+            assert s.dead_letters() == ["job"]
+
 class LocalPubSubAgent(object):
 
     def __init__(self, *argc, **kwargs):
@@ -24,6 +108,40 @@ class LocalPubSubAgent(object):
         os.makedirs(self.topics_root, exist_ok=True)
         self.subscriptions_root = LocalPubSubAgent.get_subscriptions_root()
         os.makedirs(self.subscriptions_root, exist_ok=True)
+        self.index_root = LocalPubSubAgent.get_index_root()
+        if not os.path.exists(os.path.join(self.index_root, ".built")):
+            self.build_index()
+
+    @classmethod
+    def get_index_root(cls):
+        # topic_index/<topic>/<subscription> exists for each subscription,
+        # so publishing doesn't have to look at every subscription.
+        return os.path.join(os.environ['EMULATION_DIR'], os.environ['GOOGLE_CLOUD_PROJECT'], "pubsub", "topic_index")
+
+    def index_subscription(self, topic_path, sub_path):
+        d = os.path.join(self.index_root, topic_path)
+        os.makedirs(d, exist_ok=True)
+        open(os.path.join(d, sub_path), "w").close()
+
+    def unindex_subscription(self, topic_path, sub_path):
+        try:
+            os.remove(os.path.join(self.index_root, topic_path, sub_path))
+        except FileNotFoundError:
+            pass
+
+    def build_index(self):
+        """
+        Index the subscriptions that were created before there was an index.
+        """
+        log.debug("Building the topic index")
+        os.makedirs(self.index_root, exist_ok=True)
+        for sub_path in os.listdir(self.subscriptions_root):
+            try:
+                with open(os.path.join(self.subscriptions_root, sub_path, "topic")) as f:
+                    self.index_subscription(f.read(), sub_path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass # It's being created (it'll index itself) or deleted.
+        open(os.path.join(self.index_root, ".built"), "w").close()
 
     @classmethod
     def get_topics_root(cls):
@@ -62,27 +180,42 @@ class LocalPublisher(LocalPubSubAgent, BasePublisher):
             raise AlreadyExists()
         
     def do_publish(self, path, message, **kwargs):
-        fn = str(uuid())
-        log.debug(f"Publishing to topic {self.topic_path}")
-        for subscription in os.listdir(self.subscriptions_root):
-            subscription = os.path.join(self.subscriptions_root, subscription)
-            if os.path.isdir(subscription):
-                with open(os.path.join(subscription, "topic")) as out:
-                    topic = out.read()
-                    #log.debug(f"It is for topic '{repr(topic)}'")
-                    if topic== self.topic_path:
-                        #log.debug(f"It is a match.  Writing to {fn}")
-                        log.debug(f"Found matching subscription {subscription}")
-                        with open(os.path.join(subscription, fn), "wb") as out:
-                            out.write(message)
-                    else:
-                        pass
-                        #log.debug(f"It is not a match for '{repr(self.topic_path)}'")
+        self.do_publish_many(path, [message], **kwargs)
+
+    def do_publish_many(self, path, messages, **kwargs):
+        # Write each message to a hidden file and rename it into place, so
+        # subscribers never see half of one.
+        log.debug(f"Publishing {len(messages)} messages to topic {path}")
+        try:
+            subscriptions = os.listdir(os.path.join(self.index_root, path))
+        except FileNotFoundError:
+            subscriptions = [] # No one has ever subscribed.
+        names = [str(uuid()) for m in messages]
+        for sub_path in subscriptions:
+            subscription = os.path.join(self.subscriptions_root, sub_path)
+            log.debug(f"Found matching subscription {subscription}")
+            try:
+                for fn, message in zip(names, messages):
+                    with open(os.path.join(subscription, f".{fn}"), "wb") as out:
+                        out.write(message)
+                    os.rename(os.path.join(subscription, f".{fn}"),
+                              os.path.join(subscription, fn))
+            except FileNotFoundError:
+                log.debug(f"Subscription {subscription} is gone")
+                self.unindex_subscription(path, sub_path)
                                         
     def do_delete_topic(self, path):
         shutil.rmtree(os.path.join(self.topics_root, path))
         
 class LocalSubscriber(LocalPubSubAgent, BaseSubscriber):
+    """
+    Each subscription is a directory with a file for each message.
+    Pulling a message moves it into `leases/`, and the file's mtime is
+    when the lease runs out.  Acknowledging it deletes it.  If the lease
+    runs out first, the next pull moves it back to be delivered again or,
+    once it's been delivered `max_delivery_attempts` times, to
+    `dead_letter/`.
+    """
     def __init__(self, topic, name=None, **kwargs):
         LocalPubSubAgent.__init__(self)
         BaseSubscriber.__init__(self, topic=topic, name=name, **kwargs)
@@ -94,48 +227,159 @@ class LocalSubscriber(LocalPubSubAgent, BaseSubscriber):
     def create_subscriber(self):
         return None
 
-    def create_subscription(self, sub_path, topic_path, **kwargs):
+    def create_subscription(self, sub_path, topic_path, ack_deadline_seconds=None, max_delivery_attempts=None, **kwargs):
         p = os.path.join(self.subscriptions_root, sub_path)
         log.debug(f"looking for {p}")
         if not os.path.isdir(p):
             os.mkdir(p)
             log.debug(f"Creating subscription {sub_path}")
+            config = dict(ack_deadline_seconds=ack_deadline_seconds or ACK_DEADLINE_SEC,
+                          max_delivery_attempts=max_delivery_attempts or int(os.environ.get("PUBSUB_MAX_DELIVERY_ATTEMPTS", 5)))
+            with open(os.path.join(p, "config.json"), "w") as f:
+                json.dump(config, f)
             with open(os.path.join(p, "topic"), "w") as f:
                 f.write(topic_path)
+            self.index_subscription(topic_path, sub_path)
         else:
             raise AlreadyExists
     
-    PulledMessage = namedtuple("PulledMessage",  "data ack_id")
-    def do_pull(self, path, max_messages=1, timeout=1, **kwargs):
-        sub = os.path.join(self.subscriptions_root, path)
-        items = list(filter(lambda x: x != "topic", os.listdir(sub)))
-        log.debug(f"Directory contents for {path} {list(items)} ")
-        c = 0
+    PulledMessage = namedtuple("PulledMessage",  "data ack_id delivery_attempt")
+
+    def _watcher(self, sub):
+        if not hasattr(self, "watchers"):
+            self.watchers = {}
+        if sub not in self.watchers:
+            self.watchers[sub] = DirectoryWatcher(sub)
+        return self.watchers[sub]
+
+    def _config(self, sub):
+        if not hasattr(self, "configs"):
+            self.configs = {}
+        if sub not in self.configs:
+            config = dict(ack_deadline_seconds=ACK_DEADLINE_SEC, max_delivery_attempts=int(os.environ.get("PUBSUB_MAX_DELIVERY_ATTEMPTS", 5)))
+            try:
+                with open(os.path.join(sub, "config.json")) as f:
+                    config.update(json.load(f))
+            except FileNotFoundError:
+                pass # it predates leases.
+            os.makedirs(os.path.join(sub, "leases"), exist_ok=True)
+            os.makedirs(os.path.join(sub, "dead_letter"), exist_ok=True)
+            self.configs[sub] = config
+        return self.configs[sub]
+
+    def _expire(self, sub):
+        """
+        Redeliver (or give up on) messages whose leases have run out.
+        Returns when the next lease runs out, or None.
+        """
+        config = self._config(sub)
+        now = time.time()
+        next_expiry = None
+        for lease in os.listdir(os.path.join(sub, "leases")):
+            path = os.path.join(sub, "leases", lease)
+            try:
+                expires = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue # acknowledged.
+            if expires > now:
+                next_expiry = min(next_expiry or expires, expires)
+                continue
+            message_id, deliveries = lease.split(".")
+            try:
+                if int(deliveries) >= config['max_delivery_attempts']:
+                    log.warning(f"Giving up on message {message_id} in {sub} after {deliveries} deliveries")
+                    os.rename(path, os.path.join(sub, "dead_letter", lease))
+                else:
+                    log.debug(f"Lease on {message_id} ran out.  Redelivering it.")
+                    os.rename(path, os.path.join(sub, lease))
+            except FileNotFoundError:
+                pass # someone else got to it.
+        return next_expiry
+
+    def _grab(self, sub, max_messages):
+        config = self._config(sub)
+        # Skip everything but messages: the topic, the config, messages
+        # that are still being written (.*), etc.
+        items = [x for x in os.listdir(sub) if MESSAGE_NAME.fullmatch(x)]
+        log.debug(f"Directory contents for {sub} {list(items)} ")
         r = []
         for i in items:
-            t = f"tmp_{uuid()}"
+            message_id, _, deliveries = i.partition(".")
+            lease = f"{message_id}.{int(deliveries or 0) + 1}"
             try:
-                log.debug(f"Grabbing {i} moving to {t}")
+                log.debug(f"Grabbing {i} and leasing it as {lease}")
+                # Set the deadline first, so no one thinks the lease has expired.
+                expires = time.time() + config['ack_deadline_seconds']
+                os.utime(os.path.join(sub, i), (expires, expires))
                 os.rename(os.path.join(sub, i),
-                          os.path.join(sub, t)) # atomically remove it
-                assert not os.path.exists(os.path.join(sub, i))
-            except:
+                          os.path.join(sub, "leases", lease)) # atomically take it
+            except FileNotFoundError:
                 log.debug(f"Missed!")
                 continue # someone else might have got to it first.
-            log.debug(f"Got it! reading {t}")
-            with open(os.path.join(sub, t), "rb") as f:
-                r.append(LocalSubscriber.PulledMessage(f.read(), None))
-            log.debug(f"Removing {t}")
-            os.remove(os.path.join(sub, t))
-            c += 1
-            if c == max_messages:
+            with open(os.path.join(sub, "leases", lease), "rb") as f:
+                r.append(LocalSubscriber.PulledMessage(f.read(), lease, int(deliveries or 0) + 1))
+            if len(r) == max_messages:
                 break
-        if len(r) == 0:
-            time.sleep(timeout)
         return r
 
+    def do_pull(self, path, max_messages=1, timeout=1, **kwargs):
+        """
+        Wait up to `timeout` seconds for messages, and return (up to
+        `max_messages` of) them as soon as there are any.
+        """
+        sub = os.path.join(self.subscriptions_root, path)
+        # Watch before we look, so we can't miss a message that arrives in between.
+        watcher = self._watcher(sub)
+        deadline = time.time() + timeout
+        while True:
+            next_expiry = self._expire(sub)
+            r = self._grab(sub, max_messages)
+            remaining = deadline - time.time()
+            if r or remaining <= 0:
+                return r
+            if next_expiry is not None:
+                remaining = min(remaining, max(0.01, next_expiry - time.time()))
+            watcher.wait(remaining)
+
     def do_acknowledge(self, path, msg):
-        pass
+        try:
+            os.remove(os.path.join(self.subscriptions_root, path, "leases", msg.ack_id))
+        except FileNotFoundError:
+            log.warning(f"Lease on {msg.ack_id} ran out before we acknowledged it")
+
+    def do_modify_ack_deadline(self, path, msg, seconds):
+        expires = time.time() + seconds
+        try:
+            if seconds <= 0:
+                # Put it straight back, so a waiting pull wakes up for it.
+                sub = os.path.join(self.subscriptions_root, path)
+                _, deliveries = msg.ack_id.split(".")
+                given_up = int(deliveries) >= self._config(sub)['max_delivery_attempts']
+                os.rename(os.path.join(sub, "leases", msg.ack_id),
+                          os.path.join(sub, "dead_letter" if given_up else "", msg.ack_id))
+                return
+            os.utime(os.path.join(self.subscriptions_root, path, "leases", msg.ack_id), (expires, expires))
+        except FileNotFoundError:
+            raise NotFound(f"Lease on {msg.ack_id} ran out")
+
+    def dead_letters(self):
+        """
+        The messages we gave up on.
+        """
+        d = os.path.join(self.subscriptions_root, self.subscription_path, "dead_letter")
+        r = []
+        for m in os.listdir(d) if os.path.isdir(d) else []:
+            with open(os.path.join(d, m), "rb") as f:
+                r.append(f.read().decode("utf8"))
+        return r
 
     def do_delete_subscription(self, path):
-        shutil.rmtree(os.path.join(self.subscriptions_root, path))
+        sub = os.path.join(self.subscriptions_root, path)
+        watcher = getattr(self, "watchers", {}).pop(sub, None)
+        watcher and watcher.close()
+        try:
+            with open(os.path.join(sub, "topic")) as f:
+                self.unindex_subscription(f.read(), path)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(sub)
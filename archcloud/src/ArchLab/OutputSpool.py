@@ -0,0 +1,147 @@
+import os
+import threading
+import collections
+import tempfile
+import logging as log
+
+class OutputSpool(object):
+    """
+    Disk-backed capture of a job's output.
+
+    Output goes straight to a file instead of sitting in memory.  The
+    file keeps the first `max_bytes` bytes.  After that, we only keep the
+    last `tail_bytes` bytes (in a ring buffer), and they get appended,
+    after a note about what we dropped, when the spool is closed.  So a
+    program that prints in a hot loop costs us at most `max_bytes +
+    tail_bytes` of disk and `tail_bytes` of memory.
+
+    `view()` returns a smaller head-and-tail version, suitable for
+    putting in a SubmissionResult.
+    """
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, path, max_bytes=None, tail_bytes=1024*1024):
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("RUNLAB_SPOOL_MAX_MB", 512)) * 1024 * 1024
+        self.path = path
+        self.max_bytes = max_bytes
+        self.tail_bytes = tail_bytes
+        self.file = open(path, "wb")
+        self.written = 0 # bytes in the file
+        self.total = 0 # bytes we've been given
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        with self.lock:
+            if self.closed:
+                return
+            self.total += len(data)
+            room = max(0, self.max_bytes - self.written)
+            if room:
+                self.file.write(data[:room])
+                self.written += min(room, len(data))
+                data = data[room:]
+            if data:
+                self.tail.append(data)
+                self.tail_size += len(data)
+                while self.tail_size - len(self.tail[0]) >= self.tail_bytes:
+                    self.tail_size -= len(self.tail.popleft())
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def pump(self, stream):
+        """
+        Copy `stream` (a binary file, e.g., a pipe) into the spool until EOF.
+        """
+        try:
+            while True:
+                data = stream.read1(self.CHUNK_SIZE) if hasattr(stream, "read1") else stream.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+        except (OSError, ValueError) as e: # the stream got closed out from under us.
+            log.debug(f"Stopped spooling to {self.path}: {e}")
+
+    def start_pump(self, stream):
+        t = threading.Thread(target=self.pump, args=(stream,), daemon=True)
+        t.start()
+        return t
+
+    def finish_pump(self, thread, timeout=10):
+        # If the program left children behind that still have the pipe
+        # open, we'll never see EOF, so don't wait forever.
+        thread.join(timeout)
+        if thread.is_alive():
+            log.warning(f"Something is still writing to {self.path}.  Ignoring it.")
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.tail_size:
+                tail = b"".join(self.tail)[-self.tail_bytes:]
+                dropped = self.total - self.written - len(tail)
+                if dropped:
+                    self.file.write(f"\n\n[... {dropped} bytes of output omitted ...]\n\n".encode("utf8"))
+                self.file.write(tail)
+                self.tail.clear()
+                self.tail_size = 0
+            self.file.close()
+            self.closed = True
+
+    def view(self, limit=4*1024*1024):
+        """
+        Close the spool, and return (as a string) up to `limit` bytes of
+        it: all of it, if it fits, or its beginning and end.
+        """
+        self.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "rb") as f:
+            if size <= limit:
+                data = f.read()
+            else:
+                head = f.read(limit//2)
+                f.seek(size - limit//2)
+                tail = f.read()
+                data = head + f"\n\n[... {size - len(head) - len(tail)} bytes omitted.  The full output is in the zip archive ...]\n\n".encode("utf8") + tail
+        return data.decode("utf8", errors="replace")
+
+def test_output_spool():
+    with tempfile.TemporaryDirectory() as d:
+        s = OutputSpool(os.path.join(d, "small"))
+        s.write("hello ")
+        s.write(b"world")
+        assert s.view() == "hello world"
+        s.write("ignored after close")
+        assert s.view() == "hello world"
+
+        s = OutputSpool(os.path.join(d, "big"), max_bytes=100, tail_bytes=10)
+        for i in range(1000):
+            s.write(f"{i:04d}")
+        s.close()
+        with open(s.path, "rb") as f:
+            full = f.read()
+        assert full.startswith(b"0000000100020003")
+        assert full.endswith(b"09980999")
+        assert b"3890 bytes of output omitted" in full
+        assert len(full) < 200
+
+        v = s.view(limit=40)
+        assert v.startswith("00000001000200030004")
+        assert v.endswith("0999")
+        assert "omitted" in v
+
+        import subprocess
+        s = OutputSpool(os.path.join(d, "pipe"), max_bytes=100, tail_bytes=10)
+        p = subprocess.Popen(["seq", "100000"], stdout=subprocess.PIPE)
+        s.finish_pump(s.start_pump(p.stdout))
+        p.wait()
+        assert s.view().endswith("100000\n")
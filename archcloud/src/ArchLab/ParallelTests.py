@@ -0,0 +1,580 @@
+"""
+Run a lab's GradedRegressions in parallel.
+
+`ParallelTestRunner` is a drop-in replacement for gradescope's
+`JSONTestRunner`: it produces the same JSON, but it forks a process for
+each test and runs up to `jobs` of them at once.
+
+Tests are independent unless they say otherwise.  A test that depends on
+others runs after they finish, and `assert_success_so_far()` sees their
+failures.  Use `@depends_on("test_a", ...)` to name them, or
+`@depends_on()` to depend on every test before it (in the order unittest
+would run them).  Tests that call `assert_success_so_far()` but don't
+declare anything get the latter.
+
+We run the tests serially, just like `JSONTestRunner`, if there's only
+one core to spare or if the test case has class-level setup (which would
+run once per test).
+
+fork() only copies the thread that calls it, so forking a process with
+other threads (e.g., runlab.d, with its heartbeat and job workers) can
+leave the children stuck on locks those threads held.  So if there are
+other threads, the runners start a fresh interpreter, which loads the
+tests again and does the forking.
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import tempfile
+import contextlib
+import importlib
+import importlib.util
+import subprocess
+import threading
+import unittest
+import logging as log
+
+ALL_PREVIOUS = "*"
+
+def depends_on(*names):
+    """
+    Decorator for test methods.  With no arguments, the test depends on all the tests before it.
+    """
+    def decorator(f):
+        f.__depends_on__ = names if names else ALL_PREVIOUS
+        return f
+    return decorator
+
+def default_jobs():
+    """
+    How many tests to run at once.  Set GRADING_JOBS to override it.
+    """
+    if "GRADING_JOBS" in os.environ:
+        return max(1, int(os.environ["GRADING_JOBS"]))
+    # Leave a core for whatever else is going on (e.g., the next job's benchmark).
+    return max(1, len(os.sched_getaffinity(0)) - 1)
+
+def flatten(suite):
+    for t in suite:
+        if isinstance(t, unittest.TestSuite):
+            yield from flatten(t)
+        else:
+            yield t
+
+def fork_each(count, jobs, child, deps=None, stop=None):
+    """
+    Run `child(i, slot, results)` for i in range(count), each in its own
+    forked process, `jobs` at a time.  `slot` (0 to jobs-1) is unique
+    among the children running at once, and `results` holds the results
+    of the ones that have finished.  Item i starts after the items in
+    `deps[i]` (which must all be less than i) finish.  If `stop(results)`
+    returns True, we don't start any more.
+
+    `child` returns something JSON can hold.  Returns a dict mapping i to
+    it (or to None, if the child died).
+    """
+    deps = deps if deps is not None else [set()] * count
+    results = {}
+    running = {}
+    free_slots = list(range(jobs))
+    pending = list(range(count))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with tempfile.TemporaryDirectory() as d:
+        while pending or running:
+            if stop and stop(results):
+                pending = []
+            for i in [i for i in pending if deps[i] <= results.keys()]:
+                if not free_slots:
+                    break
+                pending.remove(i)
+                slot = free_slots.pop(0)
+                path = os.path.join(d, f"{i}.json")
+                pid = os.fork()
+                if pid == 0:
+                    _run_child(child, i, slot, results, path)
+                running[pid] = (i, slot, path)
+            if not running:
+                break
+
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+            i, slot, path = running.pop(pid)
+            free_slots.append(slot)
+            try:
+                with open(path) as f:
+                    results[i] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                log.debug(f"Child {i} died with status {status}")
+                results[i] = None
+    return results
+
+def _run_child(child, i, slot, results, path):
+    code = 1
+    try:
+        r = child(i, slot, results)
+        with open(path, "w") as f:
+            json.dump(r, f)
+        code = 0
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+def _declared_dependencies(test):
+    method = getattr(test, test._testMethodName)
+    declared = getattr(method, "__depends_on__", None)
+    if declared is not None:
+        return declared
+    try:
+        if "assert_success_so_far" in inspect.getsource(method):
+            return ALL_PREVIOUS
+    except (OSError, TypeError):
+        return ALL_PREVIOUS # We can't tell, so be safe.
+    return ()
+
+def _has_class_setup(test):
+    cls = type(test)
+    return (getattr(cls, "setUpClass").__func__ is not unittest.TestCase.setUpClass.__func__ or
+            getattr(cls, "tearDownClass").__func__ is not unittest.TestCase.tearDownClass.__func__)
+
+def _locate(test):
+    """
+    Where a fresh interpreter can find `test`: its module's name and
+    file, its class's qualified name, and its method.  None if it can't.
+    """
+    cls = type(test)
+    if "<locals>" in cls.__qualname__:
+        return None
+    path = getattr(sys.modules.get(cls.__module__), "__file__", None)
+    if path is None:
+        # Modules imported from a file (e.g., lab.py, by LabSpec.load())
+        # aren't in sys.modules, but their functions know where they're from.
+        for klass in cls.__mro__:
+            if klass.__module__ == cls.__module__:
+                for f in vars(klass).values():
+                    if inspect.isfunction(f):
+                        path = inspect.unwrap(f).__code__.co_filename
+                        break
+            if path:
+                break
+    if path is None:
+        return None
+    return [cls.__module__, path, cls.__qualname__, test._testMethodName]
+
+_loaded_modules = {}
+
+def _load(location):
+    module_name, path, qualname, method = location
+    module = _loaded_modules.get(path)
+    if module is None:
+        try:
+            module = importlib.import_module(module_name)
+            if os.path.abspath(getattr(module, "__file__", "")) != os.path.abspath(path):
+                module = None
+        except ImportError:
+            module = None
+        if module is None:
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        _loaded_modules[path] = module
+    cls = module
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    return cls(method)
+
+class ForkingRunner(object):
+    """
+    The runners fork a process for each test, in `cwd` (if it's not
+    None).  Subclasses implement `_run_here(tests, **kwargs)`, which
+    returns something JSON can hold, and `_settings()`, the arguments it
+    takes to make another one like it.
+    """
+    cwd = None
+
+    def _run_safely(self, tests, **kwargs):
+        """
+        `self._run_here(tests, **kwargs)`, here if there are no other
+        threads and in a fresh interpreter if there are.  Either way, the
+        tests run in `self.cwd`, and our working directory doesn't change
+        while any other thread could see it.
+        """
+        locations = [_locate(t) for t in tests]
+        if threading.active_count() == 1 or None in locations:
+            if threading.active_count() > 1:
+                log.warning("Running tests here with other threads running, since we can't load them in a fresh process")
+            saved = os.getcwd()
+            try:
+                if self.cwd:
+                    os.chdir(self.cwd)
+                return self._run_here(tests, **kwargs)
+            finally:
+                os.chdir(saved)
+
+        log.debug(f"Running {len(tests)} tests in a fresh process, since this one has other threads")
+        with tempfile.TemporaryDirectory() as d:
+            spec = os.path.join(d, "spec.json")
+            out = os.path.join(d, "out.json")
+            with open(spec, "w") as f:
+                json.dump(dict(runner=type(self).__name__,
+                               settings=self._settings(),
+                               tests=locations,
+                               kwargs=kwargs,
+                               sys_path=sys.path), f)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            status = subprocess.call([sys.executable, "-m", "ArchLab.ParallelTests", spec, out], cwd=self.cwd)
+            try:
+                with open(out) as f:
+                    return json.load(f)
+            except (FileNotFoundError, ValueError):
+                raise Exception(f"The process running the tests failed (exit status {status})")
+
+class ParallelTestRunner(ForkingRunner):
+
+    def __init__(self, jobs=None, stream=sys.stdout, buffer=True, visibility=None, failure_prefix="Test Failed: ", cwd=None):
+        self.jobs = jobs if jobs is not None else default_jobs()
+        self.cwd = cwd
+        self.stream = stream
+        self.buffer = buffer
+        self.visibility = visibility
+        self.failure_prefix = failure_prefix
+
+    def _settings(self):
+        return dict(jobs=self.jobs, buffer=self.buffer, visibility=self.visibility, failure_prefix=self.failure_prefix)
+
+    def _serial_reason(self, tests):
+        if self.jobs <= 1 or len(tests) <= 1:
+            return "there's nothing to run in parallel"
+        if any(_has_class_setup(t) for t in tests):
+            return "the tests have class-level setup"
+        return None
+
+    def _make_result(self, tests, leaderboard):
+        from gradescope_utils.autograder_utils.json_test_runner import JSONTestResult
+        return JSONTestResult(None, True, 1, tests, leaderboard, self.failure_prefix)
+
+    def _run_test(self, test, prior_failures):
+        tests, leaderboard = [], []
+        result = self._make_result(tests, leaderboard)
+        result.buffer = self.buffer
+        result.prior_failures = prior_failures
+        result.startTestRun()
+        try:
+            test(result)
+        finally:
+            result.stopTestRun()
+        return dict(tests=tests,
+                    leaderboard=leaderboard,
+                    failed=len(result.failures) + len(result.errors))
+
+    def _crashed(self, test, why):
+        return dict(tests=[self._make_result([], []).buildResult(test, (Exception, Exception(why), None))],
+                    leaderboard=[],
+                    failed=1)
+
+    def run(self, suite):
+        json_data = self._run_safely(list(flatten(suite)))
+        json.dump(json_data, self.stream, indent=4)
+        self.stream.write('\n')
+        return json_data
+
+    def _run_here(self, tests):
+        why = self._serial_reason(tests)
+        if why:
+            import io
+            log.debug(f"Running tests serially, since {why}")
+            from gradescope_utils.autograder_utils.json_test_runner import JSONTestRunner
+            runner = JSONTestRunner(visibility=self.visibility, stream=io.StringIO(), buffer=self.buffer, failure_prefix=self.failure_prefix)
+            runner.run(unittest.TestSuite(tests))
+            return runner.json_data
+
+        start = time.time()
+        names = [t._testMethodName for t in tests]
+        deps = []
+        for i, t in enumerate(tests):
+            declared = _declared_dependencies(t)
+            if declared == ALL_PREVIOUS:
+                deps.append(set(range(i)))
+            else:
+                d = set()
+                for n in declared:
+                    if n in names[:i]:
+                        d.add(names.index(n))
+                    else:
+                        log.warning(f"Ignoring {names[i]}'s dependency on {n}, since it doesn't run before it.")
+                deps.append(d)
+
+        log.debug(f"Running {len(tests)} tests, {self.jobs} at a time")
+        def child(i, slot, results):
+            return self._run_test(tests[i], sum(results[j]['failed'] for j in deps[i]))
+        results = fork_each(len(tests), self.jobs, child, deps=deps)
+        for i in results:
+            if results[i] is None:
+                results[i] = self._crashed(tests[i], "The test crashed.")
+
+        json_data = dict(tests=[], leaderboard=[])
+        if self.visibility:
+            json_data['visibility'] = self.visibility
+        for i in range(len(tests)):
+            json_data['tests'] += results[i]['tests']
+            json_data['leaderboard'] += results[i]['leaderboard']
+        json_data['execution_time'] = format(time.time() - start, "0.2f")
+        json_data['score'] = sum(t.get("score", 0.0) for t in json_data['tests'])
+        return json_data
+
+class MetaRegressionRunner(ForkingRunner):
+    """
+    Runs a lab's MetaRegressions (the matrix of solutions and flags) in
+    parallel, `jobs` at a time, and prints one report at the end instead
+    of interleaving their logs.
+
+    Each test gets its own process, a log file in `log_dir`, and, in
+    META_REGRESSION_CORE, a core of its own (pinning is up to the test:
+    see `CSE141Lab.MetaRegressions.run_solution`).  Tests build in
+    working directories under META_REGRESSION_WORKDIRS, one per build
+    configuration, so configurations that build the same thing reuse it.
+    """
+    def __init__(self, jobs=None, failfast=False, log_dir=None, stream=sys.stderr, cwd=None):
+        self.jobs = jobs if jobs is not None else default_jobs()
+        self.cwd = cwd
+        self.failfast = failfast
+        self.log_dir = log_dir
+        self.stream = stream
+
+    def _settings(self):
+        return dict(jobs=self.jobs, failfast=self.failfast, log_dir=self.log_dir)
+
+    def _run_test(self, test, slot, log_path, workdirs):
+        cores = sorted(os.sched_getaffinity(0))
+        os.environ['META_REGRESSION_CORE'] = str(cores[slot % len(cores)])
+        os.environ['META_REGRESSION_WORKDIRS'] = workdirs
+        fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        sys.stdout = os.fdopen(1, "w", buffering=1)
+        sys.stderr = os.fdopen(2, "w", buffering=1)
+        for h in log.root.handlers:
+            if isinstance(h, log.StreamHandler) and not isinstance(h, log.FileHandler):
+                h.setStream(sys.stderr)
+
+        result = unittest.TestResult()
+        start = time.time()
+        test(result)
+        outcome = "passed"
+        details = ""
+        if result.errors or result.failures:
+            outcome = "error" if result.errors else "failed"
+            details = (result.errors + result.failures)[0][1]
+        elif result.skipped:
+            outcome = "skipped"
+            details = result.skipped[0][1]
+        return dict(outcome=outcome, details=details, duration=time.time() - start)
+
+    def _run_here(self, tests, log_paths):
+        with tempfile.TemporaryDirectory(prefix="meta-workdirs-") as workdirs:
+            def child(i, slot, results):
+                return self._run_test(tests[i], slot, log_paths[i], workdirs)
+            def stop(results):
+                return self.failfast and any(r is None or r['outcome'] in ["failed", "error"] for r in results.values())
+            return fork_each(len(tests), self.jobs, child, stop=stop)
+
+    def run(self, suite):
+        from .Columnize import columnize
+        tests = list(flatten(suite))
+        log_dir = self.log_dir or tempfile.mkdtemp(prefix="meta-regressions-")
+        os.makedirs(log_dir, exist_ok=True)
+        log_paths = [os.path.join(log_dir, f"{i:03d}-{t._testMethodName}.log") for i, t in enumerate(tests)]
+
+        log.info(f"Running {len(tests)} meta regressions, {self.jobs} at a time.  Logs are in {log_dir}")
+        # JSON keys are strings.
+        results = {int(i): r for i, r in self._run_safely(tests, log_paths=log_paths).items()}
+
+        result = unittest.TestResult()
+        rows = [["test", "result", "time", "log"]]
+        for i, t in enumerate(tests):
+            r = results.get(i, dict(outcome="not run", details="", duration=0))
+            if r is None:
+                r = dict(outcome="error", details="The test crashed.", duration=0)
+            if r['outcome'] in ["failed", "error"]:
+                (result.errors if r['outcome'] == "error" else result.failures).append((t, r['details']))
+            elif r['outcome'] == "skipped":
+                result.skipped.append((t, r['details']))
+            if i in results:
+                result.testsRun += 1
+            rows.append([t.id(), r['outcome'], f"{r['duration']:.1f}s", log_paths[i]])
+
+        for t, details in result.errors + result.failures:
+            self.stream.write(f"{'=' * 70}\n{t.id()}\n{'-' * 70}\n{details}\n")
+        self.stream.write(columnize(rows, divider="  "))
+        self.stream.write(f"Ran {result.testsRun} tests: {len(result.failures)} failed, {len(result.errors)} errors, {len(result.skipped)} skipped.\n")
+        return result
+
+RUNNERS = dict(ParallelTestRunner=ParallelTestRunner, MetaRegressionRunner=MetaRegressionRunner)
+
+def main(argv=None):
+    """
+    Run the tests that a runner in a process with threads handed us (see
+    `ForkingRunner._run_safely()`).
+    """
+    if argv == None:
+        argv = sys.argv[1:]
+    spec_path, out_path = argv
+    with open(spec_path) as f:
+        spec = json.load(f)
+    sys.path[:0] = [p for p in spec['sys_path'] if p not in sys.path]
+    tests = [_load(l) for l in spec['tests']]
+    r = RUNNERS[spec['runner']](**spec['settings'])._run_here(tests, **spec['kwargs'])
+    with open(out_path, "w") as f:
+        json.dump(r, f)
+
+def _weight(w):
+    # Like gradescope_utils' @weight, which is too slow to import when we start.
+    def decorator(f):
+        f.__weight__ = w
+        return f
+    return decorator
+
+class _ExampleTests(unittest.TestCase):
+    @_weight(1)
+    def test_a(self):
+        time.sleep(0.5)
+        print("hello from a")
+
+    @_weight(2)
+    def test_b(self):
+        time.sleep(0.5)
+        self.assertTrue(False, "b fails")
+
+    @_weight(3)
+    @depends_on("test_b")
+    def test_c(self):
+        r = self.currentResult # like CSE141Lab's assert_success_so_far()
+        if len(r.failures) + len(r.errors) + getattr(r, "prior_failures", 0):
+            raise Exception("b failed")
+
+    @_weight(4)
+    def test_d(self):
+        time.sleep(0.5)
+
+    currentResult = None
+    def run(self, result=None):
+        self.currentResult = result
+        unittest.TestCase.run(self, result)
+
+class _CrashingTests(unittest.TestCase):
+    @_weight(1)
+    def test_crash(self):
+        os._exit(1)
+    def test_fine(self):
+        pass
+
+class _WhereAmI(unittest.TestCase):
+    def test_here(self):
+        self.assertTrue(os.path.exists("marker"))
+    def test_also_here(self):
+        self.assertTrue(os.path.exists("marker"))
+
+class _ExampleMetaRegressions(unittest.TestCase):
+    def test_a(self):
+        print("a's output")
+        self.assertIn("META_REGRESSION_CORE", os.environ)
+    def test_b(self):
+        self.assertTrue(False, "b is broken")
+    def test_c(self):
+        self.skipTest("not today")
+
+# These are for testing the runners.  Don't let pytest run them itself.
+for c in [_ExampleTests, _CrashingTests, _WhereAmI, _ExampleMetaRegressions]:
+    c.__test__ = False
+
+def check_parallel_runner():
+    import io
+    from gradescope_utils.autograder_utils.json_test_runner import JSONTestRunner
+
+    runner = JSONTestRunner(stream=io.StringIO(), visibility='visible')
+    runner.run(unittest.defaultTestLoader.loadTestsFromTestCase(_ExampleTests))
+    serial = runner.json_data
+
+    out = io.StringIO()
+    r = ParallelTestRunner(jobs=3, stream=out, visibility='visible').run(unittest.defaultTestLoader.loadTestsFromTestCase(_ExampleTests))
+    assert json.loads(out.getvalue()) == r
+    assert [t['name'] for t in r['tests']] == [t['name'] for t in serial['tests']]
+    assert [t['status'] for t in r['tests']] == [t['status'] for t in serial['tests']] == ["passed", "failed", "failed", "passed"]
+    assert r['score'] == 5
+    assert "hello from a" in r['tests'][0]['output']
+    assert "b fails" in r['tests'][1]['output']
+    assert r['visibility'] == 'visible'
+    assert float(r['execution_time']) < 1.4
+
+    # A test that takes its process down with it just fails.
+    r = ParallelTestRunner(jobs=2, stream=io.StringIO()).run(unittest.defaultTestLoader.loadTestsFromTestCase(_CrashingTests))
+    assert [t['status'] for t in r['tests']] == ["failed", "passed"]
+    assert "crashed" in r['tests'][0]['output']
+
+def check_meta_regression_runner():
+    import io
+    with tempfile.TemporaryDirectory() as d:
+        out = io.StringIO()
+        r = MetaRegressionRunner(jobs=2, log_dir=d, stream=out).run(unittest.defaultTestLoader.loadTestsFromTestCase(_ExampleMetaRegressions))
+        assert r.testsRun == 3
+        assert len(r.failures) == 1 and len(r.errors) == 0 and len(r.skipped) == 1
+        assert "b is broken" in out.getvalue()
+        assert "a's output" in open(os.path.join(d, "000-test_a.log")).read()
+
+class _OtherThread(object):
+    """
+    Keep another thread running in the with block, like runlab.d does.
+    """
+    def __enter__(self):
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.done.wait, daemon=True)
+        self.thread.start()
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+
+def test_parallel_runner():
+    check_parallel_runner()
+
+def test_parallel_runner_with_threads(monkeypatch):
+    fresh = []
+    real = subprocess.call
+    monkeypatch.setattr(subprocess, "call", lambda cmd, **kwargs: fresh.append(cmd) or real(cmd, **kwargs))
+    with _OtherThread():
+        check_parallel_runner()
+    assert len(fresh) == 2 # one for each run().
+
+def test_runner_cwd():
+    import io
+    with tempfile.TemporaryDirectory() as d:
+        open(os.path.join(d, "marker"), "w").close()
+        before = os.getcwd()
+        for threads in [False, True]:
+            for jobs in [1, 2]:
+                with (_OtherThread() if threads else contextlib.nullcontext()):
+                    r = ParallelTestRunner(jobs=jobs, stream=io.StringIO(), cwd=d).run(unittest.defaultTestLoader.loadTestsFromTestCase(_WhereAmI))
+                assert [t['status'] for t in r['tests']] == ["passed", "passed"], (threads, jobs)
+                assert os.getcwd() == before
+
+def test_meta_regression_runner():
+    check_meta_regression_runner()
+
+def test_meta_regression_runner_with_threads(monkeypatch):
+    fresh = []
+    real = subprocess.call
+    monkeypatch.setattr(subprocess, "call", lambda cmd, **kwargs: fresh.append(cmd) or real(cmd, **kwargs))
+    with _OtherThread():
+        check_meta_regression_runner()
+    assert len(fresh) == 1
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Host capability probes (does PAPI work?  What clock speeds can we set?).
+
+Probes are slow (they shell out), and their answers only change when the
+machine reboots or we move to a new docker image, so we run each one
+once and keep its result in a small file in the archlab cache dir.  The
+file is keyed by the boot id and THIS_DOCKER_IMAGE; when either changes,
+the probes run again.  Otherwise, the results stick until someone
+invalidates them:
+
+    capability-probes --invalidate [papi ...]
+"""
+import os
+import sys
+import json
+import fcntl
+import argparse
+import platform
+import tempfile
+import subprocess
+import logging as log
+
+from .CacheDir import archlab_cache_dir
+
+PROBES = {}
+
+def probe(name):
+    """
+    Register a function as the probe called `name`.  It returns something JSON can hold.
+    """
+    def decorator(f):
+        PROBES[name] = f
+        return f
+    return decorator
+
+@probe("papi")
+def probe_papi():
+    try:
+        subprocess.check_call(['archlab_check', '--engine', 'papi'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return True
+    except:
+        return False
+
+@probe("cpu_freqs")
+def probe_cpu_freqs():
+    from .CPUFreq import read_freqs
+    return read_freqs()
+
+def host_stamp():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+    except OSError:
+        boot_id = "unknown"
+    return f"{platform.node()} {boot_id} {os.environ.get('THIS_DOCKER_IMAGE', 'unknown')}"
+
+class ProbeCache(object):
+    def __init__(self, path=None):
+        self.path = path if path is not None else os.path.join(archlab_cache_dir(), "probes.json")
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if data.get("stamp") != host_stamp():
+            log.debug("Host changed since the last probes.  Discarding them.")
+            return {}
+        return data.get("results", {})
+
+    def _store(self, results):
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path), delete=False) as f:
+            json.dump(dict(stamp=host_stamp(), results=results), f)
+        os.rename(f.name, self.path)
+
+    def _locked(self):
+        lock = open(f"{self.path}.lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def get(self, name):
+        """
+        The result of probe `name`, running it if we don't have it.
+        """
+        results = self._load()
+        if name in results:
+            return results[name]
+        with self._locked():
+            results = self._load() # someone else may have just run it.
+            if name not in results:
+                log.debug(f"Running capability probe '{name}'")
+                results[name] = PROBES[name]()
+                self._store(results)
+            return results[name]
+
+    def results(self):
+        """
+        All the probe results, running any we don't have.
+        """
+        return {name: self.get(name) for name in PROBES}
+
+    def invalidate(self, names=None):
+        with self._locked():
+            results = self._load()
+            for n in (names if names else list(results)):
+                results.pop(n, None)
+            self._store(results)
+
+def probe_result(name):
+    return ProbeCache().get(name)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show (and cache) what this host can do.')
+    parser.add_argument('-v', action='store_true', dest="verbose", default=False, help="Be verbose")
+    parser.add_argument('--invalidate', nargs="*", default=None, metavar="PROBE", help=f"Forget these probes' results (default: all of them).  Possibilities are {', '.join(PROBES)}")
+    if argv == None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if args.verbose else "%(levelname)-8s %(message)s",
+                    level=log.DEBUG if args.verbose else log.INFO)
+
+    cache = ProbeCache()
+    if args.invalidate is not None:
+        unknown = set(args.invalidate) - set(PROBES)
+        if unknown:
+            log.error(f"Unknown probes: {', '.join(unknown)}")
+            return 1
+        cache.invalidate(args.invalidate)
+    print(json.dumps(cache.results(), indent=4, sort_keys=True))
+    return 0
+
+def test_probe_cache():
+    calls = []
+    @probe("test_probe")
+    def test_probe():
+        calls.append(1)
+        return len(calls)
+
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            cache = ProbeCache(os.path.join(d, "probes.json"))
+            assert cache.get("test_probe") == 1
+            assert ProbeCache(cache.path).get("test_probe") == 1
+            assert len(calls) == 1
+
+            cache.invalidate(["test_probe"])
+            assert cache.get("test_probe") == 2
+
+            # A new boot (or docker image) starts over.
+            with open(cache.path) as f:
+                data = json.load(f)
+            data['stamp'] = "some other boot"
+            with open(cache.path, "w") as f:
+                json.dump(data, f)
+            assert cache.get("test_probe") == 3
+    finally:
+        del PROBES["test_probe"]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
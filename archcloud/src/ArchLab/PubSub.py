@@ -4,6 +4,9 @@ import logging as log
 if os.environ["CLOUD_MODE"] == "EMULATION":
     from .LocalPubSub import LocalPublisher as Publisher
     from .LocalPubSub import LocalSubscriber as Subscriber
+elif os.environ["CLOUD_MODE"] == "EMULATION_SQLITE":
+    from .SQLitePubSub import SQLitePublisher as Publisher
+    from .SQLitePubSub import SQLiteSubscriber as Subscriber
 else:
     from .GooglePubSub import GooglePublisher as Publisher
     from .GooglePubSub import GoogleSubscriber as Subscriber
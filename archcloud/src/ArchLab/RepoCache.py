@@ -0,0 +1,247 @@
+import os
+import re
+import shutil
+import hashlib
+import subprocess
+import tempfile
+import fcntl
+import logging as log
+from contextlib import contextmanager
+
+from .CacheDir import archlab_cache_dir
+
+class RepoCache(object):
+    """
+    Per-host cache of bare mirrors of lab repos.
+
+    Cloning a lab repo from github is the biggest fixed cost of a pristine
+    run.  Instead, we keep a bare mirror of each repo, bring it up to date
+    with an incremental fetch, and clone from it locally (which hardlinks
+    the objects when it can).  Mirrors that haven't been used recently are
+    evicted once the cache grows past `max_bytes`.
+
+    Set REPO_CACHE=no to turn it off.
+    """
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root if root is not None else archlab_cache_dir("repos")
+        os.makedirs(self.root, exist_ok=True)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("REPO_CACHE_MAX_MB", 4096)) * 1024 * 1024
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def enabled(cls):
+        return os.environ.get("REPO_CACHE", "yes").lower() != "no"
+
+    @classmethod
+    def is_remote(cls, repo):
+        # Local directories are cheap to clone already.
+        return repo is not None and not os.path.isdir(repo)
+
+    def _public_url(self, repo):
+        return re.sub(r"//[^@/]*@", "//", repo)
+
+    def mirror_path(self, repo):
+        # Key on the url without credentials, so the token can change.
+        key = hashlib.sha1(self._public_url(repo).encode("utf8")).hexdigest()
+        return os.path.join(self.root, f"{key}.git")
+
+    @contextmanager
+    def locked(self, repo):
+        with open(f"{self.mirror_path(repo)}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _git(self, *args, cwd=None):
+        log.debug(f"Running git {' '.join(self._public_url(a) for a in args)} in {cwd or '.'}")
+        p = subprocess.run(["git"] + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, ["git"] + [self._public_url(a) for a in args], output=p.stdout)
+        return p.stdout.decode("utf8", errors="replace")
+
+    def _has_ref(self, mirror, ref):
+        try:
+            self._git("rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}", cwd=mirror)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def _is_current(self, repo, mirror, ref):
+        # Commit ids don't move, so if we have one, we don't need to
+        # fetch.  Tags usually don't, but someone can re-point one, so
+        # check (that's much cheaper than a fetch).  Branches do move.
+        if re.fullmatch(r"[0-9a-f]{40}", ref):
+            return self._has_ref(mirror, ref)
+        try:
+            ours = self._git("rev-parse", "--verify", "--quiet", f"refs/tags/{ref}", cwd=mirror).strip()
+        except subprocess.CalledProcessError:
+            return False
+        theirs = self._git("ls-remote", "--tags", repo, f"refs/tags/{ref}").split()
+        return theirs[:1] == [ours]
+
+    def _refresh(self, repo, ref, fetch):
+        # Call with the lock held.  The token only ever appears on the
+        # command line, never in the mirror's config.
+        mirror = self.mirror_path(repo)
+        if not os.path.isdir(mirror):
+            log.info(f"Mirroring {self._public_url(repo)} into the repo cache")
+            tmp = tempfile.mkdtemp(dir=self.root, prefix="tmp-")
+            try:
+                # Not --mirror: we don't want github's refs/pull/*
+                self._git("clone", "--bare", repo, tmp)
+                self._git("remote", "set-url", "origin", self._public_url(repo), cwd=tmp)
+                self._git("config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*", cwd=tmp)
+                os.rename(tmp, mirror)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        elif fetch and (ref is None or not self._is_current(repo, mirror, ref)):
+            log.debug(f"Fetching {self._public_url(repo)} into the repo cache")
+            # Forced tag updates, so re-pointed tags move too.
+            self._git("fetch", "--prune", repo, "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*", cwd=mirror)
+        os.utime(mirror) # for LRU eviction
+        return mirror
+
+    def refresh(self, repo, ref=None):
+        """
+        Make sure the mirror of `repo` exists and is up to date enough to
+        have `ref`.  Returns the mirror's path.
+        """
+        with self.locked(repo):
+            mirror = self._refresh(repo, ref, fetch=True)
+        self.evict(keep=mirror)
+        return mirror
+
+    def has_branch(self, repo, branch):
+        mirror = self.refresh(repo, branch)
+        try:
+            self._git("show-ref", "--verify", "--quiet", f"refs/heads/{branch}", cwd=mirror)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def clone(self, repo, dest, ref=None, fetch=True):
+        """
+        Clone `repo` into `dest` (which should be empty) and check out `ref`
+        (a branch, tag, or commit id).  The clone's origin is `repo`, just
+        like a regular clone.  Pass `fetch=False` if you've just refreshed
+        the mirror (e.g., with `has_branch()`).
+        """
+        # Hold the lock until we're done, so no one evicts the mirror
+        # out from under the clone.
+        with self.locked(repo):
+            mirror = self._refresh(repo, ref, fetch)
+            if ref is None or re.fullmatch(r"[0-9a-f]{40}", ref):
+                self._git("clone", mirror, dest)
+                if ref:
+                    self._git("checkout", "-q", ref, cwd=dest)
+            else:
+                self._git("clone", "-b", ref, mirror, dest)
+        self._git("remote", "set-url", "origin", repo, cwd=dest)
+        self.evict(keep=mirror)
+        return dest
+
+    def _size(self, path):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for f in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, f)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def evict(self, keep=None):
+        mirrors = []
+        for m in os.listdir(self.root):
+            path = os.path.join(self.root, m)
+            if m.endswith(".git") and os.path.isdir(path):
+                mirrors.append((os.path.getmtime(path), path, self._size(path)))
+        total = sum(m[2] for m in mirrors)
+        for mtime, path, size in sorted(mirrors):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            with open(f"{path}.lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # someone's using it.
+                try:
+                    log.info(f"Evicting {path} from the repo cache")
+                    shutil.rmtree(path, ignore_errors=True)
+                    total -= size
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+def test_repo_cache():
+    def git(*args, cwd):
+        subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@test", "-c", "init.defaultBranch=master"] + list(args),
+                              cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    with tempfile.TemporaryDirectory() as d:
+        origins = []
+        for name in ["a", "b"]:
+            origin = os.path.join(d, name)
+            os.makedirs(origin)
+            git("init", "-q", cwd=origin)
+            with open(os.path.join(origin, "lab.py"), "w") as f:
+                f.write("1")
+            git("add", "lab.py", cwd=origin)
+            git("commit", "-q", "-m", "one", cwd=origin)
+            git("tag", "v1", cwd=origin)
+            origins.append(origin)
+        origin = origins[0]
+        first = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=origin).decode("utf8").strip()
+
+        cache = RepoCache(root=os.path.join(d, "cache"))
+        cache.clone(origin, os.path.join(d, "c1"), "master")
+        assert open(os.path.join(d, "c1", "lab.py")).read() == "1"
+        assert subprocess.check_output(["git", "remote", "get-url", "origin"], cwd=os.path.join(d, "c1")).decode("utf8").strip() == origin
+
+        # branches get fetched
+        with open(os.path.join(origin, "lab.py"), "w") as f:
+            f.write("2")
+        git("commit", "-q", "-a", "-m", "two", cwd=origin)
+        cache.clone(origin, os.path.join(d, "c2"), "master")
+        assert open(os.path.join(d, "c2", "lab.py")).read() == "2"
+
+        # tags and commit ids work too
+        cache.clone(origin, os.path.join(d, "c3"), "v1")
+        assert open(os.path.join(d, "c3", "lab.py")).read() == "1"
+        cache.clone(origin, os.path.join(d, "c4"), first)
+        assert open(os.path.join(d, "c4", "lab.py")).read() == "1"
+
+        assert cache.has_branch(origin, "master")
+        assert not cache.has_branch(origin, "nope")
+
+        # Tags that get re-pointed get fetched again.
+        git("tag", "-f", "v1", cwd=origin)
+        cache.clone(origin, os.path.join(d, "c5"), "v1")
+        assert open(os.path.join(d, "c5", "lab.py")).read() == "2"
+
+        # Credentials don't end up in the mirror.
+        assert cache._public_url("https://token@github.com/x/y") == "https://github.com/x/y"
+        assert cache.mirror_path("https://token@github.com/x/y") == cache.mirror_path("https://other@github.com/x/y")
+        assert cache._git("config", "remote.origin.url", cwd=cache.mirror_path(origin)).strip() == origin
+
+        # has_branch() fetches, so the clone after it doesn't have to.
+        class Counting(RepoCache):
+            fetches = 0
+            def _git(self, *args, cwd=None):
+                if args[0] == "fetch":
+                    self.fetches += 1
+                return super(Counting, self)._git(*args, cwd=cwd)
+        counting = Counting(root=os.path.join(d, "cache"))
+        assert counting.has_branch(origin, "master")
+        counting.clone(origin, os.path.join(d, "c6"), "master", fetch=False)
+        assert counting.fetches == 1
+
+        # A tiny cache only keeps the mirror we just used.
+        small = RepoCache(root=os.path.join(d, "cache"), max_bytes=1)
+        small.refresh(origins[1])
+        assert os.path.isdir(small.mirror_path(origins[1]))
+        assert not os.path.isdir(small.mirror_path(origin))
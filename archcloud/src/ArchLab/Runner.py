@@ -14,26 +14,33 @@ from contextlib import contextmanager
 import csv
 from pathlib import Path
 import functools
-import unittest
+import unittest # LabSpec.GradedRegressions and MetaRegressions are TestCases.
 from pathlib import Path
 import io
 import platform
 import base64
+import hashlib
 from uuid import uuid4 as uuid
 import time
-from zipfile import ZipFile
+import shutil
 from functools import reduce
-import http.client as http_client
-import pytest
 
-#http_client.HTTPConnection.debuglevel = 1
+# Keep imports here cheap: every runlab, labtool, etc. pays for them.
+# Import heavy things (zipfile, the cloud backends, pytest) where they're used.
 
-from gradescope_utils.autograder_utils.json_test_runner import JSONTestRunner
+#import http.client as http_client; http_client.HTTPConnection.debuglevel = 1
 
 from .Columnize import columnize
+from .RepoCache import RepoCache
+from .OutputSpool import OutputSpool
+from .DockerPool import docker_run_options
+from .Timing import SpanRecorder
+from .CacheDir import archlab_cache_dir
+from .CSVTable import csv_table
+from .ParallelTests import ParallelTestRunner, MetaRegressionRunner
 
 import datetime
-import pytz
+import threading
 
 class UserError(Exception):
     pass
@@ -50,9 +57,21 @@ class ConfigException(UserError):
 class MalformedObject(ArchlabError):
     pass
 
+class JobTimedOut(UserError):
+    """
+    The job ran too long.  `recorded` says whether the datastore already
+    says so.
+    """
+    def __init__(self, message, recorded):
+        super(JobTimedOut, self).__init__(message)
+        self.recorded = recorded
 
 class cd:
-    """Context manager for changing the current working directory"""
+    """
+    Context manager for changing the current working directory.  It's
+    process-wide, so don't use it where other threads are running (e.g.,
+    in runlab.d): pass `cwd=` to whatever you're calling instead.
+    """
     def __init__(self, newPath):
         self.newPath = os.path.expanduser(newPath)
         
@@ -73,6 +92,16 @@ def environment(**kwds):
         os.environ.clear()
         os.environ.update(env)
 
+def job_environment(env):
+    """
+    Return a copy of `os.environ` updated with `env`.  Pass it to
+    subprocess as `env=` rather than using `environment()`, so jobs
+    running in other threads don't see each other's settings.
+    """
+    r = dict(os.environ)
+    r.update(env)
+    return r
+
 @contextmanager
 def collect_fields_of(obj):
     before = list(obj.__dict__.keys())
@@ -138,21 +167,24 @@ class LabSpec(object):
         Class = type(self).GradedRegressions
         log.debug(f"Running regressions for {Class}")
         suite = unittest.defaultTestLoader.loadTestsFromTestCase(Class)
-        with cd(dirname):
-            #with environment(**result.submission.env):
-            JSONTestRunner(visibility='visible', stream=out, buffer=True).run(suite)
+        #with environment(**result.submission.env):
+        ParallelTestRunner(visibility='visible', stream=out, buffer=True, cwd=dirname).run(suite)
         return json.loads(out.getvalue())
 
 
-    def run_meta_regressions(self, *argc, **kwargs):
+    def run_meta_regressions(self, *argc, jobs=1, **kwargs):
         Class = type(self).MetaRegressions
         if kwargs.get('test_name', None):
             suite = unittest.defaultTestLoader.loadTestsFromName(kwargs['test_name'])
         else:
             suite = unittest.defaultTestLoader.loadTestsFromTestCase(Class)
         del kwargs['test_name']
-            
-        runner = unittest.TextTestRunner(*argc, **kwargs)
+
+        if jobs > 1:
+            runner = MetaRegressionRunner(jobs=jobs, failfast=kwargs.get('failfast', False), log_dir=kwargs.get('log_dir'))
+        else:
+            kwargs.pop('log_dir', None)
+            runner = unittest.TextTestRunner(*argc, **kwargs)
         return runner.run(suite)
         
     def get_help(self):
@@ -175,37 +207,16 @@ class LabSpec(object):
 
     
     def csv_extract_by_line(self, file_contents, field, line=0):
-        reader = csv.DictReader(StringIO(file_contents))
-        d = list(reader)
-        if len(d) < line + 1:
+        r = csv_table(file_contents).value(line, field)
+        if r is None:
             log.debug(f"Returning None, because there is no line {line}")
-            return None
-        try:
-            return float(d[line][field])
-        except:
-            return d[line][field]
-    
+        return r
 
     def csv_extract_by_lookup(self, file_contents, pattern, column):
-        reader = csv.DictReader(StringIO(file_contents))
-        d = list(reader)
-        r = None
-        for l in d:
-            if all([l[c] == q for c,q in pattern.items()]):
-                try:
-                    return float(l[column])
-                except:
-                    return l[column]
-        return None
+        return csv_table(file_contents).lookup(pattern, column)
     
     def csv_column_values(self, file_contents, field):
-        reader = csv.DictReader(StringIO(file_contents))
-        def parse(x):
-            try:
-                return float(x)
-            except:
-                return x
-        return map(lambda x: parse(x[field]), reader)
+        return iter(csv_table(file_contents).column(field))
     
     def safe_env_value(self, v):
         if not re.match(fr"^{safe_env}*$", v):
@@ -287,42 +298,116 @@ class LabSpec(object):
             raise MalformedObject()
         return t
 
-    @classmethod
-    def load(cls, root, public_only=False):
+    # The ThisLab classes we've already executed, keyed by the hash of
+    # their source, so each version of lab.py runs once per process.  We
+    # keep the MAX_CACHED_CLASSES most recently used, so old versions of
+    # labs drop out of long-running processes (e.g., the daemon).
+    _class_cache = collections.OrderedDict()
+    _class_cache_lock = threading.Lock()
+    MAX_CACHED_CLASSES = 32
+    _library_stamp = None
 
-        def load_file(name, f):
-            path =  os.path.join(root, f)
-            spec = importlib.util.spec_from_file_location(name, path)
-            info = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(info)
-            log.debug(f"Imported {path}")
-            log.debug(f"{dir(info)}")
+    @classmethod
+    def _source(cls, root, public_only):
+        """
+        Find the file the lab spec comes from and read it.  Returns (module name, path, contents).
+        """
+        candidates = [("lab", "lab.py")] if public_only else [("private", "private.py"), ("lab", "lab.py")]
+        for name, f in candidates:
+            path = os.path.join(root, f)
             try:
-                importlib.reload(info)
-            except:
-                pass
+                with open(path, "rb") as s:
+                    return name, path, s.read()
+            except FileNotFoundError:
+                log.debug(f"Didn't find {path}")
+        raise FileNotFoundError(f"No lab.py in {root}")
 
-            return path, info
+    @classmethod
+    def _digest(cls, name, contents):
+        return hashlib.sha256(name.encode("utf8") + b"\0" + contents).hexdigest()
 
-        if public_only:
-            log.debug(f"Ignoring private.py")
-            path, info = load_file("lab", "lab.py")
-            LabType = info.ThisLab
-        else:
+    @classmethod
+    def _snapshot_path(cls, digest):
+        # Labs inherit defaults from this package, so a snapshot is only
+        # good for the version of it that made it.
+        if cls._library_stamp is None:
+            here = os.path.dirname(os.path.abspath(__file__))
+            stamp = sorted((f, os.path.getmtime(os.path.join(here, f))) for f in os.listdir(here) if f.endswith(".py"))
+            cls._library_stamp = hashlib.sha256(repr(stamp).encode("utf8")).hexdigest()[:16]
+        return os.path.join(archlab_cache_dir("labspecs"), f"{digest}-{cls._library_stamp}.json")
 
-            try:
-                log.debug(f"Checking for private.py")
-                path, info = load_file("private","private.py")
-                LabType = info.ThisLab
-            except FileNotFoundError:
-                log.debug(f"Falling back to lab.py")
-                path, info = load_file("lab", "lab.py")
+    @classmethod
+    def _write_snapshot(cls, digest, spec):
+        path = cls._snapshot_path(digest)
+        if os.path.exists(path):
+            return
+        try:
+            data = json.dumps(spec._asdict())
+        except (TypeError, ValueError) as e: # a field that isn't JSON
+            log.debug(f"Couldn't snapshot {spec.source_file}: {e}")
+            return
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+            f.write(data)
+        os.rename(f.name, path)
+
+    @classmethod
+    def load(cls, root, public_only=False):
+        name, path, contents = cls._source(root, public_only)
+        digest = cls._digest(name, contents)
+        with cls._class_cache_lock:
+            LabType = cls._class_cache.get(digest)
+            if LabType is None:
+                spec = importlib.util.spec_from_file_location(name, path)
+                info = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(info)
+                log.debug(f"Imported {path}")
                 LabType = info.ThisLab
+                cls._class_cache[digest] = LabType
+                while len(cls._class_cache) > cls.MAX_CACHED_CLASSES:
+                    cls._class_cache.popitem(last=False)
+            else:
+                cls._class_cache.move_to_end(digest)
+
         r = LabType()
         # this should probably be passed to the constructor. This require adding **kwargs to the end of the super constructor call in lab.py for all the labs.
         r.source_file = os.path.abspath(path)
+        cls._write_snapshot(digest, r)
         return r
 
+    @classmethod
+    def load_snapshot(cls, root, public_only=False):
+        """
+        Like `load()`, but, if we've loaded this version of the lab before,
+        read its fields from a snapshot instead of executing lab.py.  The
+        result is a plain `LabSpec`, so it's only good for looking at
+        fields (e.g., for `runlab --info`), not for running the lab.
+        """
+        name, path, contents = cls._source(root, public_only)
+        try:
+            with open(cls._snapshot_path(cls._digest(name, contents))) as f:
+                r = LabSpec._fromdict(json.load(f))
+        except (FileNotFoundError, ValueError, MalformedObject):
+            return cls.load(root, public_only=public_only)
+        r.source_file = os.path.abspath(path)
+        return r
+
+def encode_files(files):
+    """
+    `files` maps names to raw bytes in memory.  JSON can't hold bytes, so
+    the old JSON format base64 encodes them.
+    """
+    if not isinstance(files, dict): # e.g., None or "<hidden>"
+        return files
+    return {k: base64.b64encode(v).decode('utf8') for k, v in files.items()}
+
+def file_names(files):
+    return sorted(files) if isinstance(files, dict) else files
+
+def decode_files(files):
+    if not isinstance(files, dict):
+        return files
+    return {k: v if isinstance(v, bytes) else base64.b64decode(v) for k, v in files.items()}
+
 class Submission(object):
 
     def __init__(self, lab_spec, files, env, command, #run_directory,
@@ -336,9 +421,10 @@ class Submission(object):
             self.user_directory = user_directory
             self.solution = solution
             
-    def _asdict(self):
+    def _asdict(self, with_files=True):
         t = {f:getattr(self, f) for f in self._fields}
         t['lab_spec'] = self.lab_spec._asdict()
+        t['files'] = encode_files(self.files) if with_files else file_names(self.files)
         return t
 
     @classmethod
@@ -346,6 +432,7 @@ class Submission(object):
         try:
             t = cls(**j)
             t.lab_spec = LabSpec(**t.lab_spec)
+            t.files = decode_files(t.files)
         except TypeError:
             raise MalformedObject
         else:
@@ -353,9 +440,9 @@ class Submission(object):
 
     def get_file(self, name):
         try: # this seems horribly wrong. We return either bytes or a string...
-            return base64.b64decode(self.files[name]).decode("utf8")
+            return self.files[name].decode("utf8")
         except UnicodeDecodeError:
-            return base64.b64decode(self.files[name])
+            return self.files[name]
 
     def write_inputs(self, directory=None):
         if not directory:
@@ -365,7 +452,7 @@ class Submission(object):
             os.makedirs(os.path.dirname(p), exist_ok=True)
             with open(p, "wb") as t:
                 log.debug(f"Writing data to {p}: {self.files[i][0:100]}")
-                t.write(base64.b64decode(self.files[i]))
+                t.write(self.files[i])
 
 def extract_from_first_csv_line_by_field(file_contents, field):
     reader = csv.DictReader(StringIO(file_contents))
@@ -379,7 +466,7 @@ class SubmissionResult(object):
     TIMEOUT = "timeout"
     MISSING_OUTPUT= "missing_output"
     ERROR = "error"
-    def __init__(self, submission, files, status, status_reasons, results=None, job_submission_data=None):
+    def __init__(self, submission, files, status, status_reasons, results=None, job_submission_data=None, timings=None):
         self.submission = submission
         #log.debug(f"{submission}")# {submission.__type__}  {submission.__type__.__name__}")
         assert isinstance(submission, Submission)
@@ -391,26 +478,48 @@ class SubmissionResult(object):
             self.results = {}
         else:
             self.results = results
+        # Spans from a Timing.SpanRecorder
+        self.timings = timings if timings is not None else []
+        # Full versions of files that we only keep part of in `files`.
+        # See OutputSpool.
+        self.spools = {}
+        self._spool_owners = []
+
+    def attach_spool(self, name, path, owner=None):
+        """
+        `path` holds the full version of file `name`.  `owner` (e.g., a
+        TemporaryDirectory) is kept alive as long as we are.
+        """
+        self.spools[name] = path
+        self._spool_owners.append(owner)
 
     def set_job_submission_data(self, data):
         self.job_submission_data = data
         
     def get_file(self, name):
         try: # this seems horribly wrong. We return either bytes or a string...
-            return base64.b64decode(self.files[name]).decode("utf8")
+            return self.files[name].decode("utf8")
         except UnicodeDecodeError:
-            return base64.b64decode(self.files[name])
+            return self.files[name]
     
     def put_file(self, name, contents):
-        self.files[name] = base64.b64encode(contents).decode('utf8')
+        self.files[name] = contents
+
+    def csv_table(self, name):
+        """
+        Output file `name`, parsed as a CSVTable.  It's parsed once, no
+        matter how many tests look at it.
+        """
+        return csv_table(self.get_file(name))
             
-    def _asdict(self):
-        return dict(submission=self.submission._asdict(),
-                    files=self.files,
+    def _asdict(self, with_files=True):
+        return dict(submission=self.submission._asdict(with_files=with_files),
+                    files=encode_files(self.files) if with_files else file_names(self.files),
                     status=self.status,
                     results=self.results,
                     job_submission_data=self.job_submission_data,
-                    status_reasons=self.status_reasons)
+                    status_reasons=self.status_reasons,
+                    timings=self.timings)
     
     def write_outputs(self, directory=None):
         log.debug(f"Writing {len(self.files)} outputs...")
@@ -424,21 +533,25 @@ class SubmissionResult(object):
             os.makedirs(d, exist_ok=True)
             with open(p, "wb") as t:
                 log.debug(f"Writing data to {p}: {self.files[i][0:100]}")
-                t.write(base64.b64decode(self.files[i]))
+                t.write(self.files[i])
                 
         with open(os.path.join(directory, "results.json"), "w") as t:
             log.debug(f"wrote {json.dumps(self.results, sort_keys=True, indent=4)}")
             t.write(json.dumps(self.results, sort_keys=True, indent=4))
         
     def build_file_zip_archive(self):
+        from zipfile import ZipFile
         out = io.BytesIO()
         zip_file = ZipFile(out,mode="w")
         
         for fn in self.files:
-            zip_file.writestr(fn, self.get_file(fn))
+            if fn in self.spools and os.path.exists(self.spools[fn]):
+                zip_file.write(self.spools[fn], fn)
+            else:
+                zip_file.writestr(fn, self.files[fn])
 
         for fn in self.submission.files:
-            zip_file.writestr(fn, self.submission.get_file(fn))
+            zip_file.writestr(fn, self.submission.files[fn])
         zip_file.close()
 
         return out.getvalue()
@@ -457,21 +570,151 @@ class SubmissionResult(object):
         try:
             if j['submission']:
                 j['submission'] = Submission._fromdict(j['submission'])
-            return cls(**j)
+            t = cls(**j)
+            t.files = decode_files(t.files)
+            return t
         except TypeError:
             raise MalformedObject
 
-def run_submission_by_proxy(proxy, submission):
-    import requests
-    
-    data = dict(submission=json.dumps(submission._asdict()))
+# Submissions and results travel between the runner, the daemon, the
+# proxy, and labtool as "envelopes": a zip file with a `manifest.json`
+# that holds everything but the file contents, plus one member per file
+# under `submission/` or `result/`.  Unlike the old JSON format, the
+# files aren't base64 encoded, and we can write and read them one at a
+# time.
+#
+# Since version 2, an envelope can, instead, refer to files by their
+# hash in a ContentStore (see the `content` section of the manifest).
+ENVELOPE_FORMAT = "archlab-envelope"
+ENVELOPE_VERSION = 2
+
+def _envelope_kind(cls):
+    return "result" if issubclass(cls, SubmissionResult) else "submission"
+
+def write_envelope(obj, f, content_store=None):
+    """
+    Write `obj` (a Submission or SubmissionResult) to `f`, a path or a
+    binary file.  If `content_store` is given, the file contents go
+    there, and the envelope just refers to them.
+    """
+    kind = _envelope_kind(type(obj))
+    if kind == "result":
+        members = [("submission", obj.submission.files), ("result", obj.files)]
+    else:
+        members = [("submission", obj.files)]
+
+    manifest = dict(format=ENVELOPE_FORMAT,
+                    version=ENVELOPE_VERSION,
+                    kind=kind,
+                    object=obj._asdict(with_files=False),
+                    content={})
+
+    from zipfile import ZipFile, ZIP_DEFLATED
+    with ZipFile(f, mode="w", compression=ZIP_DEFLATED) as z:
+        for prefix, files in members:
+            if not isinstance(files, dict):
+                continue
+            if content_store:
+                manifest['content'][prefix] = {name: content_store.put(contents) for name, contents in files.items()}
+            else:
+                for name, contents in files.items():
+                    z.writestr(f"{prefix}/{name}", contents)
+        z.writestr("manifest.json", json.dumps(manifest, sort_keys=True, indent=4))
+
+def _open_envelope(f):
+    """
+    Returns a seekable version of `f` and whether it's an envelope (rather than JSON).
+    """
+    if not (hasattr(f, "seekable") and f.seekable()): # e.g., stdin or a request body.  ZipFile needs to seek.
+        t = tempfile.SpooledTemporaryFile(max_size=16*1024*1024)
+        shutil.copyfileobj(f, t)
+        t.seek(0)
+        f = t
+        
+    start = f.tell()
+    magic = f.read(4)
+    f.seek(start)
+    return f, magic == b"PK\x03\x04"
+
+def _read_manifest(z, kind=None):
     try:
-        r = requests.post(f"{proxy}/jobs/submit-full", data=data,timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
-    except:
-        raise ArchlabTransientError("Unable to connect to proxy.  Please report this on piazza.  In the meantime, you can submit via gradescape.")
+        manifest = json.loads(z.read("manifest.json").decode("utf8"))
+    except KeyError:
+        raise MalformedObject("Envelope has no manifest")
+    if manifest.get('format') != ENVELOPE_FORMAT:
+        raise MalformedObject(f"Unknown envelope format: {manifest.get('format')}")
+    if manifest.get('version', 0) > ENVELOPE_VERSION:
+        raise MalformedObject(f"Envelope version {manifest.get('version')} is newer than I understand ({ENVELOPE_VERSION}).  Upgrade archcloud.")
+    if kind and manifest.get('kind') != kind:
+        raise MalformedObject(f"Expected a {kind} envelope, but got a {manifest.get('kind')} envelope")
+    return manifest
+
+def read_envelope(f, cls, content_store=None):
+    """
+    Read a `cls` (Submission or SubmissionResult) from `f`, a path or a
+    binary file.  It can also be in the old JSON format.  If the
+    envelope refers to files in a ContentStore, you need to pass it.
+    """
+    if isinstance(f, (str, Path)):
+        with open(f, "rb") as b:
+            return read_envelope(b, cls, content_store)
+
+    f, is_envelope = _open_envelope(f)
+    if not is_envelope:
+        return cls._fromdict(json.loads(f.read().decode("utf8")))
+
+    kind = _envelope_kind(cls)
+    from zipfile import ZipFile
+    with ZipFile(f) as z:
+        manifest = _read_manifest(z, kind)
+        content = manifest.get('content', {})
+        if content and not content_store:
+            raise MalformedObject("This envelope refers to a content store, but I don't have one")
         
-    #log.debug(f"Got response: {r}")
+        def load_files(prefix, names):
+            if not isinstance(names, list):
+                return names
+            digests = content.get(prefix, {})
+            return {n: content_store.get(digests[n]) if n in digests else z.read(f"{prefix}/{n}") for n in names}
+            
+        j = manifest['object']
+        if kind == "result":
+            j['files'] = load_files("result", j['files'])
+            if j['submission']:
+                j['submission']['files'] = load_files("submission", j['submission']['files'])
+        else:
+            j['files'] = load_files("submission", j['files'])
+
+    return cls._fromdict(j)
+
+def envelope_references(f):
+    """
+    Return the content digests that the envelope in `f` (a path or a
+    binary file) refers to.  Anything that isn't an envelope refers to
+    nothing.
+    """
+    if isinstance(f, (str, Path)):
+        with open(f, "rb") as b:
+            return envelope_references(b)
+    f, is_envelope = _open_envelope(f)
+    if not is_envelope:
+        return set()
+    from zipfile import ZipFile, BadZipFile
+    try:
+        with ZipFile(f) as z:
+            manifest = _read_manifest(z)
+    except (MalformedObject, BadZipFile):
+        return set() # e.g., the zip files we make for students to download.
+    return set(d for files in manifest.get('content', {}).values() for d in files.values())
+
+def read_proxy_response(r):
     r.raise_for_status()
+    if r.headers.get('Content-Type', "").startswith("application/zip"):
+        r.raw.decode_content = True
+        result = read_envelope(r.raw, SubmissionResult)
+        result.write_outputs(".")
+        return result
+
     response = r.json()
     if response['status'] == "SUCCESS":
         result = SubmissionResult._fromdict(response['result'])
@@ -480,40 +723,295 @@ def run_submission_by_proxy(proxy, submission):
     else:
         raise ArchlabError(response['reason'])
 
-    
-def run_repo_by_proxy(proxy, repo, branch, command):
+# How long we ask the proxy to hold a status request while it waits for
+# our job to finish.
+PROXY_LONG_POLL_SEC = 30
+
+# How many times in a row we'll retry if we can't reach the proxy while we wait.
+PROXY_RETRIES = 3
+
+def proxy_request(method, url, **kwargs):
     import requests
+    try:
+        return requests.request(method, url, **kwargs)
+    except Exception as e:
+        raise ArchlabTransientError(f"Unable to connect to proxy.  Please report this on piazza.  In the meantime, you can submit via gradescope: {e}")
+
+def wait_for_proxy_job(proxy, r):
+    """
+    `r` is the proxy's response to one of the `/jobs/async/` endpoints.
+    Wait for the job to finish and return its result.
+    """
+    r.raise_for_status()
+    response = r.json()
+    if response['status'] != "SUBMITTED":
+        raise ArchlabError(response['reason'])
+    job_id = response['job_id']
+    log.info(f"The proxy accepted job {job_id}")
+
+    failures = 0
+    while True:
+        try:
+            r = proxy_request("GET", f"{proxy}/jobs/{job_id}/status",
+                              params=dict(wait=PROXY_LONG_POLL_SEC),
+                              timeout=PROXY_LONG_POLL_SEC + 30)
+            r.raise_for_status()
+        except Exception as e:
+            failures += 1
+            if failures >= PROXY_RETRIES:
+                raise ArchlabTransientError(f"Lost contact with the proxy while waiting for job {job_id}: {e}")
+            log.warning(f"Couldn't get the status of job {job_id} from the proxy ({e}).  Trying again.")
+            time.sleep(5)
+            continue
+        failures = 0
+
+        status = r.json()
+        if status['status'] == "COMPLETED":
+            break
+        elif status['status'] == "FAILURE":
+            raise ArchlabError(status['reason'])
+        log.debug(f"Job progress: {job_id[:8]} is {status['job_status']}")
+
+    return read_proxy_response(proxy_request("GET", f"{proxy}/jobs/{job_id}/result", stream=True, timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC'])))
+
+def run_submission_by_proxy(proxy, submission):
+    with tempfile.TemporaryFile() as envelope:
+        write_envelope(submission, envelope)
+        envelope.seek(0)
+        r = proxy_request("POST", f"{proxy}/jobs/async/submit-envelope",
+                          data=envelope,
+                          headers={'Content-Type': "application/zip"},
+                          timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
+        if r.status_code == 404: # An older proxy.  Wait for it the old way.
+            envelope.seek(0)
+            r = proxy_request("POST", f"{proxy}/jobs/submit-envelope",
+                              data=envelope,
+                              headers={'Content-Type': "application/zip"},
+                              stream=True,
+                              timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
+            return read_proxy_response(r)
+
+    return wait_for_proxy_job(proxy, r)
+
     
+def run_repo_by_proxy(proxy, repo, branch, command):
     data = dict(repo=repo,
                 branch=branch,
-                command=command)
+                command=command,
+                format="envelope")
     log.debug(f"Sending data: {repr(data)}")
 
-
     j = json.dumps(data)
-    try:
-        r = requests.post(f"{proxy}/jobs/submit", data=dict(request=j),timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
-    except Exception as e:
-        raise ArchlabTransientError(f"Unable to connect to proxy.  Please report this on piazza.  In the meantime, you can submit via gradescape: {e}")
-        
+    r = proxy_request("POST", f"{proxy}/jobs/async/submit", data=dict(request=j), timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
     log.debug(f"Got response: {r}")
-    r.raise_for_status()
-    response = r.json()
-    if response['status'] == "SUCCESS":
-        result = SubmissionResult._fromdict(response['result'])
-        result.write_outputs(".")
-        return result
-    else:
-        raise ArchlabError(response['reason'])
+    if r.status_code == 404: # An older proxy.
+        return read_proxy_response(proxy_request("POST", f"{proxy}/jobs/submit", data=dict(request=j), stream=True, timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC'])))
+    return wait_for_proxy_job(proxy, r)
     
-def run_submission_remotely(submission, daemon=False):
+# How often to check the datastore while we wait for a job.  The
+# runner publishes to the job's reply topic when it finishes, so this
+# is just a safety net in case that message never arrives.
+COMPLETION_POLL_INTERVAL_SEC = 10
+
+def wait_for_completion_message(replies, seconds):
+    """
+    Block until a message arrives on `replies` or `seconds` pass.
+    Returns the messages, if any.
+    """
+    deadline = time.time() + seconds
+    while True:
+        messages = replies.pull(deadline=deadline)
+        if messages or time.time() >= deadline:
+            return messages
+
+def submit_remote_job(submission, job_id=None, reply_topic=None, timings=None):
+    """
+    Hand `submission` to the runners.  Returns the job's id once it's in
+    the datastore.  `check_remote_job()` tells you how it's doing, and
+    `collect_remote_result()` fetches the result when it's done.
+    """
     from .BlobStore import BlobStore
     from .DataStore import DataStore
     from .PubSub import Publisher, Subscriber
+    from .ContentStore import ContentStore
+
+    if timings is None:
+        timings = SpanRecorder()
+    if job_id is None:
+        job_id = str(uuid())
+
+    # cleanup local outputs.  This is mostly so can reliably
+    # test for the absence of particular outputs.
+    subprocess.call(submission.lab_spec.clean_cmd, cwd=submission.user_directory, env=job_environment(submission.env))
+
+    publisher = Publisher(topic=os.environ['PUBSUB_TOPIC'])
+
+    # there is a race between the creation of the first
+    # subscription and the first publication.  If the subscription
+    # is late, the published items are lost.  Creating a
+    # subscriber here fixes this.  We should never pull on this subscriber
+    Subscriber(name=os.environ['PUBSUB_SUBSCRIPTION'],
+               topic=os.environ['PUBSUB_TOPIC'])
+
+    ds = DataStore()
+    blobstore = BlobStore(os.environ['JOBS_BUCKET'])
+    content_store = ContentStore(blobstore)
+    with timings.span("upload_submission"), tempfile.NamedTemporaryFile(suffix=".zip") as envelope:
+        write_envelope(submission, envelope, content_store)
+        envelope.flush()
+        blobstore.upload_file(job_id, envelope.name, content_type="application/zip")
+    ds.push(
+        job_id,
+        output='',
+        status='SUBMITTED',
+        username=submission.username,
+        reply_topic=reply_topic
+    )
+
+    publisher.publish(job_id)
+
+    c = 0
+    while True:
+        log.info("Waiting for job to appear...")
+        job_data = ds.pull(
+            job_id=job_id
+        )
+        if job_data:
+            break
+        c +=1
+        if c > 20:
+            raise ArchlabError("I was not able to submit your job because the job spec never appeared in the datastore.  This is a problem with the autograder.  Try again.")
+        time.sleep(0.5)
+
+    log.info(f"Started job {job_id}.")
+    return job_id
+
+def check_remote_job(job_id, ds=None):
+    """
+    Returns the job's datastore entry if it has finished, or None if it's
+    still going.  Raises ArchlabError if it failed and JobTimedOut if it
+    has run for too long.  It doesn't change the job's record, so anyone
+    can ask.
+    """
+    import pytz
+    if ds is None:
+        from .DataStore import DataStore
+        ds = DataStore()
 
+    job_data = ds.pull(
+        job_id=job_id
+    )
+    if job_data is None:
+        log.error("Can't find job!")
+        raise ArchlabError(f"Couldn't find job: {job_id}")
+
+    log.debug(f"Job progress: {job_id[:8]} is {job_data['status']} on host {job_data['runner_host'] or '<na>'}")
+    running_time = (datetime.datetime.now(pytz.utc) - job_data['submitted_utc']).total_seconds()
+
+    if job_data['status'] == 'COMPLETED':
+        # A job that hit the lab's time limit finished, and has a result.
+        # This is the submitter giving up on it (see record_timeout()).
+        if job_data.get('timed_out_by_submitter'):
+            raise JobTimedOut(f"Your job ran for more than {os.environ['UNIVERSAL_TIMEOUT_SEC']} seconds, and was canceled", recorded=True)
+        return job_data
+    elif job_data['status'] == 'ERROR':
+        raise ArchlabError(f"Job failed after {running_time} seconds: {job_id}:\nstatus={job_data['status']}\n{'; '.join(job_data['status_reasons'])}")
+    elif job_data['status'] not in ['PREPARING', 'SUBMITTED', 'STARTED']:
+        raise ArchlabError(f"Job {job_id} in unknown state: '{job_data['status']}'")
+
+    if running_time > int(os.environ['UNIVERSAL_TIMEOUT_SEC']):
+        log.error(f'Job timed out after {running_time}s')
+        raise JobTimedOut(f"Your job ran for more than {os.environ['UNIVERSAL_TIMEOUT_SEC']} seconds, and was canceled", recorded=False)
+
+    return None
+
+def record_timeout(job_id, ds):
+    """
+    Record that we gave up on `job_id` because it ran for more than
+    UNIVERSAL_TIMEOUT_SEC, so `check_remote_job()` says so from now on.
+    """
+    import pytz
+    ds.update(job_id,
+              status="COMPLETED",
+              completed_utc=datetime.datetime.now(pytz.utc),
+              submission_status=SubmissionResult.TIMEOUT,
+              timed_out_by_submitter=True)
+
+def poll_remote_job(job_id, ds=None):
+    """
+    Like `check_remote_job()`, but if the job has run for too long,
+    record that it timed out (the first time we notice).
+    """
+    if ds is None:
+        from .DataStore import DataStore
+        ds = DataStore()
+    try:
+        return check_remote_job(job_id, ds)
+    except JobTimedOut as e:
+        if not e.recorded:
+            record_timeout(job_id, ds)
+        raise
+
+def wait_for_remote_job(job_id, replies=None, timings=None, ds=None, wait_for_completion=None):
+    """
+    Wait for the job to finish, record how it ended, and return its
+    SubmissionResult.  If `replies` is the job's reply subscription, we
+    wake up as soon as the runner says it's done.  Or, pass
+    `wait_for_completion(seconds)`, which waits until it might be.
+    """
+    import pytz
+    if ds is None:
+        from .DataStore import DataStore
+        ds = DataStore()
+    if wait_for_completion is None:
+        wait_for_completion = (lambda seconds: wait_for_completion_message(replies, seconds)) if replies else (lambda seconds: time.sleep(1))
+    start_time = time.time()
+    while True:
+        job_data = poll_remote_job(job_id, ds)
+        running_time = time.time() - start_time
+        if job_data:
+            break
+        wait_for_completion(min(COMPLETION_POLL_INTERVAL_SEC,
+                                max(1, int(os.environ['UNIVERSAL_TIMEOUT_SEC']) - running_time)))
+
+    log.info(f"Job finished after {running_time} seconds: {job_id}")
+    ds.update(job_id,
+              status="COMPLETED",
+              completed_utc=datetime.datetime.now(pytz.utc),
+              submission_status=SubmissionResult.SUCCESS)
+    return collect_remote_result(job_id, job_data, timings)
+
+def collect_remote_result(job_id, job_data, timings=None):
+    """
+    The SubmissionResult for a job that `check_remote_job()` says is
+    done.  This just reads it, so it's safe to call as often as you like.
+    """
+    from .BlobStore import BlobStore
+    from .DataStore import DataStore
+    from .ContentStore import ContentStore
+
+    if timings is None:
+        timings = SpanRecorder()
+    ds = DataStore()
+    blobstore = BlobStore(os.environ['JOBS_BUCKET'])
+    content_store = ContentStore(blobstore)
+
+    with timings.span("download_result"), tempfile.NamedTemporaryFile(suffix=".zip") as envelope:
+        blobstore.download_file(f"{job_id}-result", envelope.name)
+        r = read_envelope(envelope.name, SubmissionResult, content_store)
+    r.timings += timings.spans
+    r.set_job_submission_data(ds.convert_to_dict(job_data))  #it might be a Google data store entity, so convert it before storing it.
+    r.zip_archive = job_data['zip_archive']
+    return r
+
+def run_submission_remotely(submission, daemon=False, timings=None):
+    from .PubSub import Publisher, Subscriber
+
+    if timings is None:
+        timings = SpanRecorder()
     the_daemon = None
-    subscriber = None
-    publisher = None
+    reply_topic = None
+    replies = None
     log.info(f"Submitting remotely  {os.environ['IN_DEPLOYMENT']}")
     log.info(f"Submitting remotely  {os.environ['CLOUD_MODE']}")
     log.info(f"Submitting remotely  {os.environ['GOOGLE_RESOURCE_PREFIX']}")
@@ -529,116 +1027,36 @@ def run_submission_remotely(submission, daemon=False):
         else:
             the_daemon = None
 
-        with environment(**submission.env):
-            # cleanup local outputs.  This is mostly so can reliably
-            # test for the absence of particular outputs.
-            subprocess.call(submission.lab_spec.clean_cmd, cwd=submission.user_directory)
-
-        publisher = Publisher(topic=os.environ['PUBSUB_TOPIC'])
-        
-        # there is a race between the creation of the first
-        # subscription and the first publication.  If the subscription
-        # is late, the published items are lost.  Creating a
-        # subscriber here fixes this.  We should never pull on this subscriber
-        subscriber = Subscriber(name=os.environ['PUBSUB_SUBSCRIPTION'], 
-                                topic=os.environ['PUBSUB_TOPIC'])
-
-        ds = DataStore()
-
-        job_submission_json = json.dumps(submission._asdict(), sort_keys=True, indent=4)
-
-        job_id = str(uuid())
-
-        output = ''
-
-        blobstore = BlobStore(os.environ['JOBS_BUCKET'])
-        blobstore.write_file(job_id, job_submission_json)
-        ds.push(
-            job_id,
-            output='',
-            status='SUBMITTED',
-            username=submission.username
-        )
-
-        publisher.publish(job_id)
-
-        c = 0
-        while True:
-            log.info("Waiting for job to appear...")
-            job_data = ds.pull(
-                job_id=job_id
-            )
-            if job_data:
-                break
-            c +=1
-            if c > 20:
-                raise ArchlabError("I was not able to submit your job because the job spec never appeared in the datastore.  This is a problem with the autograder.  Try again.")
-            time.sleep(0.5)
-
-        start_time = time.time()
-
-        running_time = time.time() - start_time
-
-        log.info(f"Started job {job_id}.")
-        while True:
-
-            job_data = ds.pull(
-                job_id=job_id
-            )
-
-            running_time = time.time() - start_time
+        # The runner tells us when our job is done via this topic.
+        # Subscribe before we submit, so we can't miss it.
+        reply_topic = Publisher(topic=f"{os.environ['PUBSUB_TOPIC']}-reply", private_topic=True)
+        replies = Subscriber(topic=reply_topic.topic)
 
-            if running_time > int(os.environ['UNIVERSAL_TIMEOUT_SEC']):
-
-                log.error(f'Job timed out after {running_time}s')
-                ds.update(job_id,
-                          status="COMPLETED",
-                          completed_utc=datetime.datetime.now(pytz.utc),
-                          submission_status=SubmissionResult.TIMEOUT)
-                raise UserError(f"Your job ran for more than {os.environ['UNIVERSAL_TIMEOUT_SEC']} seconds, and was canceled")
-
-            if job_data is None:
-                log.error("Can't find job!")
-                raise ArchlabError(f"Couldn't find job: {job_id}")
-            else:
-                log.debug(f"Job progress: {job_id[:8]} is {job_data['status']} on host {job_data['runner_host'] or '<na>'}")
-
-                if job_data['status'] == 'COMPLETED':
-                    log.info(f"Job finished after {running_time} seconds: {job_id}")
-                    ds.update(job_id,
-                              status="COMPLETED",
-                              completed_utc=datetime.datetime.now(pytz.utc),
-                              submission_status=SubmissionResult.SUCCESS)
-
-                    r = SubmissionResult._fromdict(json.loads(blobstore.read_file(f"{job_id}-result")))
-                    r.set_job_submission_data(ds.convert_to_dict(job_data))  #it might be a Google data store entity, so convert it before storing it.
-                    r.write_outputs()
-                    r.zip_archive = job_data['zip_archive']
-                    return r
-                elif job_data['status'] == 'ERROR':
-                    raise ArchlabError(f"Job failed after {running_time} seconds: {job_id}:\nstatus={job_data['status']}\n{'; '.join(job_data['status_reasons'])}")
-                elif job_data['status'] == 'STARTED':
-                    pass  # keep running...
-                elif job_data['status'] == 'SUBMITTED':
-                    pass  # keep running...
-                else:
-                    raise ArchlabError(f"Job {job_id} in unknown state: '{job_data['status']}'")
-
-            time.sleep(1)
+        job_id = submit_remote_job(submission, reply_topic=reply_topic.topic, timings=timings)
+        r = wait_for_remote_job(job_id, replies, timings)
+        r.write_outputs()
+        return r
     finally:
+        replies and replies.delete_subscription()
+        reply_topic and reply_topic.delete_topic()
         if the_daemon:
             log.debug("Killing local daemon")
             the_daemon.terminate()
             the_daemon.wait()
             log.debug("Local daemon is dead.")
-            publisher and publisher.delete_topic(force=True)
-            subscriber and subscriber.delete_subscription(force=True)
+            Publisher(topic=os.environ['PUBSUB_TOPIC']).delete_topic(force=True)
+            Subscriber(name=os.environ['PUBSUB_SUBSCRIPTION'],
+                       topic=os.environ['PUBSUB_TOPIC']).delete_subscription(force=True)
             try:
                 del os.environ['PRIVATE_PUBSUB_NAMESPACE']
             except:
                 pass
                   
 
+# How much of a job's output we keep in its SubmissionResult.  The rest
+# is only in the zip archive.
+OUTPUT_VIEW_BYTES = 4*1024*1024
+
 def run_submission_locally(sub,
                            run_in_docker=False,
                            run_pristine=False,
@@ -647,8 +1065,15 @@ def run_submission_locally(sub,
                            write_outputs=True, # write outputs in addition to capturing them
                            docker_image=None,
                            verify_repo=True,
-                           user_directory_override=None):
-    out = StringIO()
+                           user_directory_override=None,
+                           docker_pool=None, # A DockerPool of warm containers to run in.
+                           timings=None, # A SpanRecorder
+                           clean=True): # Run the lab's clean_cmd first.  Turn it off to reuse an earlier build.
+    if timings is None:
+        timings = SpanRecorder()
+    # The result owns this, so the full output lives as long as it does.
+    spool_directory = tempfile.TemporaryDirectory(prefix="runlab-output-")
+    out = OutputSpool(os.path.join(spool_directory.name, "STDOUT.txt"))
     err = StringIO()
     result_files = {}
     root = sub.user_directory
@@ -660,16 +1085,14 @@ def run_submission_locally(sub,
 
         r = SubmissionResult.SUCCESS
         reasons = []
-        output, errout = b"", b""
+        pump = None
         
         try:
             p = subprocess.Popen(cmd, *args, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
-            
+            pump = out.start_pump(p.stdout)
             
             log.debug(f"Timeout is {timeout}")
-            output1, errout1 = p.communicate(timeout=timeout)
-            output += output1 or b""
-            errout += errout1 or b""
+            p.wait(timeout=timeout)
             
             log.info(f"Execution completed with result: {p.returncode}")
             if p.returncode != 0:
@@ -680,11 +1103,8 @@ def run_submission_locally(sub,
 
             # clean up: https://docs.python.org/3/library/subprocess.html
             p.kill()
-            output2, errout2 = p.communicate()
+            p.wait()
 
-            output += output2 or b""
-            errout += errout2 or b""
-            
             r = SubmissionResult.TIMEOUT
             reasons.append(f"Execution of {args} timedout after {timeout} seconds on {platform.node()}.")
             try:
@@ -695,8 +1115,8 @@ def run_submission_locally(sub,
             r = SubmissionResult.ERROR
             reasons.append(f"An error occcurred while running your program: {repr(e)}.")
         finally:
-            out.write(output.decode("utf-8"))
-            err.write(errout.decode("utf-8"))
+            if pump:
+                out.finish_pump(pump)
             
         return r, reasons
 
@@ -729,30 +1149,41 @@ def run_submission_locally(sub,
     with directory_or_tmp(root if not run_pristine else None) as dirname:
         try:
             if run_pristine:
-                repo = sub.lab_spec.repo
-                if "GITHUB_OAUTH_TOKEN" in os.environ and "http" in repo and "@" not in repo:
-                    repo = repo.replace("//", f"//{os.environ['GITHUB_OAUTH_TOKEN']}@", 1)
-                log.info("Cloning lab reference files...")
-                r, reasons = log_run(cmd=['git', 'clone', '-b', sub.lab_spec.reference_tag, repo , dirname])
-                if r != SubmissionResult.SUCCESS:
-                    raise  ArchlabError(f"Clone for pristine execution failed: {reasons}")
+                with timings.span("clone"):
+                    repo = authenticated_repo(sub.lab_spec.repo)
+                    log.info("Cloning lab reference files...")
+                    cloned = False
+                    if RepoCache.enabled():
+                        try:
+                            RepoCache().clone(repo, dirname, sub.lab_spec.reference_tag)
+                            cloned = True
+                        except Exception as e:
+                            log.warning(f"Couldn't clone from the repo cache ({e}).  Cloning directly.")
+                            shutil.rmtree(dirname, ignore_errors=True)
+                            os.makedirs(dirname, exist_ok=True)
+                    if not cloned:
+                        r, reasons = log_run(cmd=['git', 'clone', '-b', sub.lab_spec.reference_tag, repo , dirname])
+                        if r != SubmissionResult.SUCCESS:
+                            raise  ArchlabError(f"Clone for pristine execution failed: {reasons}")
 
             sub.lab_spec = LabSpec.load(dirname) # distrust submitters spec by loading the pristine one from the newly cloned repo.
             if run_pristine:
                 # we just dumped the files in '.' so, look for them there.
                 sub.env['LAB_SUBMISSION_DIR'] = '.'
             else:
-                with environment(**sub.env):
-                    log_run(sub.lab_spec.clean_cmd, cwd=dirname)
+                if clean:
+                    with timings.span("clean"):
+                        log_run(sub.lab_spec.clean_cmd, cwd=dirname, env=job_environment(sub.env))
                 os.makedirs(os.path.join(dirname, ".tmp"),exist_ok=True)
                 sub.env['LAB_SUBMISSION_DIR'] = ".tmp"
 
-            for f in sub.files:
-                path = os.path.join(dirname, sub.env['LAB_SUBMISSION_DIR'], f)
-                os.makedirs(os.path.dirname(path),exist_ok=True)
-                with open(path, "wb") as of:
-                    log.debug("Writing input file {}".format(path))
-                    of.write(base64.b64decode(sub.files[f]))
+            with timings.span("write_inputs"):
+                for f in sub.files:
+                    path = os.path.join(dirname, sub.env['LAB_SUBMISSION_DIR'], f)
+                    os.makedirs(os.path.dirname(path),exist_ok=True)
+                    with open(path, "wb") as of:
+                        log.debug("Writing input file {}".format(path))
+                        of.write(sub.files[f])
 
             # filter the environment with the clean lab_spec
             log.debug(f"Incoming env: {sub.env}")
@@ -763,67 +1194,77 @@ def run_submission_locally(sub,
             log.debug(f"Filtered env: {sub.env}")
             sub.lab_spec.validate_environment (sub.env)
             
-            # If we run in a docker, just serialize the submission and pass it via the file system.
-            if run_in_docker:
-                assert dirname[:8] == "/staging", f"{dirname} doesn't appear to be a /staging directory"
-                id = str(uuid())
-                os.makedirs(os.path.join("/staging", id), exist_ok=False)
-                status_path = os.path.join("/staging",id, "status.json")
-
-                cgroup = subprocess.check_output("tail -1 /proc/self/cgroup".split())
-                my_container_id = cgroup.decode("utf8").split("/")[-1]
-                if my_container_id.strip() == "":
-                    log.error(f"Couldn't get my container id.  Output was: {cgroup}")
-                    log.error("cat /proc/self/cgroup: ")
-                    log.error(subprocess.check_output("cat /proc/self/cgroup".split()))
-
-                log.info(f"my container id is: {my_container_id}")
-                log.info("Docker starts...")
-
-                env = reduce(lambda x,y:x+y, map(lambda x:["--env", f"{x[0]}={x[1]}"], sub.env.items()))
-                status, reasons = log_run(cmd=
-                                          ["docker", "run",
-                                           "--hostname", f"{platform.node()}-runner",
-                                           "--volumes-from", my_container_id.strip(),
-                                           "--name", f"job-{id[:8]}",
-                                          ] +
-                                          env +
-                                          (["--volume", "/home/swanson/cse141pp-archlab/archcloud/src:/course/cse141pp-archlab/archcloud/src"] if "USE_LOCAL_ARCHCLOUD" in os.environ else [])+
-                                          ["-w", dirname,
-                                           "--privileged",
-                                           docker_image,
-                                           "runlab", '--no-validate',  '--solution', '.',
-                                           '--debug', '--json-status', status_path, '--directory', dirname, "--quieter"] +
-                                          (['-v'] if (log.getLogger().getEffectiveLevel() < log.INFO) else []) +
-                                          ["--"] + sub.command,
-                                          timeout=sub.lab_spec.time_limit)
-                
-                log_run(f"docker container stop job-{id[:8]}".split())
-                log_run(f"docker container rm job-{id[:8]}".split())
-                log.info("Docker finished")
-
-                if os.path.exists(status_path):
-                    with open(status_path, "r") as s:
-                        json_status = json.loads(s.read())
-                        if json_status['exit_code'] != 0:
-                            reasons.append(f"From runlab in docker: {json_status['status_str']}")
-                    os.remove(status_path)
+            with timings.span("run"):
+                # If we run in a docker, just serialize the submission and pass it via the file system.
+                if run_in_docker:
+                    assert dirname[:8] == "/staging", f"{dirname} doesn't appear to be a /staging directory"
+                    id = str(uuid())
+                    os.makedirs(os.path.join("/staging", id), exist_ok=False)
+                    status_path = os.path.join("/staging",id, "status.json")
+
+                    runlab_args = (['--no-validate',  '--solution', '.',
+                                    '--debug', '--json-status', status_path, '--directory', dirname, "--quieter"] +
+                                   (['-v'] if (log.getLogger().getEffectiveLevel() < log.INFO) else []) +
+                                   ["--"] + sub.command)
+
+                    ran_warm = False
+                    if docker_pool:
+                        try:
+                            exit_code = docker_pool.run(runlab_args, sub.env, dirname, out, timeout=sub.lab_spec.time_limit)
+                        except subprocess.TimeoutExpired:
+                            log.error(f"Execution timed out after {sub.lab_spec.time_limit} seconds.")
+                            ran_warm = True
+                            status, reasons = SubmissionResult.TIMEOUT, [f"Execution of {sub.command} timedout after {sub.lab_spec.time_limit} seconds on {platform.node()}."]
+                        else:
+                            ran_warm = exit_code is not None
+                            if exit_code is None:
+                                log.info("No warm runner available.  Starting a new container.")
+                            elif exit_code == 0:
+                                status, reasons = SubmissionResult.SUCCESS, []
+                            else:
+                                status, reasons = SubmissionResult.ERROR, [f"""Execution of {sub.command} completed with result {exit_code}, which usually indicates failure.  Look at STDERR and STDOUT for more information."""]
+
+                    if not ran_warm:
+                        log.info("Docker starts...")
+                        env = reduce(lambda x,y:x+y, map(lambda x:["--env", f"{x[0]}={x[1]}"], sub.env.items()), [])
+                        status, reasons = log_run(cmd=
+                                                  ["docker", "run",
+                                                   "--name", f"job-{id[:8]}",
+                                                  ] +
+                                                  docker_run_options() +
+                                                  env +
+                                                  ["-w", dirname,
+                                                   docker_image,
+                                                   "runlab"] +
+                                                  runlab_args,
+                                                  timeout=sub.lab_spec.time_limit)
+
+                        log_run(f"docker container stop job-{id[:8]}".split())
+                        log_run(f"docker container rm job-{id[:8]}".split())
+                        log.info("Docker finished")
+
+                    if os.path.exists(status_path):
+                        with open(status_path, "r") as s:
+                            json_status = json.loads(s.read())
+                            if json_status['exit_code'] != 0:
+                                reasons.append(f"From runlab in docker: {json_status['status_str']}")
+                        os.remove(status_path)
 
-            else:
-                # Run the job!
-                with environment(**sub.env):
-                    status, reasons = log_run(sub.command, cwd=dirname, timeout=sub.lab_spec.time_limit)
+                else:
+                    # Run the job!
+                    status, reasons = log_run(sub.command, cwd=dirname, env=job_environment(sub.env), timeout=sub.lab_spec.time_limit)
                 
                     #log.debug(f"Directory contents\n{list(Path(dirname).glob('**'))}")
-            for f in sub.lab_spec.output_files:
-                log.debug(f"Searching for output files matching '{f}'")
-                for filename in Path(dirname).glob(f):
-                    if os.path.isfile(filename):
-                        with open(filename, "rb") as r:
-                            key = filename.relative_to(dirname)
-                            log.debug(f"Reading output file (storing as '{key}') {filename}.")
-                            t = str(key)
-                            result_files[t] = base64.b64encode(r.read()).decode('utf8')
+            with timings.span("collect_outputs"):
+                for f in sub.lab_spec.output_files:
+                    log.debug(f"Searching for output files matching '{f}'")
+                    for filename in Path(dirname).glob(f):
+                        if os.path.isfile(filename):
+                            with open(filename, "rb") as r:
+                                key = filename.relative_to(dirname)
+                                log.debug(f"Reading output file (storing as '{key}') {filename}.")
+                                t = str(key)
+                                result_files[t] = r.read()
 
         except TypeError:
             raise
@@ -840,29 +1281,44 @@ def run_submission_locally(sub,
                 reasons.append(f"{traceback.format_exc()}\nAutograder caught an exception during execution.:{repr(e)}.\nThis probably not a bug in your submission.")
             
         try:
-            result_files['STDOUT.txt'] = base64.b64encode(out.getvalue().encode('utf8')).decode('utf8')
-            result_files['STDERR.txt'] = base64.b64encode(err.getvalue().encode('utf8')).decode('utf8')
-            log.debug("STDOUT: \n{}".format(out.getvalue()))
+            stdout = out.view(OUTPUT_VIEW_BYTES)
+            result_files['STDOUT.txt'] = stdout.encode('utf8')
+            result_files['STDERR.txt'] = err.getvalue().encode('utf8')
+            log.debug("STDOUT: \n{}".format(stdout))
             log.debug("STDOUT_ENDS")
             log.debug("STDERR: \n{}".format(err.getvalue()))
             log.debug("STDERR_ENDS")
             result = SubmissionResult(sub, result_files, status, reasons)
-            result.results['gradescope_test_output'] = sub.lab_spec.run_gradescope_tests(result, dirname)
+            result.attach_spool('STDOUT.txt', out.path, spool_directory)
+            result.timings = timings.spans
+            with timings.span("gradescope_tests"):
+                result.results['gradescope_test_output'] = sub.lab_spec.run_gradescope_tests(result, dirname)
             if write_outputs:
-                result.write_outputs()
+                with timings.span("write_outputs"):
+                    result.write_outputs()
         except Exception as e:
             exc_type, exc_value, exc_tb = sys.exc_info()
             log.error("\n".join(traceback.format_exception(exc_type, exc_value, exc_tb)))
             log.error(repr(e))
-            result_files['exception'] = base64.b64encode(repr(e).encode('utf8')).decode('utf8')
+            result_files['exception'] = repr(e).encode('utf8')
             result = SubmissionResult(sub,
                                       result_files,
                                       SubmissionResult.ERROR,
                                       [f'Something went wrong while preparing the submission response.  This a bug or error in the autograder: {repr(e)}'])
+            result.attach_spool('STDOUT.txt', out.path, spool_directory)
             
     return result
     
 
+def authenticated_repo(repo):
+    """
+    `repo` with $GITHUB_OAUTH_TOKEN in the url, if it's an http one.
+    """
+    if "GITHUB_OAUTH_TOKEN" in os.environ and "http" in repo and "@" not in repo:
+        repo = repo.replace("//", f"//{os.environ['GITHUB_OAUTH_TOKEN']}@", 1)
+        log.debug(f"rewriting repo with token: {repo}")
+    return repo
+
 def remove_outputs(dirname, submission):
     for i in submission.lab_spec.output_files:
         if os.path.exists(path) and os.path.isfile(path):
@@ -877,40 +1333,55 @@ def build_submission(user_directory,
                      public_only=False,
                      repo=None,
                      branch=None,
-                     options=None):
-
-    if (repo or branch) and not pristine:
-        raise UserError("You can't pass a repo or a branch without passing pristine")
+                     commit=None, # Check out this commit on `branch`.
+                     options=None,
+                     timings=None): # A SpanRecorder
+    if timings is None:
+        timings = SpanRecorder()
+
+    if (repo or branch or commit) and not pristine:
+        raise UserError("You can't pass a repo, a branch, or a commit without passing pristine")
     
 
     if pristine:
         if repo is None:
             repo = user_directory
             
-        if repo and "GITHUB_OAUTH_TOKEN" in os.environ and "http" in repo and "@" not in repo:
-            repo = repo.replace("//", f"//{os.environ['GITHUB_OAUTH_TOKEN']}@", 1)
-            log.debug(f"rewriting repo with token: {repo}")
+        if repo:
+            repo = authenticated_repo(repo)
                         
             
-        try:
-            log.debug(f"Checking for repo '{repo}' on branh '{branch}'")
-            log.debug(str(["git", "ls-remote", "--heads", repo, branch]))
-            subprocess.check_call(["git", "ls-remote", "--heads", repo, (branch if branch else "")])
-        except Exception as e:
-            raise UserError(f"Branch {branch} doesn't exist (did you push it?): {e}")
-    
-    with tempfile.TemporaryDirectory(dir="/tmp/") as run_directory:
-        if pristine:
+        use_cache = RepoCache.enabled() and RepoCache.is_remote(repo)
+        with timings.span("check_branch"):
             try:
-                log.info(f"Cloning {repo} on branch {branch} to get the version in git...")
-                if branch is None:
-                    subprocess.check_call(["git", "clone", repo, run_directory])
+                log.debug(f"Checking for repo '{repo}' on branh '{branch}'")
+                if use_cache:
+                    if branch and not RepoCache().has_branch(repo, branch):
+                        raise UserError(f"No branch named {branch}")
                 else:
-                    subprocess.check_call(["git", "clone", "-b", branch, repo, run_directory])
-
+                    log.debug(str(["git", "ls-remote", "--heads", repo, branch]))
+                    subprocess.check_call(["git", "ls-remote", "--heads", repo, (branch if branch else "")])
             except Exception as e:
-                log.error(f"Tried to clone `{repo}` into '{run_directory}' for pristine execution, but failed: {repr(e)}")
-                raise UserError("Tried to clone `{repo}` into '{run_directory}' for pristine execution, but failed: {repr(e)}")
+                raise UserError(f"Branch {branch} doesn't exist (did you push it?): {e}")
+    
+    with tempfile.TemporaryDirectory(dir="/tmp/") as run_directory:
+        if pristine:
+            with timings.span("build_clone"):
+                try:
+                    log.info(f"Cloning {repo} on branch {branch} to get the version in git...")
+                    if use_cache:
+                        # has_branch() just refreshed the mirror, so don't fetch again.
+                        RepoCache().clone(repo, run_directory, branch if branch else None, fetch=branch is None)
+                    elif branch is None:
+                        subprocess.check_call(["git", "clone", repo, run_directory])
+                    else:
+                        subprocess.check_call(["git", "clone", "-b", branch, repo, run_directory])
+                    if commit:
+                        subprocess.check_call(["git", "checkout", "-q", commit], cwd=run_directory)
+
+                except Exception as e:
+                    log.error(f"Tried to clone `{repo}` into '{run_directory}' for pristine execution, but failed: {repr(e)}")
+                    raise UserError("Tried to clone `{repo}` into '{run_directory}' for pristine execution, but failed: {repr(e)}")
             
         else:
             run_directory = user_directory
@@ -963,26 +1434,27 @@ def build_submission(user_directory,
         if not good_command:
             raise UserError(f"This command is not allowed ({error}): {command}")
 
-        for f in spec.input_files:
-            full_path = os.path.join(run_directory, input_dir)
-            log.debug(f"Looking for files matching '{f}' in '{full_path}'.")
-            for filename in Path(full_path).glob(f):
-                if not  os.path.isfile(filename):
-                    log.debug(f"Skipping '{filename}' since it's a directory.")
-                    continue
-                if os.path.split(filename)[1][:1] == "." and f[:1] != ".":  
-                    log.debug(f"Skipping '{filename}' since it's a hidden file.  To include add a pattern for it starting with '.'.")
-                    continue
-                log.debug(f"Found file '{filename}' matching '{f}'.")
-                try:
-                    with open(filename, "rb") as o:
-                        log.debug(f"Reading input file '{filename}'")
-                        key = filename.relative_to(full_path)
-                        log.debug(f"Storing as '{str(key)}'")
-                        files[str(key)] = base64.b64encode(o.read()).decode('utf8')
-                        log.info(f"Found input file '{filename}'")
-                except Exception:
-                    raise UserError(f"Couldn't open input file '{filename}'.")
+        with timings.span("collect_inputs"):
+            for f in spec.input_files:
+                full_path = os.path.join(run_directory, input_dir)
+                log.debug(f"Looking for files matching '{f}' in '{full_path}'.")
+                for filename in Path(full_path).glob(f):
+                    if not  os.path.isfile(filename):
+                        log.debug(f"Skipping '{filename}' since it's a directory.")
+                        continue
+                    if os.path.split(filename)[1][:1] == "." and f[:1] != ".":  
+                        log.debug(f"Skipping '{filename}' since it's a hidden file.  To include add a pattern for it starting with '.'.")
+                        continue
+                    log.debug(f"Found file '{filename}' matching '{f}'.")
+                    try:
+                        with open(filename, "rb") as o:
+                            log.debug(f"Reading input file '{filename}'")
+                            key = filename.relative_to(full_path)
+                            log.debug(f"Storing as '{str(key)}'")
+                            files[str(key)] = o.read()
+                            log.info(f"Found input file '{filename}'")
+                    except Exception:
+                        raise UserError(f"Couldn't open input file '{filename}'.")
 
         if config_file:
             path = os.path.join(run_directory,
@@ -1046,6 +1518,89 @@ def test_run():
     assert result.status == n.status
     assert result.results == n.results
 
+    phases = [s['name'] for s in n.timings]
+    assert "run" in phases and "collect_outputs" in phases
+
+
+def test_wait_for_completion_message():
+    from .PubSub import Publisher, Subscriber
+    with Publisher(topic="test-reply", private_topic=True) as topic:
+        with Subscriber(topic=topic.topic) as replies:
+            start = time.time()
+            assert wait_for_completion_message(replies, 2) == []
+            assert time.time() - start >= 2
+            Publisher(topic=topic.topic, create_if_missing=False).publish("done")
+            assert wait_for_completion_message(replies, 10) == ["done"]
+
+def test_check_remote_job():
+    import pytest
+    import pytz
+    from .DataStore import DataStore
+    ds = DataStore(namespace="testing-junk")
+    with environment(UNIVERSAL_TIMEOUT_SEC="60"):
+        job_id = str(uuid())
+        ds.push(job_id, output='', status='PREPARING', username="a@b.c")
+        assert check_remote_job(job_id, ds) is None
+        ds.update(job_id, status='STARTED')
+        assert check_remote_job(job_id, ds) is None
+        ds.update(job_id, status='COMPLETED')
+        assert check_remote_job(job_id, ds)['status'] == 'COMPLETED'
+
+        # Hitting the lab's time limit is a result like any other.
+        ds.update(job_id, submission_status=SubmissionResult.TIMEOUT)
+        assert check_remote_job(job_id, ds)['submission_status'] == SubmissionResult.TIMEOUT
+
+        ds.update(job_id, status='ERROR', status_reasons=["it broke"])
+        with pytest.raises(ArchlabError, match="it broke"):
+            check_remote_job(job_id, ds)
+
+        ds.update(job_id, status='STARTED', submitted_utc=datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds=61))
+        with pytest.raises(JobTimedOut) as e:
+            check_remote_job(job_id, ds)
+        assert not e.value.recorded
+        assert ds.pull(job_id)['status'] == 'STARTED' # Just looking doesn't change it.
+
+        with pytest.raises(JobTimedOut):
+            wait_for_remote_job(job_id, ds=ds)
+        assert ds.pull(job_id)['timed_out_by_submitter']
+        with pytest.raises(JobTimedOut) as e:
+            check_remote_job(job_id, ds)
+        assert e.value.recorded
+
+        with pytest.raises(ArchlabError):
+            check_remote_job(str(uuid()), ds)
+
+def test_run_caps_output():
+    from zipfile import ZipFile
+    sub = build_submission("test_inputs", ".", config_file = "config-good", command=["seq", "2000000"])
+    result = run_submission_locally(sub,
+                                    run_in_docker = False,
+                                    run_pristine = False,
+                                    docker_image = None,
+                                    write_outputs = False)
+    assert result.status == SubmissionResult.SUCCESS
+    stdout = result.get_file("STDOUT.txt")
+    assert len(stdout) < OUTPUT_VIEW_BYTES + 1024
+    assert "omitted" in stdout
+    assert stdout.endswith("2000000\n")
+
+    # The archive has all of it.
+    with ZipFile(io.BytesIO(result.build_file_zip_archive())) as z:
+        full = z.read("STDOUT.txt").decode("utf8")
+    assert "omitted" not in full
+    assert full.endswith("1999999\n2000000\n")
+
+def test_run_leaves_process_state_alone():
+    sub = build_submission("test_inputs", ".", config_file = "config-good", command=["true"])
+    sub.env['C_OPTS'] = "yes"
+    env = dict(os.environ)
+    cwd = os.getcwd()
+    run_submission_locally(sub,
+                           run_in_docker = False,
+                           run_pristine = False,
+                           docker_image = None)
+    assert dict(os.environ) == env
+    assert os.getcwd() == cwd
     
 def test_lab_spec():
     spec = LabSpec.load("test_inputs")
@@ -1055,10 +1610,49 @@ def test_lab_spec():
     for f in spec._fields:
         assert getattr(n, f) == getattr(spec, f), f"Field '{f}' doesn't match";
 
+def test_lab_spec_cache():
+    with tempfile.TemporaryDirectory() as d, environment(ARCHLAB_CACHE_DIR=os.path.join(d, "cache")):
+        lab = os.path.join(d, "lab")
+        shutil.copytree("test_inputs", lab)
+        a = LabSpec.load(lab)
+        b = LabSpec.load(lab)
+        assert type(a) is type(b)
+        assert a is not b
+
+        snapshot = LabSpec.load_snapshot(lab)
+        assert type(snapshot) is LabSpec
+        for f in a._fields:
+            if f != "loaded_on_host":
+                assert getattr(snapshot, f) == getattr(a, f), f"Field '{f}' doesn't match"
+
+        # A new version gets executed.
+        with open(os.path.join(lab, "lab.py"), "a") as f:
+            f.write("\n# changed\n")
+        c = LabSpec.load(lab)
+        assert type(c) is not type(a)
+
+        # Old versions drop out once there are too many newer ones.
+        for i in range(LabSpec.MAX_CACHED_CLASSES):
+            with open(os.path.join(lab, "lab.py"), "a") as f:
+                f.write(f"\n# changed {i}\n")
+            LabSpec.load(lab)
+        assert len(LabSpec._class_cache) <= LabSpec.MAX_CACHED_CLASSES
+        assert type(a) not in LabSpec._class_cache.values()
+
+def test_csv_helpers():
+    spec = LabSpec.load("test_inputs")
+    contents = "function,IC,CPI\nfoo,10,1.5\nbar,20,2\n"
+    assert spec.csv_extract_by_line(contents, "IC") == 10
+    assert spec.csv_extract_by_line(contents, "function", line=1) == "bar"
+    assert spec.csv_extract_by_line(contents, "IC", line=2) is None
+    assert spec.csv_extract_by_lookup(contents, dict(function="bar"), "CPI") == 2
+    assert spec.csv_extract_by_lookup(contents, dict(function="baz"), "CPI") is None
+    assert list(spec.csv_column_values(contents, "IC")) == [10, 20]
+
 def test_build_result():
     with environment(FOO="BAR", C_OPTS="yes"):
         sub = build_submission("test_inputs", ".", config_file = "config-good", command=["true"])
-        r = SubmissionResult(sub, dict(t="stuff"), SubmissionResult.SUCCESS, [])
+        r = SubmissionResult(sub, dict(t=b"stuff"), SubmissionResult.SUCCESS, [])
         d = r._asdict()
         j = json.loads(json.dumps(d))
         n = SubmissionResult._fromdict(j)
@@ -1066,8 +1660,62 @@ def test_build_result():
         assert r.status == n.status
         assert r.files == n.files
         
+def test_envelope():
+    import pytest
+    from zipfile import ZipFile
+    sub = build_submission("test_inputs", ".", config_file = "config-good", command=["true"])
+    r = SubmissionResult(sub, {"t": b"stuff", "bin/blob": b"\x00\xff\xfe"}, SubmissionResult.SUCCESS, ["ok"], results=dict(a=1))
+
+    for obj, cls in [(sub, Submission), (r, SubmissionResult)]:
+        f = io.BytesIO()
+        write_envelope(obj, f)
+        f.seek(0)
+        n = read_envelope(f, cls)
+        assert n.files == obj.files
+        assert n._asdict() == obj._asdict()
+
+    # The old JSON format still works.
+    f = io.BytesIO(json.dumps(r._asdict()).encode("utf8"))
+    assert read_envelope(f, SubmissionResult).files == r.files
+
+    # so do unseekable streams.
+    class Unseekable(io.BytesIO):
+        def seekable(self):
+            return False
+    f = io.BytesIO()
+    write_envelope(r, f)
+    n = read_envelope(Unseekable(f.getvalue()), SubmissionResult)
+    assert n.submission.files == sub.files
+
+    with pytest.raises(MalformedObject):
+        f = io.BytesIO()
+        write_envelope(sub, f)
+        f.seek(0)
+        read_envelope(f, SubmissionResult)
+
+    # With a content store, the envelope just refers to the contents.
+    from .BlobStore import BlobStore
+    from .ContentStore import ContentStore
+    with tempfile.TemporaryDirectory() as d:
+        content_store = ContentStore(BlobStore("envelope-test"), cache_dir=d)
+        f = io.BytesIO()
+        write_envelope(r, f, content_store)
+        f.seek(0)
+        assert envelope_references(f) == set(map(ContentStore.digest, list(r.files.values()) + list(sub.files.values())))
+        f.seek(0)
+        with ZipFile(f) as z:
+            assert z.namelist() == ["manifest.json"]
+        f.seek(0)
+        n = read_envelope(f, SubmissionResult, content_store)
+        assert n.files == r.files
+        assert n.submission.files == sub.files
+        f.seek(0)
+        with pytest.raises(MalformedObject):
+            read_envelope(f, SubmissionResult)
+
         
 def test_build_submission():
+    import pytest
     with environment(FOO="BAR", C_OPTS="yes"):
         sub = build_submission("test_inputs", ".", config_file = "config-good", command=["true"])
 
@@ -1101,6 +1749,7 @@ def test_build_submission():
         sub = build_submission("test_inputs", ".", config_file="config-bad", command=["true"])
 
 def test_configs_validation():
+    import pytest
         
     def test_good():
         spec = LabSpec.load("test_inputs")
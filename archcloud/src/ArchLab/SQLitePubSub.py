@@ -0,0 +1,264 @@
+"""
+Pub/sub emulation in a single SQLite database (CLOUD_MODE=EMULATION_SQLITE).
+
+LocalPubSub keeps a file per message, so every pull is a directory scan
+and delivery order is arbitrary.  This keeps topics, subscriptions, and
+messages in one WAL-mode database, and delivers each subscription's
+messages in the order they were published, using an index.  Leases work
+like LocalPubSub's: a pulled message comes back after its ack deadline
+unless it's acknowledged, and goes to the dead letters after
+`max_delivery_attempts` deliveries.
+"""
+import os
+import time
+import sqlite3
+import threading
+import logging as log
+from uuid import uuid4 as uuid
+from collections import namedtuple
+
+from .BasePubSub import BasePublisher, BaseSubscriber, AlreadyExists, NotFound, DeadlineExceeded, do_test_publisher, do_test_subscriber
+
+# How long a subscriber has to acknowledge a message before we deliver it again.
+ACK_DEADLINE_SEC = 60
+
+# How often a waiting pull checks for new messages.
+POLL_INTERVAL_SEC = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS topics (path TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS subscriptions (path TEXT PRIMARY KEY,
+                                          topic TEXT NOT NULL,
+                                          ack_deadline_seconds REAL NOT NULL,
+                                          max_delivery_attempts INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS subscriptions_by_topic ON subscriptions (topic);
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                     subscription TEXT NOT NULL,
+                                     data BLOB NOT NULL,
+                                     deliveries INTEGER NOT NULL DEFAULT 0,
+                                     lease_expires REAL NOT NULL DEFAULT 0,
+                                     dead INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS messages_by_subscription ON messages (subscription, dead, id);
+"""
+
+_connections = threading.local()
+
+class SQLitePubSubAgent(object):
+
+    def __init__(self, *argc, **kwargs):
+        log.debug("SQLitePubSubAgent Constructor")
+
+    @classmethod
+    def get_database_path(cls):
+        return os.path.join(os.environ['EMULATION_DIR'], os.environ['GOOGLE_CLOUD_PROJECT'], "pubsub.sqlite3")
+
+    @classmethod
+    def db(cls):
+        """
+        This thread's connection to the database.
+        """
+        path = cls.get_database_path()
+        if not hasattr(_connections, "by_path"):
+            _connections.by_path = {}
+        if path not in _connections.by_path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            c = sqlite3.connect(path, timeout=30, isolation_level=None) # we manage transactions.
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.executescript(SCHEMA)
+            _connections.by_path[path] = c
+        return _connections.by_path[path]
+
+    def compose_subscription_path(self, project, name):
+        return f"{project}-{name}"
+
+    def compose_topic_path(self, project, name):
+        return f"{project}-{name}"
+
+    def compose_path(self, project, name):
+        return f"{project}-{name}"
+
+class SQLitePublisher(SQLitePubSubAgent, BasePublisher):
+
+    def __init__(self, topic, private_topic=False, **kwargs):
+        SQLitePubSubAgent.__init__(self)
+        BasePublisher.__init__(self, topic, private_topic=private_topic, **kwargs)
+
+    @classmethod
+    def topic_exists(cls, path):
+        return cls.db().execute("SELECT 1 FROM topics WHERE path = ?", (path,)).fetchone() is not None
+
+    def create_publisher(self):
+        return None
+
+    def create_topic(self, topic, **kwargs):
+        try:
+            self.db().execute("INSERT INTO topics (path) VALUES (?)", (topic,))
+        except sqlite3.IntegrityError:
+            raise AlreadyExists()
+
+    def do_publish(self, path, message, **kwargs):
+        self.do_publish_many(path, [message], **kwargs)
+
+    def do_publish_many(self, path, messages, **kwargs):
+        log.debug(f"Publishing {len(messages)} messages to topic {path}")
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # One copy for each subscription, like Google does.
+            db.executemany("INSERT INTO messages (subscription, data) SELECT path, ? FROM subscriptions WHERE topic = ?",
+                           [(m, path) for m in messages])
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def do_delete_topic(self, path):
+        # Like Google, this leaves the subscriptions (and their messages) alone.
+        self.db().execute("DELETE FROM topics WHERE path = ?", (path,))
+
+class SQLiteSubscriber(SQLitePubSubAgent, BaseSubscriber):
+    def __init__(self, topic, name=None, **kwargs):
+        SQLitePubSubAgent.__init__(self)
+        BaseSubscriber.__init__(self, topic=topic, name=name, **kwargs)
+
+    @classmethod
+    def subscription_exists(cls, sub_path):
+        return cls.db().execute("SELECT 1 FROM subscriptions WHERE path = ?", (sub_path,)).fetchone() is not None
+
+    def create_subscriber(self):
+        return None
+
+    def create_subscription(self, sub_path, topic_path, ack_deadline_seconds=None, max_delivery_attempts=None, **kwargs):
+        log.debug(f"Creating subscription {sub_path}")
+        try:
+            self.db().execute("INSERT INTO subscriptions (path, topic, ack_deadline_seconds, max_delivery_attempts) VALUES (?, ?, ?, ?)",
+                              (sub_path, topic_path,
+                               ack_deadline_seconds or ACK_DEADLINE_SEC,
+                               max_delivery_attempts or int(os.environ.get("PUBSUB_MAX_DELIVERY_ATTEMPTS", 5))))
+        except sqlite3.IntegrityError:
+            raise AlreadyExists()
+
+    def get_subscription(self, path):
+        r = self.db().execute("SELECT * FROM subscriptions WHERE path = ?", (path,)).fetchone()
+        if r is None:
+            raise NotFound(path)
+        return r
+
+    PulledMessage = namedtuple("PulledMessage",  "data ack_id delivery_attempt")
+
+    def _grab(self, path, max_messages):
+        db = self.db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            sub = db.execute("SELECT ack_deadline_seconds, max_delivery_attempts FROM subscriptions WHERE path = ?", (path,)).fetchone()
+            if sub is None:
+                raise NotFound(path)
+            ack_deadline, max_attempts = sub
+            dead = db.execute("UPDATE messages SET dead = 1 WHERE subscription = ? AND dead = 0 AND deliveries >= ? AND lease_expires <= ?",
+                              (path, max_attempts, now)).rowcount
+            if dead:
+                log.warning(f"Gave up on {dead} messages in {path} after {max_attempts} deliveries")
+            rows = db.execute("SELECT id, data, deliveries FROM messages WHERE subscription = ? AND dead = 0 AND lease_expires <= ? ORDER BY id LIMIT ?",
+                              (path, now, max_messages)).fetchall()
+            r = []
+            for id, data, deliveries in rows:
+                db.execute("UPDATE messages SET deliveries = ?, lease_expires = ? WHERE id = ?", (deliveries + 1, now + ack_deadline, id))
+                r.append(SQLiteSubscriber.PulledMessage(data, f"{id}.{deliveries + 1}", deliveries + 1))
+            db.execute("COMMIT")
+            return r
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def do_pull(self, path, max_messages=1, timeout=1, **kwargs):
+        """
+        Wait up to `timeout` seconds for messages, and return (up to
+        `max_messages` of) them, oldest first, as soon as there are any.
+        """
+        deadline = time.time() + timeout
+        while True:
+            r = self._grab(path, max_messages)
+            remaining = deadline - time.time()
+            if r or remaining <= 0:
+                return r
+            time.sleep(min(remaining, POLL_INTERVAL_SEC))
+
+    def _lease(self, msg):
+        # The ack id includes the delivery, so a lease that ran out (and
+        # was delivered again) can't ack or extend the new one.
+        id, deliveries = msg.ack_id.split(".")
+        return int(id), int(deliveries)
+
+    def do_acknowledge(self, path, msg):
+        self.do_acknowledge_many(path, [msg])
+
+    def do_acknowledge_many(self, path, msgs):
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for msg in msgs:
+                if not db.execute("DELETE FROM messages WHERE id = ? AND deliveries = ? AND dead = 0", self._lease(msg)).rowcount:
+                    log.warning(f"Lease on {msg.ack_id} ran out before we acknowledged it")
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def do_modify_ack_deadline(self, path, msg, seconds):
+        if not self.db().execute("UPDATE messages SET lease_expires = ? WHERE id = ? AND deliveries = ? AND dead = 0 AND lease_expires > ?",
+                                 (time.time() + seconds,) + self._lease(msg) + (time.time(),)).rowcount:
+            raise NotFound(f"Lease on {msg.ack_id} ran out")
+
+    def do_delete_subscription(self, path):
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM messages WHERE subscription = ?", (path,))
+        db.execute("DELETE FROM subscriptions WHERE path = ?", (path,))
+        db.execute("COMMIT")
+
+    def dead_letters(self):
+        """
+        The messages we gave up on.
+        """
+        return [d.decode("utf8") for d, in self.db().execute("SELECT data FROM messages WHERE subscription = ? AND dead = 1 ORDER BY id",
+                                                              (self.subscription_path,))]
+
+def test_subscriber():
+    do_test_subscriber(SQLiteSubscriber, SQLitePublisher)
+
+def test_publisher():
+    do_test_publisher(SQLitePublisher)
+
+def test_fifo_and_leases():
+    import pytest
+    with SQLitePublisher(f"sqlite-test-topic-{uuid()}", private_topic=True) as topic:
+        with SQLiteSubscriber(topic=topic.topic, ack_deadline_seconds=1, max_delivery_attempts=2) as s:
+            for i in range(10):
+                topic.publish(str(i))
+            assert s.pull(max_messages=4, timeout=0) == ["0", "1", "2", "3"]
+            assert s.pull(max_messages=10, timeout=0) == [str(i) for i in range(4, 10)]
+
+            topic.publish_many([str(i) for i in range(5)])
+            leases = s.pull_leased(max_messages=5, timeout=0)
+            assert [l.data for l in leases] == [str(i) for i in range(5)]
+            s.acknowledge(leases)
+            assert all(l.acknowledged for l in leases)
+            s.acknowledge(leases) # already done, so this does nothing.
+
+            topic.publish("job")
+            lease, = s.pull_leased(timeout=1)
+            assert lease.data == "job" and not lease.redelivered
+            with lease.kept(1):
+                time.sleep(1.5)
+                assert s.pull_leased(timeout=0) == []
+
+            again, = s.pull_leased(timeout=3)
+            assert again.redelivered
+            with pytest.raises(NotFound):
+                lease.extend(10)
+            lease.acknowledge() # too late: this doesn't ack `again`.
+
+            assert s.pull_leased(timeout=1.5) == []
+            assert s.dead_letters() == ["job"]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+How long does it take to start each of our console scripts?
+
+For each console script in setup.py, import its module in a fresh
+interpreter, time it, and check that it didn't drag in something heavy
+(the Google Cloud SDKs, pytest, etc.) that its code path doesn't need at
+startup.  Heavy modules should be imported where they are used.
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+import logging as log
+
+# Modules that are too slow to import unless you need them.
+HEAVY_MODULES = ["pytest", "packet", "google.cloud", "flask", "matplotlib", "gradescope_utils"]
+
+# The scripts that really do need them as soon as they start.
+ALLOWED_HEAVY_MODULES = {
+    "ArchLab.runlab_daemon": ["google.cloud"],
+    "ArchLab.runlab_proxy": ["flask"],
+}
+
+def console_scripts():
+    """
+    (script name, module) for each of our console scripts.
+    """
+    import importlib.metadata
+    scripts = set()
+    for e in importlib.metadata.entry_points(group="console_scripts"):
+        if e.value.startswith("ArchLab."):
+            scripts.add((e.name, e.value.split(":")[0]))
+    return sorted(scripts)
+
+_probe = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, heavy=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+def measure(module, repeat=3, cloud_mode=None):
+    """
+    Returns (best import time in seconds, the heavy modules it imported).
+    """
+    env = dict(os.environ)
+    if cloud_mode is not None:
+        env['CLOUD_MODE'] = cloud_mode
+    best, heavy = None, []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", _probe.format(module=module, heavy=HEAVY_MODULES)], env=env)
+        r = json.loads(out.decode("utf8").strip().split("\n")[-1])
+        if best is None or r['seconds'] < best:
+            best = r['seconds']
+        heavy = r['heavy']
+    return best, heavy
+
+def check(scripts=None, repeat=3, cloud_mode=None, max_ms=None):
+    """
+    Returns a row for each script, and a list of problems.
+    """
+    rows = []
+    problems = []
+    for name, module in (scripts if scripts is not None else console_scripts()):
+        seconds, heavy = measure(module, repeat=repeat, cloud_mode=cloud_mode)
+        unexpected = [m for m in heavy if m not in ALLOWED_HEAVY_MODULES.get(module, [])]
+        rows.append([name, module, f"{seconds*1000:.0f}", " ".join(heavy)])
+        if unexpected:
+            problems.append(f"{name} ({module}) imports {', '.join(unexpected)} at startup")
+        if max_ms is not None and seconds*1000 > max_ms:
+            problems.append(f"{name} ({module}) took {seconds*1000:.0f}ms to import (limit is {max_ms}ms)")
+    return rows, problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure how long our console scripts take to start.')
+    parser.add_argument('-v', action='store_true', dest="verbose", default=False, help="Be verbose")
+    parser.add_argument('--repeat', default=3, type=int, help="Take the best of this many runs (default = 3)")
+    parser.add_argument('--cloud-mode', default=None, help="Set CLOUD_MODE to this while measuring (e.g., EMULATION)")
+    parser.add_argument('--max-ms', default=None, type=float, help="Fail if any script takes longer than this to import")
+    parser.add_argument('script', nargs="*", help="Just measure these scripts")
+    if argv == None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if args.verbose else "%(levelname)-8s %(message)s",
+                    level=log.DEBUG if args.verbose else log.INFO)
+
+    from .Columnize import columnize
+    scripts = [s for s in console_scripts() if not args.script or s[0] in args.script]
+    rows, problems = check(scripts, repeat=args.repeat, cloud_mode=args.cloud_mode, max_ms=args.max_ms)
+    sys.stdout.write(columnize([["script", "module", "ms", "heavy imports"]] + rows, divider="  "))
+    for p in problems:
+        log.error(p)
+    return 1 if problems else 0
+
+def test_startup_imports():
+    # Outside of emulation is the interesting case: that's when the cloud backends are heavy.
+    rows, problems = check(repeat=1, cloud_mode="CLOUD")
+    assert len(rows) > 10
+    assert problems == []
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
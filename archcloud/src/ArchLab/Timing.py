@@ -0,0 +1,108 @@
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+# Spans that measure the student's code rather than our pipeline.
+STUDENT_SPANS = ["run"]
+
+class SpanRecorder(object):
+    """
+    Records how long each phase of a job takes, so we can tell our
+    overhead (cloning, uploading, etc.) from the time the student's code
+    takes.  Spans are plain dicts (name, start, duration), so they
+    serialize with the SubmissionResult.
+
+        timings = SpanRecorder()
+        with timings.span("clone"):
+            ...
+    """
+    def __init__(self, spans=None):
+        self.spans = spans if spans is not None else []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append(dict(name=name, start=start, duration=time.perf_counter() - t0))
+
+    def totals(self):
+        return span_totals(self.spans)
+
+def span_totals(spans):
+    """
+    Total seconds spent in each phase.
+    """
+    r = {}
+    for s in spans or []:
+        r[s['name']] = r.get(s['name'], 0) + s['duration']
+    return r
+
+def overhead(totals):
+    return sum(v for k, v in totals.items() if k not in STUDENT_SPANS)
+
+def encode_totals(totals):
+    """
+    Compact form for the job record, which limits field sizes.
+    """
+    return json.dumps({k: round(v, 3) for k, v in totals.items()}, sort_keys=True, separators=(",", ":"))
+
+def decode_totals(s):
+    try:
+        return json.loads(s) if s else {}
+    except ValueError:
+        return {}
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def phase_stats(totals_list):
+    """
+    Summarize the totals from many jobs.  Returns rows of (phase, count,
+    mean, p50, p90, max), with "overhead" (everything but the student's
+    code) at the end.
+    """
+    by_phase = {}
+    for totals in totals_list:
+        for k, v in totals.items():
+            by_phase.setdefault(k, []).append(v)
+        if totals:
+            by_phase.setdefault("overhead", []).append(overhead(totals))
+
+    rows = []
+    for k in sorted(by_phase, key=lambda k: (k == "overhead", k)):
+        v = by_phase[k]
+        rows.append((k, len(v), sum(v)/len(v), _percentile(v, 0.5), _percentile(v, 0.9), max(v)))
+    return rows
+
+def test_span_recorder():
+    timings = SpanRecorder()
+    with timings.span("clone"):
+        time.sleep(0.01)
+    for i in range(2):
+        with timings.span("run"):
+            time.sleep(0.01)
+    try:
+        with timings.span("upload"):
+            raise Exception()
+    except Exception:
+        pass
+
+    totals = timings.totals()
+    assert set(totals) == {"clone", "run", "upload"}
+    assert totals['run'] >= 0.02
+    assert overhead(totals) < totals['clone'] + totals['upload'] + 0.001
+    assert decode_totals(encode_totals(totals)).keys() == totals.keys()
+    assert decode_totals("") == {}
+
+def test_phase_stats():
+    rows = phase_stats([dict(clone=1, run=10), dict(clone=3, run=20), {}])
+    assert [r[0] for r in rows] == ["clone", "run", "overhead"]
+    assert rows[0] == ("clone", 2, 2, 3, 3, 3)
+    assert rows[2][5] == 3
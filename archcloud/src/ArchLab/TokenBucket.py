@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+import logging as log
+from contextlib import contextmanager
+
+class SharedState(object):
+    """
+    A dict that the threads in this process share or, if you give it a
+    path, that every process on the host shares (it lives in a JSON file,
+    under an fcntl lock).  Use it like this:
+
+        with state.locked() as d:
+            d['x'] = 1
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        self.lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _store(self, data):
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(self.path)), delete=False) as f:
+            json.dump(data, f)
+        os.rename(f.name, self.path)
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if not self.path:
+                yield self.data
+                return
+            with open(f"{self.path}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    data = self._load()
+                    yield data
+                    self._store(data)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+class TokenBucket(object):
+    """
+    Rate limit by key (e.g., by user).  Each key gets a bucket that holds
+    up to `burst` tokens and gains one every `refill_sec` seconds.  Each
+    request takes a token, and if there aren't any, it has to wait.
+    """
+    def __init__(self, burst, refill_sec, state=None):
+        self.burst = burst
+        self.refill_sec = refill_sec
+        self.state = state if state is not None else SharedState()
+
+    def _tokens(self, bucket, now):
+        tokens, last = bucket
+        return min(self.burst, tokens + (now - last) / self.refill_sec)
+
+    def take(self, key, now=None):
+        """
+        Take a token from `key`'s bucket.  Returns 0 if there was one, or
+        how many seconds until there will be.
+        """
+        if now is None:
+            now = time.time()
+        with self.state.locked() as buckets:
+            # Full buckets are the same as no bucket, so don't keep them.
+            for k in [k for k, b in buckets.items() if self._tokens(b, now) >= self.burst]:
+                del buckets[k]
+
+            tokens = self._tokens(buckets[key], now) if key in buckets else self.burst
+            if tokens >= 1:
+                buckets[key] = [tokens - 1, now]
+                return 0
+            log.debug(f"{key} is out of tokens")
+            return (1 - tokens) * self.refill_sec
+
+def test_token_bucket():
+    for path in [None, "tokens.json"]:
+        with tempfile.TemporaryDirectory() as d:
+            state = SharedState(path and os.path.join(d, path))
+            bucket = TokenBucket(burst=2, refill_sec=60, state=state)
+            assert bucket.take("a", now=0) == 0
+            assert bucket.take("a", now=0) == 0
+            assert bucket.take("a", now=0) == 60
+            assert bucket.take("a", now=30) == 30
+            assert bucket.take("b", now=30) == 0 # everyone has their own.
+            assert bucket.take("a", now=60) == 0
+            assert bucket.take("a", now=60) == 60
+
+            # Everyone using the same state shares the buckets.
+            other = TokenBucket(burst=2, refill_sec=60, state=state if path is None else SharedState(state.path))
+            assert other.take("a", now=60) == 60
+
+            # Once they're full again, we forget them.
+            bucket.take("c", now=1000)
+            with state.locked() as buckets:
+                assert list(buckets) == ["c"]
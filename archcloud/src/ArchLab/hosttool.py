@@ -7,14 +7,12 @@ import os
 
 import re
 from .SubCommand import SubCommand
-import packet
 from .Columnize import columnize, format_time_delta
-from .PubSub import Publisher, Subscriber
 
-def send_command_to_hosts(command):
+def send_command_to_hosts(*commands):
+    from .PubSub import Publisher
     publisher = Publisher(os.environ['HOST_COMMAND_TOPIC'])
-    s = json.dumps(dict(command=command))
-    publisher.publish(s)
+    publisher.publish_many([json.dumps(dict(command=c)) for c in commands])
     
 class HostControl(SubCommand):
     def __init__(self, parent):
@@ -22,10 +20,10 @@ class HostControl(SubCommand):
                                           name="cmd",
                                           help="Control build servers processes")
         
-        self.parser.add_argument("command", help="Command to send")
+        self.parser.add_argument("command", nargs="+", help="Commands to send")
         
     def run(self, args):
-        send_command_to_hosts(args.command)
+        send_command_to_hosts(*args.command)
         
 
 class PacketCommand(SubCommand):
@@ -33,7 +31,14 @@ class PacketCommand(SubCommand):
         super(PacketCommand, self).__init__(*args, **kwargs)
         self.token = os.environ["PACKET_AUTH_TOKEN"]
         self.project = os.environ["PACKET_PROJECT_ID"]
-        self.manager = packet.Manager(auth_token=self.token)
+        self._manager = None
+
+    @property
+    def manager(self):
+        if self._manager is None:
+            import packet # it's slow, and most commands don't need it.
+            self._manager = packet.Manager(auth_token=self.token)
+        return self._manager
 
 
     def get_packet_hosts(self):
@@ -68,6 +73,7 @@ class PacketDelete(PacketCommand):
         self.parser.add_argument("device", nargs="+", help="Device id")
 
     def run(self, args):
+        import packet
         current_devices = self.get_packet_hosts()
         by_name = {x.hostname : x for x in current_devices}
         by_id = {x.id : x for x in current_devices}
@@ -134,6 +140,7 @@ class HostTop(PacketCommand):
 
     def run(self, args):
         log.debug(f"Running hosts with {args}")
+        from .PubSub import Subscriber
         from google.cloud.pubsub_v1.types import Duration
         from google.cloud.pubsub_v1.types import ExpirationPolicy
         from uuid import uuid4 as uuid
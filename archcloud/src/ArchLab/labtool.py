@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from .Runner import build_submission, run_submission_locally, run_submission_remotely, Submission, SubmissionResult, MalformedObject
+from .Runner import build_submission, run_submission_locally, run_submission_remotely, Submission, SubmissionResult, MalformedObject, read_envelope, envelope_references
 import logging as log
 import json
 import platform
@@ -9,15 +9,12 @@ import sys
 import os
 import subprocess
 import base64
-from  .DataStore import DataStore
-from  .BlobStore import BlobStore
-from  .PubSub import Subscriber
 import math
 
 import copy
 from .Columnize import columnize, format_time_delta, format_time_short, format_time_excel
 from .SubCommand import SubCommand
-from .hosttool import send_command_to_hosts
+from .Timing import decode_totals, phase_stats
 import pytz
 
 class Report(SubCommand):
@@ -63,6 +60,7 @@ class Report(SubCommand):
             print(f"{lb:4} {'#' * int((buckets[int(lb/bucket_size)]/max_count)*70)}")
         
     def run(self, args):
+        from .DataStore import DataStore
         
         import csv
         import datetime
@@ -83,6 +81,7 @@ class List(SubCommand):
         self.parser.add_argument("--csv", nargs="?", help="List as CSV")
         
     def run(self, args):
+        from .DataStore import DataStore
         
         import csv
         import datetime
@@ -119,6 +118,9 @@ class Download(SubCommand):
         self.parser.add_argument("id", nargs='+', help="prefix of job id")
 
     def run(self, args):
+        from .DataStore import DataStore
+        from .BlobStore import BlobStore
+        from .ContentStore import ContentStore
         import json
         from .Runner import cd
         import re
@@ -142,15 +144,12 @@ class Download(SubCommand):
             
             os.makedirs(prefix, exist_ok=True)
             for i in names:
-                d = blobstore.read_file(i)
-                mode = "w" if isinstance(d, str) else "wb"
-                    
-                with open(os.path.join(prefix, i), mode) as f:
-                    f.write(d)
+                path = os.path.join(prefix, os.path.basename(i))
+                blobstore.download_file(i, path)
                 if "-result" in i:
                     files_path = os.path.join(prefix, "files")
                     os.makedirs(files_path, exist_ok=True)
-                    result = SubmissionResult._fromdict(json.loads(d))
+                    result = read_envelope(path, SubmissionResult, ContentStore(blobstore))
                     result.write_outputs(directory=files_path)
                     result.submission.write_inputs(directory=files_path)
 
@@ -176,6 +175,7 @@ class Cleanup(SubCommand):
         self.parser.add_argument('-n', '--dry-run', action='store_true', default=False, help="Don't actually do anything")
 
     def run(self, args):
+        from .DataStore import DataStore
         import datetime
         ds = DataStore()
         for i in ds.query(status="SUBMITTED") + ds.query(status="STARTED"):
@@ -190,6 +190,66 @@ class Cleanup(SubCommand):
                               submission_status = SubmissionResult.TIMEOUT,
                     )
                     
+class CollectBlobs(SubCommand):
+    def __init__(self, parent):
+        super(CollectBlobs, self).__init__(parent,
+                                           name="gc-blobs",
+                                           help="Delete file contents that no job refers to")
+        self.parser.add_argument('-n', '--dry-run', action='store_true', default=False, help="Don't actually delete anything")
+        self.parser.add_argument('--grace-hours', default=24, type=float, help="Don't delete anything newer than this (default = 24)")
+
+    def run(self, args):
+        from .BlobStore import BlobStore
+        from .ContentStore import ContentStore
+        import tempfile
+        blobstore = BlobStore(os.environ['JOBS_BUCKET'])
+
+        def referenced_by(name):
+            if name.endswith(".zip"): # the archives students download
+                return set()
+            with tempfile.NamedTemporaryFile() as f:
+                blobstore.download_file(name, f.name)
+                return envelope_references(f.name)
+
+        deleted = ContentStore(blobstore).collect_garbage(referenced_by,
+                                                          grace_sec=args.grace_hours*3600,
+                                                          dry_run=args.dry_run)
+        sys.stdout.write(f"{'Would delete' if args.dry_run else 'Deleted'} {len(deleted)} blobs\n")
+
+class Timings(SubCommand):
+    def __init__(self, parent):
+        super(Timings, self).__init__(parent,
+                                      name="timings",
+                                      help="Show where jobs spend their time")
+        self.parser.add_argument("id", nargs='*', help="prefix of job id (default: recently completed jobs)")
+        self.parser.add_argument('--window', default=60, help="Time window to look at (in minutes) (default = 60)")
+
+    def run(self, args):
+        from .DataStore import DataStore
+        from .BlobStore import BlobStore
+        import re
+        ds = DataStore()
+        if args.id:
+            blobstore = BlobStore(os.environ['JOBS_BUCKET'])
+            job_ids = set()
+            for id in args.id:
+                for name in blobstore.get_files_by_prefix(id):
+                    m = re.search("^(\w+-\w+-\w+-\w+-\w+)", name)
+                    if m:
+                        job_ids.add(m.group(1))
+            jobs = [j for j in map(ds.get_job, sorted(job_ids)) if j]
+        else:
+            jobs = ds.get_recently_completed_jobs(int(args.window)*60)
+
+        totals = [decode_totals(j.get('timings')) for j in jobs]
+        totals = [t for t in totals if t]
+        if not totals:
+            sys.stdout.write("No timings found.\n")
+            return 1
+
+        rows = [[phase, str(count)] + [f"{t:.3f}" for t in stats] for phase, count, *stats in phase_stats(totals)]
+        sys.stdout.write(columnize([["phase", "jobs", "mean", "p50", "p90", "max"]] + rows, divider=" "))
+
 class Top(SubCommand):
     def __init__(self, parent):
         super(Top, self).__init__(parent,
@@ -200,6 +260,8 @@ class Top(SubCommand):
         self.parser.add_argument('--window', default=30, help="Time window to compute stats (in minutes) (default = 30)")
 
     def run(self, args):
+        from .DataStore import DataStore
+        from .PubSub import Subscriber
         from google.cloud.pubsub_v1.types import Duration
         from google.cloud.pubsub_v1.types import ExpirationPolicy
         import datetime
@@ -357,6 +419,8 @@ def main(argv=None):
 
     Top(subparsers)
     Cleanup(subparsers)
+    CollectBlobs(subparsers)
+    Timings(subparsers)
     Download(subparsers)
     List(subparsers)
     Report(subparsers)
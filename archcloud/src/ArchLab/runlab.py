@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from .Runner import build_submission, run_submission_locally, run_submission_remotely, run_submission_by_proxy, run_repo_by_proxy, Submission, ArchlabError, UserError, SubmissionResult, LabSpec, ArchlabTransientError, ConfigException
+from .Runner import build_submission, run_submission_locally, run_submission_remotely, run_submission_by_proxy, run_repo_by_proxy, Submission, ArchlabError, UserError, SubmissionResult, LabSpec, ArchlabTransientError, ConfigException, read_envelope
 import logging as log
 import json
 import platform
@@ -16,6 +16,8 @@ import traceback
 from .Columnize import columnize
 import datetime
 from .showgrades import render_grades
+from .Timing import SpanRecorder, overhead
+from .Probes import ProbeCache
 
 log.addLevelName(25, "NOTE")
 def note(*argc, **kwargs):
@@ -36,6 +38,7 @@ def exec_environment():
                 origin=run_git(subprocess.run, "git remote get-url origin".split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode('utf8').strip(),
                 upstream=run_git(subprocess.run, "git remote get-url upstream".split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode('utf8').strip(),
     )
+    data.update({f"probe_{k}": v for k, v in ProbeCache().results().items()})
     rows.append(["EXEC", ""])
     rows.append(["=======", ""])
 
@@ -62,13 +65,15 @@ def cache_git_credentials():
         
 def show_info(directory, fields=None):
     try:
-        spec=LabSpec.load(directory)
+        spec=LabSpec.load_snapshot(directory)
     except FileNotFoundError:
         return "Not a lab directory\n"
 
     if fields == []:
         return f"{exec_environment()}\n{spec.get_help()}"
     else:
+        if not hasattr(spec, fields) and type(spec) is LabSpec:
+            spec = LabSpec.load(directory) # It's not in the snapshot, but the lab might define it.
         try:
             return f"{getattr(spec, fields)}\n"
         except AttributeError:
@@ -197,7 +202,7 @@ def main(argv=None):
     parser.add_argument('--docker-image', default=os.environ['DOCKER_RUNNER_IMAGE'], help=sm("Docker image to use"))
     parser.add_argument('--json', default=None, help=sm("Dump json version of submission and response."))
     parser.add_argument('--directory', default=".", help=sm("Lab root"))
-    parser.add_argument('--run-json', nargs="*", default=None, help=sm("Read json submission spec from file.   With no arguments, read from stdin"))
+    parser.add_argument('--run-json', nargs="*", default=None, help=sm("Read a submission (an envelope or json) from file.   With no arguments, read from stdin"))
     parser.add_argument('--json-status', help=sm("Write exit status to file"))
     parser.add_argument('--remote', action='store_true', default=False, help=sm("Run remotely"))
     parser.add_argument('--daemon', action='store_true', default=False, help=sm("Start a local server to run my job"))
@@ -277,13 +282,14 @@ def main(argv=None):
         args.command = None
 
     log.note("Running your code...")
+    timings = SpanRecorder()
     try:
         submission = None
         if args.run_json is not None:
             if args.run_json == []:
-                submission = Submission._fromdict(json.loads(sys.stdin.read()))
+                submission = read_envelope(sys.stdin.buffer, Submission)
             else:
-                submission = Submission._fromdict(json.loads(open(args.run_json[0]).read()))
+                submission = read_envelope(args.run_json[0], Submission)
             log.debug(f"loaded this submission from json:\n" + str(submission._asdict()))
         elif args.run_git_remotely:
             pass
@@ -295,7 +301,8 @@ def main(argv=None):
                                           username=os.environ.get("USER_EMAIL", None) or f"{os.environ.get('USER',None)}-on-{platform.node()}",
                                           pristine=args.pristine,
                                           repo=args.repo,
-                                          branch=args.branch)
+                                          branch=args.branch,
+                                          timings=timings)
 
             for i in args.lab_override:
                 k, v = i.split("=")
@@ -333,7 +340,7 @@ def main(argv=None):
         if not args.nop:
 
             if args.remote:
-                result = run_submission_remotely(submission, daemon=args.daemon)
+                result = run_submission_remotely(submission, daemon=args.daemon, timings=timings)
             elif args.run_git_remotely:
                 result = run_repo_by_proxy(proxy=args.proxy,
                                            repo=args.repo,
@@ -347,7 +354,8 @@ def main(argv=None):
                                                 run_in_docker=args.docker,
                                                 run_pristine=args.pristine,
                                                 docker_image=args.docker_image,
-                                                verify_repo=args.verify_repo)
+                                                verify_repo=args.verify_repo,
+                                                timings=timings)
 
                 
             if args.json:
@@ -391,6 +399,8 @@ def main(argv=None):
                     f.write(result.build_file_zip_archive())
 
             log.info(f"Grading results:\n{json.dumps(result.results, indent=4)}")
+            totals = timings.totals()
+            log.debug(f"Timings: {json.dumps({k: round(v, 3) for k, v in totals.items()})} (overhead {overhead(totals):.3f}s)")
     except (UserError, ConfigException) as e: 
         log.error(f"User error (probably your fault): {repr(e)}")
         status_str = f"{repr(e)}"
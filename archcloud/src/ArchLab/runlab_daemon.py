@@ -4,7 +4,11 @@ runlab daemon
 
 This program pulls CSE141 jobs from the pubsub queue and runs them. Then posts results to Google Datastore.
 
-Usage: runlab.d
+Usage: runlab.d [--workers N] [--docker [--docker-pool M]]
+
+It runs up to N jobs at once.  Each job is claimed, run, and reported on by
+its own worker thread.  With --docker-pool, jobs run in M warm containers
+(see DockerPool.py).
 
 """
 import time
@@ -18,23 +22,31 @@ import tempfile
 import datetime
 import threading
 import traceback
+import concurrent.futures
+from contextlib import contextmanager
 from uuid import uuid4 as uuid
 import pytz
 
 
 from .BlobStore import BlobStore
+from .BaseBlobStore import UnknownUser
 from .DataStore import DataStore
 from .PubSub import Publisher, Subscriber
+from .ContentStore import ContentStore
+from .DockerPool import DockerPool
+from .Timing import SpanRecorder, encode_totals
+from .Probes import ProbeCache
 
 
-from .Runner import build_submission, run_submission_locally, Submission, ArchlabError, UserError
-
-import google.api_core
+from .Runner import build_submission, run_submission_locally, Submission, SubmissionResult, ArchlabError, UserError, read_envelope, write_envelope
 
 
 status = "IDLE"
+running_jobs = []
+worker_count = 1
 
 running_mutex = threading.Lock()
+status_mutex = threading.Lock()
 keep_running_flag = True
 
 def stop_running():
@@ -55,6 +67,35 @@ def keep_running():
     finally:
         running_mutex.release()    
     
+def default_worker_count(cores_per_job=None, reserved_cores=None):
+    """
+    How many jobs to run at once.  `reserved_cores` are left for the
+    daemon and the OS, and each job gets `cores_per_job` (the benchmark
+    core plus one for the build and everything else).
+    """
+    if cores_per_job is None:
+        cores_per_job = int(os.environ.get('RUNLAB_CORES_PER_JOB', 2))
+    if reserved_cores is None:
+        reserved_cores = int(os.environ.get('RUNLAB_RESERVED_CORES', 1))
+    return max(1, ((os.cpu_count() or 1) - reserved_cores) // max(1, cores_per_job))
+
+def job_started(job_id):
+    with running_mutex:
+        running_jobs.append(job_id)
+        jobs = list(running_jobs)
+    set_status("RUNNING", " ".join(j[:8] for j in jobs))
+
+def job_finished(job_id):
+    with running_mutex:
+        running_jobs.remove(job_id)
+        jobs = list(running_jobs)
+    if not keep_running(): # Don't clobber RELOAD_* or SHUTDOWN
+        return
+    if jobs:
+        set_status("RUNNING", " ".join(j[:8] for j in jobs))
+    else:
+        set_status("IDLE")
+
 my_id=str(uuid())
 heart = None
 valid_status = ["IDLE",
@@ -69,11 +110,12 @@ def set_status(new_status, message=None):
     
     if new_status not in valid_status:
         raise Exception("Illegal status: {new_status}.  should be in {valid_status}")
-    status = new_status + (f": {message}" if message else "")
-    log.info(f"Setting status to '{status}'")
-    with open(f"{os.environ['RUNLAB_STATUS_DIRECTORY']}/status", "w") as f:
-        log.info(f"Writing status: '{new_status}'")
-        f.write(new_status)
+    with status_mutex: # worker threads report status concurrently
+        status = new_status + (f": {message}" if message else "")
+        log.info(f"Setting status to '{status}'")
+        with open(f"{os.environ['RUNLAB_STATUS_DIRECTORY']}/status", "w") as f:
+            log.info(f"Writing status: '{new_status}'")
+            f.write(new_status)
     heart.send_beat()
     
 class Heart(object):
@@ -91,6 +133,8 @@ class Heart(object):
         global status
         global my_id
         log.debug(f"now = {repr(datetime.datetime.utcnow())}")
+        with running_mutex:
+            jobs = list(running_jobs)
         data = dict(id=my_id,
                     type="heartbeat",
                     node=platform.node(),
@@ -98,7 +142,10 @@ class Heart(object):
                     sw_git_hash=self.git_hash,
                     docker_image=os.environ.get("THIS_DOCKER_IMAGE", "unknown"),
                     status=status,
-                    load=open("/proc/loadavg").read().strip())
+                    jobs=jobs,
+                    workers=worker_count,
+                    load=open("/proc/loadavg").read().strip(),
+                    probes=ProbeCache().results())
                 
         self.publisher.publish(json.dumps(data))
         log.info(f"Heartbeat sent: {data}")
@@ -137,10 +184,8 @@ class CommandListener(object):
                             heart.send_beat()
 
     
-def run_job(job_submission_json, in_docker, docker_image):
+def run_job(submission, in_docker, docker_image, docker_pool=None, timings=None):
 
-
-    submission = Submission._fromdict(json.loads(job_submission_json))
     with tempfile.TemporaryDirectory(dir="/tmp/") as directory:
         submission.run_directory = directory
         result = run_submission_locally(submission,
@@ -149,11 +194,324 @@ def run_job(job_submission_json, in_docker, docker_image):
                                         run_pristine=True,
                                         run_in_docker=in_docker,
                                         docker_image=docker_image,
+                                        docker_pool=docker_pool,
+                                        timings=timings,
                                         # this timeout is conservative.  The lab timeout is enforced on the docker process
                                         timeout=int(os.environ['UNIVERSAL_TIMEOUT_SEC']))
 
     return result
 
+def notify_submitter(job_id, job_data, status):
+    """
+    Tell whoever submitted `job_id` that it's done, so they don't have
+    to poll the datastore.  This is just a hint: if it gets lost,
+    they'll notice on their next (slow) poll.
+    """
+    reply_topic = job_data.get('reply_topic') if job_data else None
+    if not reply_topic:
+        return
+    try:
+        Publisher(topic=reply_topic, create_if_missing=False).publish(json.dumps(dict(job_id=job_id, status=status)))
+    except Exception as e:
+        log.warning(f"Couldn't notify submitter that {job_id} is {status}: {e}")
+
+# How long we hold a job's message between lease extensions.  If we
+# die, the job goes back on the queue this long after our last one.
+JOB_LEASE_SEC = 60
+
+# While a job runs, its host stamps the job's `heartbeat_utc` this often.
+# If the job's message comes back to someone else while the stamp is
+# fresher than JOB_HEARTBEAT_STALE_SEC, its host is still running it
+# (it just couldn't extend its lease), so they hold onto the message and
+# check on the job every OWNER_POLL_SEC, in case the host dies before
+# it's done.  We extend leases every JOB_LEASE_SEC/3, so by the time a
+# dead host's job comes back, its stamp is at least 2*JOB_LEASE_SEC/3 old.
+JOB_HEARTBEAT_SEC = JOB_LEASE_SEC/6
+JOB_HEARTBEAT_STALE_SEC = JOB_LEASE_SEC/2
+OWNER_POLL_SEC = JOB_HEARTBEAT_SEC
+
+@contextmanager
+def job_heartbeat(ds, job_id, interval=JOB_HEARTBEAT_SEC):
+    """
+    Stamp the job's `heartbeat_utc` every `interval` seconds until the
+    with block ends.  It only touches that field, so anyone else can
+    keep updating the job meanwhile.
+    """
+    done = threading.Event()
+    def beat():
+        while not done.wait(interval):
+            try:
+                ds.update(job_id, heartbeat_utc=datetime.datetime.now(pytz.utc))
+            except Exception as e:
+                log.warning(f"Couldn't update the heartbeat for {job_id}: {e}")
+    t = threading.Thread(target=beat, daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        done.set()
+        t.join()
+
+def owner_is_alive(job_id, job_data, now=None):
+    """
+    Is the host that started this job still running it?
+    """
+    if job_data['runner_host'] == platform.node():
+        with running_mutex:
+            return job_id in running_jobs
+    if now is None:
+        now = datetime.datetime.now(pytz.utc)
+    last = job_data.get('heartbeat_utc') or job_data.get('started_utc')
+    return isinstance(last, datetime.datetime) and (now - last).total_seconds() < JOB_HEARTBEAT_STALE_SEC
+
+def run_leased_job(lease, args, ds, blobstore, docker_pool=None):
+    """
+    Run the job in `lease`, holding onto the lease until it's done (or,
+    with `--ack-on claim`, until we've marked the job STARTED).  If we
+    crash before we let go of it, the lease runs out and someone else
+    gets the job.
+    """
+    if args.ack_on == "pull":
+        lease.acknowledge()
+    given_back = []
+    try:
+        with lease.kept(JOB_LEASE_SEC):
+            run_queued_job(lease.data, args, ds, blobstore, docker_pool, redelivered=lease.redelivered,
+                           on_claimed=lease.acknowledge if args.ack_on == "claim" else None,
+                           on_given_back=lambda: given_back.append(True))
+    finally:
+        if given_back:
+            if not lease.acknowledged:
+                lease.nack()
+        else:
+            lease.acknowledge()
+
+def run_queued_job(job_id, args, ds, blobstore, docker_pool=None, redelivered=False, on_claimed=None, on_given_back=None):
+    """
+    Claim, run, and report on one job.  This runs in a worker thread, so
+    everything it needs is passed in or local.  If the job's message was
+    `redelivered` and whoever started it died, we start it over.  If
+    they're still running it, we wait for them to finish, and take over
+    if they die first.  We call `on_claimed()` once the job is STARTED in
+    the datastore, and `on_given_back()` if we stop waiting because we're
+    shutting down, so the message should go back on the queue.
+    """
+    job_data = dict()
+    started = False
+    result = None
+    timings = SpanRecorder()
+    try:
+        try:
+            job_data = ds.pull(
+                job_id=job_id
+            )
+            if not job_data: # job missing?
+                return
+            if job_data['status'] == "STARTED" and redelivered:
+                if owner_is_alive(job_id, job_data):
+                    log.info(f"{job_id} came back to us, but {job_data['runner_host'] or '<na>'} is still running it.  Waiting for it to finish.")
+                while owner_is_alive(job_id, job_data):
+                    if not keep_running():
+                        on_given_back and on_given_back()
+                        return
+                    time.sleep(OWNER_POLL_SEC)
+                    job_data = ds.pull(job_id=job_id)
+                    if not job_data or job_data['status'] != "STARTED":  # They finished it.
+                        return
+                log.warning(f"{job_id} was running on {job_data['runner_host'] or '<na>'}, which lost its lease on it.  Running it again.")
+            elif job_data['status'] != "SUBMITTED":  # Someone else grabbed it.
+                return
+
+            # Got one we should run!  Grab it.
+            with timings.span("download_submission"), tempfile.NamedTemporaryFile(suffix=".zip") as envelope:
+                blobstore.download_file(job_id, envelope.name)
+                submission = read_envelope(envelope.name, Submission, ContentStore(blobstore))
+            job_started(job_id)
+            started = True
+
+            ds.update(
+                job_id,
+                status='STARTED',
+                started_utc=datetime.datetime.now(pytz.utc),
+                heartbeat_utc=datetime.datetime.now(pytz.utc),
+                runner_host=platform.node()
+            )
+            if on_claimed:
+                on_claimed()
+
+            # Run the job
+            with job_heartbeat(ds, job_id):
+                result = run_job(
+                    submission=submission,
+                    in_docker=args.docker,
+                    docker_image=args.docker_image,
+                    docker_pool=docker_pool,
+                    timings=timings
+                )
+
+            # pull the job data again to make sure it wasn't
+            # canceled or completed by someone else.  If it timed
+            # out, we should leave it incomplete, since that's
+            # what effectively happened.
+            job_data = ds.pull(job_id=job_id)
+            if job_data['status'] != "STARTED":
+                log.error(f"Found that job I was running completed without me")
+                return
+
+
+            # Bundle up the output
+            if job_data.get('username',"") != None and '@' in job_data.get('username',""):
+                username = f"{job_data['username'].split('@')[0]}-"
+
+                to_zone = pytz.timezone('America/Los_Angeles')
+                local_time = job_data['submitted_utc'].astimezone(to_zone).strftime('%Y-%m-%d-%H-%M-%S')
+                download_name=f"{username}submitted-at-{local_time}.zip"
+                zip_name = f"{job_id}.zip"
+
+                try:
+                    with timings.span("zip_archive"):
+                        zip_archive = result.build_file_zip_archive()
+                    archive = blobstore.write_file(zip_name,
+                                                   zip_archive,
+                                                   content_disposition=f"Attachment; filename={download_name}",
+                                                   owner=job_data['username'],
+                                                   content_type="application/zip")
+                except UnknownUser:
+                    raise UserError(f"Unknown user: Your email address needs to be associated with a google account.  It appears that '{job_data['username']}' is not.")
+            else:
+                archive = None
+
+            result.limit_output_file_size(size_limit=10*1024*1024, msg="This is usually due to printing too much output.  Disable your debugging output.  " + ("The full output is available in the zip file: {archive}" if archive else "If you run this via gradescope, the full output will be in your zip archive for the run."))
+
+            # Store the result in the cloud
+            with timings.span("upload_result"), tempfile.NamedTemporaryFile(suffix=".zip") as envelope:
+                write_envelope(result, envelope, ContentStore(blobstore))
+                envelope.flush()
+                blobstore.upload_file(f"{job_id}-result", envelope.name, content_type="application/zip")
+
+            # Update it's status.
+            ds.update(
+                job_id,
+                status='COMPLETED',
+                submission_status=result.status,
+                submission_status_reasons=result.status_reasons,
+                completed_utc=datetime.datetime.now(pytz.utc),
+                zip_archive=archive,
+                timings=encode_totals(timings.totals())
+            )
+            notify_submitter(job_id, job_data, 'COMPLETED')
+        except (ArchlabError, UserError) as e:
+            job_data = ds.pull(job_id=job_id)
+            ds.update(
+                job_id,
+                status='ERROR',
+                status_reasons=job_data['status_reasons'] +
+                [f"{traceback.format_exc()}\n{repr(e)}"] +
+                [f"An error occurred.  This is probably {'not ' if isinstance(e, ArchlabError) else ''}a problem with your code or configuration."],
+                completed_utc=datetime.datetime.now(pytz.utc),
+                timings=encode_totals(timings.totals())
+            )
+            notify_submitter(job_id, job_data, 'ERROR')
+            if args.debug:
+                raise
+        except Exception as e:
+            log.error(f"Something went wrong and {job_id} failed.  Job failed:{e}")
+            job_id and ds.update(job_id,
+                                 status='ERROR',
+                                 status_reasons=job_data.get('status_reasons', []) +
+                                 [f"{traceback.format_exc()}\n{repr(e)}"] +
+                                 ["An unexected error occurred.  This is probably not a problem with your code."],
+                                 completed_utc=datetime.datetime.now(pytz.utc),
+                                 timings=encode_totals(timings.totals())
+            )
+            job_id and notify_submitter(job_id, job_data, 'ERROR')
+            if args.debug:
+                raise
+        finally:
+            if started:
+                job_finished(job_id)
+    # This is to catch exceptions that arise during the processing
+    # of other exceptions, so the daemon doesn't crash.  The
+    # likely cause is some problem with the cloud services.  If
+    # they aren't working, there's not much we can do, so we just
+    # listen pause for a bit before giving up the worker slot.
+    except Exception as e: 
+        log.error(f"Uncaught exception: {e}.")
+        log.error("Sleeping for 10 second and trying again")
+        if args.debug:
+            raise
+        time.sleep(10.0)
+
+def poll_for_jobs(subscriber, workers, args, ds, blobstore, docker_pool, failures):
+    """
+    Pull a job whenever a worker is free, and run it.
+    """
+    slots = threading.BoundedSemaphore(workers)
+    def job_done(future):
+        slots.release()
+        if future.exception() is not None and args.debug:
+            failures.append(future.exception())
+            stop_running()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+    try:
+        while keep_running():
+            # Wait for a free worker before we take a job off the queue.
+            if not slots.acquire(timeout=1):
+                continue
+            try:
+                # Pull a job
+                leases = subscriber.pull_leased()
+            except Exception as e:
+                slots.release()
+                log.error(f"Uncaught exception: {e}.")
+                log.error("Sleeping for 10 second and trying again")
+                if args.debug:
+                    raise
+                time.sleep(10.0)
+                continue
+
+            if len(leases) == 0 or leases[0].data == "junk":
+                slots.release()
+                if len(leases) == 0:
+                    log.info('No jobs in queue')
+                    if not args.just_once:
+                        time.sleep(1)
+                else:
+                    leases[0].acknowledge()
+            else:
+                executor.submit(run_leased_job, leases[0], args, ds, blobstore, docker_pool).add_done_callback(job_done)
+
+            if args.just_once:
+                break
+    finally:
+        executor.shutdown(wait=True)
+
+def stream_jobs(subscriber, workers, args, ds, blobstore, docker_pool, failures):
+    """
+    Let the subscriber hand us jobs as they arrive, up to one per free
+    worker, until we're told to stop.
+    """
+    def run_streamed_job(lease):
+        if lease.data == "junk":
+            lease.acknowledge()
+            return
+        try:
+            run_leased_job(lease, args, ds, blobstore, docker_pool)
+        except Exception as e:
+            if args.debug:
+                failures.append(e)
+                stop_running()
+            raise
+
+    stream = subscriber.subscribe(run_streamed_job, max_outstanding=workers, lease_sec=JOB_LEASE_SEC)
+    try:
+        while keep_running():
+            time.sleep(1)
+    finally:
+        stream.cancel()
+        stream.join()
+
 def main(argv=None):
 
     parser = argparse.ArgumentParser(description='Server to run a lab.')
@@ -164,10 +522,20 @@ def main(argv=None):
     parser.add_argument('--id', default=None,  help="Use this as the server identifier.")
     parser.add_argument('--debug', action='store_true', help="exit on errors")
     parser.add_argument('--heart-rate', default=30, help="seconds between heart beats")
+    parser.add_argument('--workers', default=None, help="How many jobs to run at once.  Defaults to what the cores allow (see RUNLAB_CORES_PER_JOB and RUNLAB_RESERVED_CORES)")
+    parser.add_argument('--docker-pool', default=0, type=int, help="With --docker, keep this many warm containers to run jobs in (default 0, i.e., start a new container for each job)")
+    parser.add_argument('--docker-pool-recycle', default=20, type=int, help="Replace warm containers after this many jobs")
+    parser.add_argument('--ack-on', default="finish", choices=["pull", "claim", "finish"],
+                        help="When to acknowledge a job's message: as soon as we pull it, once we've marked the job STARTED, or when it's done (the default).  "
+                        "Acking earlier saves holding leases on long jobs, but if we die before it's done, no one will run it again.")
+    parser.add_argument('--streaming-pull', action='store_true', default=False,
+                        help="Have jobs pushed to us as they arrive (up to one per free worker), instead of polling for them.")
 
     if argv == None:
         argv = sys.argv[1:]
     args = parser.parse_args(argv)
+    if args.streaming_pull and args.just_once:
+        parser.error("--streaming-pull doesn't work with --just-once")
 
     log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if args.verbose else "%(levelname)-8s %(message)s",
                     level=log.DEBUG if args.verbose else log.INFO)
@@ -185,148 +553,90 @@ def main(argv=None):
     ds = DataStore()
     blobstore = BlobStore(os.environ['JOBS_BUCKET'])
     subscriber = Subscriber(name=os.environ['PUBSUB_SUBSCRIPTION'],
-                            topic=os.environ['PUBSUB_TOPIC'])
+                            topic=os.environ['PUBSUB_TOPIC'],
+                            ack_deadline_seconds=JOB_LEASE_SEC)
 
     global heart
+    global worker_count
+
+    workers = int(args.workers) if args.workers else default_worker_count()
+    worker_count = workers
+    log.info(f"Running up to {workers} jobs at once")
 
     heart = Heart(float(args.heart_rate))
     head = CommandListener()
     set_status("IDLE")    
     threading.Thread(target=Heart.beat,args=(heart,), daemon=True).start()
     threading.Thread(target=head.listen, daemon=True).start()
-    job_id = None
-    job_data = dict()
-    while keep_running():
-        result = None
-        try:
-            try:
-
-                # Pull a job
-                job_id = subscriber.pull()
-                if job_id == "junk":
-                    continue
-                if len(job_id) == 0:
-                    log.info('No jobs in queue')
-                    time.sleep(1)
-                    continue
 
-                job_id = job_id[0]
+    docker_pool = None
+    if args.docker and args.docker_pool > 0:
+        docker_pool = DockerPool(args.docker_pool, args.docker_image, recycle_after=args.docker_pool_recycle)
+        docker_pool.start()
 
-                job_data = ds.pull(
-                    job_id=job_id
-                )
-                if not job_data: # job missing?
-                    continue
-                if job_data['status'] != "SUBMITTED":  # Someone else grabbed it.
-                    continue
-
-                # Got one we should run!  Grab it.
-                job_submission_json = blobstore.read_file(job_id)
-                set_status("RUNNING", job_data['job_id'][:8])
-
-                ds.update(
-                    job_id,
-                    status='STARTED',
-                    started_utc=datetime.datetime.now(pytz.utc),
-                    runner_host=platform.node()
-                )
-
-                # Run the job
-                result = run_job(
-                    job_submission_json=job_submission_json,
-                    in_docker=args.docker,
-                    docker_image=args.docker_image
-                )
+    failures = []
+    try:
+        if args.streaming_pull:
+            stream_jobs(subscriber, workers, args, ds, blobstore, docker_pool, failures)
+        else:
+            poll_for_jobs(subscriber, workers, args, ds, blobstore, docker_pool, failures)
+    finally:
+        docker_pool and docker_pool.shutdown()
 
-                # pull the job data again to make sure it wasn't
-                # canceled or completed by someone else.  If it timed
-                # out, we should leave it incomplete, since that's
-                # what effectively happened.
-                job_data = ds.pull(job_id=job_id)
-                if job_data['status'] != "STARTED":
-                    log.error(f"Found that job I was running completed without me")
-                    continue
-
-
-                # Bundle up the output
-                if job_data.get('username',"") != None and '@' in job_data.get('username',""):
-                    username = f"{job_data['username'].split('@')[0]}-"
-
-                    to_zone = pytz.timezone('America/Los_Angeles')
-                    local_time = job_data['submitted_utc'].astimezone(to_zone).strftime('%Y-%m-%d-%H-%M-%S')
-                    download_name=f"{username}submitted-at-{local_time}.zip"
-                    zip_name = f"{job_id}.zip"
-
-                    try:
-                        archive = blobstore.write_file(zip_name,
-                                                       result.build_file_zip_archive(),
-                                                       content_disposition=f"Attachment; filename={download_name}",
-                                                       owner=job_data['username'],
-                                                       content_type="application/zip")
-                    except google.api_core.exceptions.BadRequest as e:
-                        if "Unknown user" in repr(e):
-                            raise UserError(f"Unknown user: Your email address needs to be associated with a google account.  It appears that '{job_data['username']}' is not.")
-                        else:
-                            raise
-                else:
-                    archive = None
-
-                result.limit_output_file_size(size_limit=10*1024*1024, msg="This is usually due to printing too much output.  Disable your debugging output.  " + ("The full output is available in the zip file: {archive}" if archive else "If you run this via gradescope, the full output will be in your zip archive for the run."))
-
-                # Store the result in the cloud
-                blobstore.write_file(f"{job_id}-result",
-                                     json.dumps(result._asdict(), sort_keys=True, indent=4))
-
-                # Update it's status.
-                ds.update(
-                    job_id,
-                    status='COMPLETED',
-                    submission_status=result.status,
-                    submission_status_reasons=result.status_reasons,
-                    completed_utc=datetime.datetime.now(pytz.utc),
-                    zip_archive=archive
-                )
-            except (ArchlabError, UserError) as e:
-                job_data = ds.pull(job_id=job_id)
-                ds.update(
-                    job_id,
-                    status='ERROR',
-                    status_reasons=job_data['status_reasons'] +
-                    [f"{traceback.format_exc()}\n{repr(e)}"] +
-                    [f"An error occurred.  This is probably {'not ' if isinstance(e, ArchlabError) else ''}a problem with your code or configuration."],
-                    completed_utc=datetime.datetime.now(pytz.utc),
-                )
-                if args.debug:
-                    raise
-            except Exception as e:
-                log.error(f"Something went wrong and {job_id} failed.  Job failed:{e}")
-                job_id and ds.update(job_id,
-                                     status='ERROR',
-                                     status_reasons=job_data.get('status_reasons', []) +
-                                     [f"{traceback.format_exc()}\n{repr(e)}"] +
-                                     ["An unexected error occurred.  This is probably not a problem with your code."],
-                                     completed_utc=datetime.datetime.now(pytz.utc),
-                )
-                if args.debug:
-                    raise
-            finally:
-                if keep_running():
-                    set_status("IDLE")
-                if args.just_once:
-                    sys.exit(0)
-        # This is to catch exceptions that arise during the processing
-        # of other exceptions, so the daemon doesn't crash.  The
-        # likely cause is some problem with the cloud services.  If
-        # they aren't working, there's not much we can do, so we just
-        # listen pause for a bit and look for a new request.
-        except Exception as e: 
-            log.error(f"Uncaught exception: {e}.")
-            log.error("Sleeping for 10 second and trying again")
-            if args.debug:
-                raise
-            time.sleep(10.0)
+    if failures:
+        raise failures[0]
     log.info("Exiting...")
 
+def test_default_worker_count():
+    assert default_worker_count(cores_per_job=1, reserved_cores=0) == os.cpu_count()
+    assert default_worker_count(cores_per_job=os.cpu_count() + 1, reserved_cores=0) == 1
+    assert default_worker_count(cores_per_job=2, reserved_cores=os.cpu_count()) == 1
             
+def test_redelivered_jobs():
+    import argparse
+    ds = DataStore(namespace="testing-junk")
+    now = datetime.datetime.now(pytz.utc)
+    job_id = str(uuid())
+    ds.push(job_id, output='', status='SUBMITTED', username="a@b.c")
+    ds.update(job_id, status='STARTED', started_utc=now, heartbeat_utc=now, runner_host="elsewhere")
+    job_data = ds.pull(job_id)
+
+    assert owner_is_alive(job_id, job_data, now=now + datetime.timedelta(seconds=JOB_HEARTBEAT_SEC))
+    assert not owner_is_alive(job_id, job_data, now=now + datetime.timedelta(seconds=JOB_HEARTBEAT_STALE_SEC))
+    # We know whether we're running it ourselves.
+    assert not owner_is_alive(job_id, dict(job_data, runner_host=platform.node()), now=now)
+
+    # Its host is still working on it, so we wait, holding onto the
+    # message, until it's done (there's no submission to download, so
+    # we'd fail if we tried to run it).
+    global OWNER_POLL_SEC
+    poll_sec = OWNER_POLL_SEC
+    OWNER_POLL_SEC = 0.1
+    try:
+        given_back = []
+        waiter = threading.Thread(target=run_queued_job, args=(job_id, argparse.Namespace(debug=True), ds, None),
+                                  kwargs=dict(redelivered=True, on_given_back=lambda: given_back.append(True)))
+        waiter.start()
+        time.sleep(0.5)
+        assert waiter.is_alive()
+        ds.update(job_id, status='COMPLETED')
+        waiter.join(5)
+        assert not waiter.is_alive()
+    finally:
+        OWNER_POLL_SEC = poll_sec
+    assert ds.pull(job_id)['runner_host'] == "elsewhere"
+    assert given_back == []
+
+def test_job_heartbeat():
+    ds = DataStore(namespace="testing-junk")
+    job_id = str(uuid())
+    ds.push(job_id, output='', status='STARTED', username="a@b.c")
+    with job_heartbeat(ds, job_id, interval=0.1):
+        time.sleep(0.5)
+    first = ds.pull(job_id)['heartbeat_utc']
+    assert isinstance(first, datetime.datetime)
+    time.sleep(0.3)
+    assert ds.pull(job_id)['heartbeat_utc'] == first # it stopped.
+
 if __name__ == '__main__':
     main(sys.argv[1:])
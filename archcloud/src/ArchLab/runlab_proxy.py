@@ -3,21 +3,125 @@ import logging as log
 log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if True else "%(levelname)-8s %(message)s",
                 level=log.DEBUG)
 
-from flask import Flask, escape, request
+from flask import Flask, request, send_file
 import json
 import subprocess
 import os
 import tempfile
-from .Runner import run_submission_remotely, build_submission, UserError, ArchlabError, Submission
+from .Runner import run_submission_remotely, submit_remote_job, poll_remote_job, collect_remote_result, wait_for_remote_job, record_timeout, COMPLETION_POLL_INTERVAL_SEC, build_submission, authenticated_repo, environment, UserError, ArchlabError, Submission, SubmissionResult, read_envelope, write_envelope
 import traceback
 import sys
 import re
 import time
+import atexit
+import threading
 import textwrap 
+import argparse
+from uuid import uuid4 as uuid
+from concurrent.futures import ThreadPoolExecutor
+from .TokenBucket import TokenBucket, SharedState
+from .CacheDir import archlab_cache_dir
 app = Flask(__name__)
 
 debug=False
 
+# The /jobs/async/ endpoints return a job id right away and clone and
+# upload the submission in the background, in one of these.
+preparers = ThreadPoolExecutor(max_workers=int(os.environ.get("PROXY_PREPARE_THREADS", 8)))
+
+# The longest we'll hold a status request open while we wait for a job.
+MAX_LONG_POLL_SEC = 60
+
+JOB_ID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def shared_state(name):
+    """
+    Our workers share state through files in $PROXY_SHARED_STATE_DIR.
+    Without it, each process keeps its own.
+    """
+    d = os.environ.get("PROXY_SHARED_STATE_DIR")
+    return SharedState(os.path.join(d, f"{name}.json") if d else None)
+
+# Each student gets PROXY_SUBMIT_BURST jobs at once, and one more every
+# PROXY_SUBMIT_REFILL_SEC seconds.
+submission_limiter = TokenBucket(burst=int(os.environ.get("PROXY_SUBMIT_BURST", 1)),
+                                 refill_sec=float(os.environ.get("PROXY_SUBMIT_REFILL_SEC", 60)),
+                                 state=shared_state("submission-limits"))
+
+# The git jobs that are running, by repo, branch, commit, and command, so
+# that submitting the same thing again (e.g., clicking twice) shares the
+# job that's already running.
+jobs_in_flight = shared_state("jobs-in-flight")
+
+class CompletionListener(object):
+    """
+    Wakes up requests that are waiting for jobs when the runners say the
+    jobs are done.  The jobs we submit name our reply topic, and each
+    worker process has its own subscription to it, so every worker hears
+    about every job.  The datastore is still the truth: this just saves
+    polling it.
+    """
+    # How long we keep a notice nobody has waited for yet, in case
+    # someone starts waiting just after it arrives.
+    KEEP_SEC = 60
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = {} # job id -> when we heard
+        self.pid = None
+        self.topic = None
+
+    def start(self):
+        """
+        Start listening in this process, if we aren't.  Returns the topic
+        the runners should reply on.
+        """
+        from .PubSub import Publisher, Subscriber
+        with self.cond:
+            # gunicorn forks the workers after we're imported, so each needs its own.
+            if self.pid != os.getpid():
+                self.topic = Publisher(topic=f"{os.environ['PUBSUB_TOPIC']}-proxy-reply").topic
+                subscription = Subscriber(topic=self.topic)
+                atexit.register(subscription.delete_subscription)
+                threading.Thread(target=self._listen, args=(subscription,), daemon=True).start()
+                self.pid = os.getpid()
+            return self.topic
+
+    def _listen(self, subscription):
+        while True:
+            try:
+                messages = subscription.pull(max_messages=100, deadline=time.time() + COMPLETION_POLL_INTERVAL_SEC)
+            except Exception as e:
+                log.warning(f"Couldn't check for finished jobs: {e}")
+                time.sleep(1)
+                continue
+            now = time.time()
+            with self.cond:
+                for m in messages:
+                    try:
+                        self.finished[json.loads(m)['job_id']] = now
+                    except (ValueError, KeyError, TypeError):
+                        log.warning(f"Ignoring strange reply: {m}")
+                for job_id in [j for j, t in self.finished.items() if now - t > self.KEEP_SEC]:
+                    del self.finished[job_id]
+                self.cond.notify_all()
+
+    def wait(self, job_id, seconds):
+        """
+        Wait up to `seconds` for a runner to say `job_id` is done.
+        """
+        self.start()
+        deadline = time.time() + seconds
+        with self.cond:
+            while job_id not in self.finished:
+                if time.time() >= deadline:
+                    return False
+                self.cond.wait(deadline - time.time())
+            del self.finished[job_id]
+            return True
+
+completions = CompletionListener()
+
 def fail(**kwargs):
     t = json.dumps(kwargs, indent=4)
     sys.stderr.write(t)
@@ -27,6 +131,58 @@ def fail(**kwargs):
 def submit_hello():
     return "Hello"
 
+def envelope_response(result):
+    f = tempfile.TemporaryFile() # send_file() closes (and thereby deletes) it.
+    write_envelope(result, f)
+    f.seek(0)
+    return send_file(f, mimetype="application/zip")
+
+def failure_reason(e):
+    if isinstance(e, UserError):
+        return f"A user error occurred with your job.  There is probably something wrong with your submission: {repr(e)}"
+    elif isinstance(e, ArchlabError):
+        return f"Something unexpected went wrong in autograder.  Probably not your fault.: {repr(e)}"
+    else:
+        return f"An exception occurred.  Probably not your fault: {repr(e)}."
+
+def guarded(f, *args, **kwargs):
+    """
+    Call `f`.  Returns its result and None, or None and a failure response.
+    """
+    try:
+        return f(*args, **kwargs), None
+    except Exception as e:
+        if debug:
+            raise
+        return None, fail(status="FAILURE",
+                          reason=f"{traceback.format_exc()}\n{failure_reason(e)}")
+
+def start_job(username, prepare, *args):
+    """
+    Record a new job and call `prepare(*args, job_id=..., reply_topic=...)`
+    in the background to build it and hand it to the runners.  Returns
+    the job's id.
+
+    Everything about the job lives in the datastore, so any of the
+    proxy's workers can answer questions about it.
+    """
+    from .DataStore import DataStore
+    job_id = str(uuid())
+    reply_topic = completions.start()
+    DataStore().push(job_id, output='', status='PREPARING', username=username)
+    preparers.submit(prepare_job, job_id, reply_topic, prepare, *args)
+    return job_id
+
+def prepare_job(job_id, reply_topic, prepare, *args):
+    from .DataStore import DataStore
+    try:
+        prepare(*args, job_id=job_id, reply_topic=reply_topic)
+    except Exception as e:
+        log.exception(f"Failed to submit job {job_id}")
+        DataStore().update(job_id,
+                           status="ERROR",
+                           status_reasons=[failure_reason(e)])
+
 @app.route('/jobs/submit-full', methods=["POST"])
 def submit_job():
     log.warning(f"Got request: {request.form}")
@@ -35,96 +191,356 @@ def submit_job():
     submission = Submission._fromdict(json.loads(_sub))
     submission.username += f"({request.remote_addr})"
     
-    try:
-        result = run_submission_remotely(submission)#, daemon=True)
-    except UserError as e:
-        if debug:
-            raise
-        return fail(status="FAILURE",
-                    reason=f"{traceback.format_exc()}\nA user error occurred with your job.  There is probably something wrong with your submission: {repr(e)}")
-    except ArchlabError as e:
-        if debug:
-            raise
-        return fail(status="FAILURE",
-                    reason=f"{traceback.format_exc()}\nSomething unexpected went wrong in autograder.  Probably not your fault.: {repr(e)}")
-    except Exception as e:
-        if debug:
-            raise
-        return fail(status="FAILURE",
-                    reason=f"{traceback.format_exc()}\nAn exception occurred.  Probably not your fault: {repr(e)}.")
-    finally:
-        pass
+    result, failure = guarded(run_submission_remotely, submission) #, daemon=True)
+    if failure:
+        return failure
     
     return json.dumps(dict(status="SUCCESS",
                            result=result._asdict()))
 
-@app.route('/jobs/submit',methods=["POST"])
-def submit_gitjob():
-    log.warning(f"Got request: {request.form}")
+@app.route('/jobs/submit-envelope', methods=["POST"])
+def submit_envelope():
+    """
+    Like submit-full, but the body is a submission envelope, and the
+    response is a result envelope (or a JSON failure).
+    """
+    log.warning(f"Got envelope from {request.remote_addr}")
     os.makedirs("/status_files", exist_ok=True)
+    submission = read_envelope(request.stream, Submission)
+    submission.username += f"({request.remote_addr})"
+
+    result, failure = guarded(run_submission_remotely, submission) #, daemon=True)
+    if failure:
+        return failure
+
+    return envelope_response(result)
+
+def read_git_request():
+    """
+    Returns the request's parameters and the user it's for, or None and a failure response.
+    """
+    log.warning(f"Got request: {request.form}")
     r = request.form['request']
     data = json.loads(r)
     repo = data['repo']
-    branch = data['branch']
-    command = data['command']
 
-    log.info(f"command = {command}")
+    log.info(f"command = {data['command']}")
     
     student_repo = re.search("/CSE142/(.*)-(\w+)", repo)
     master_repo = re.search("/NVSL/.*Lab-(.*)", repo)
     
     if student_repo:
         username=student_repo.group(2)
-        lock_path =os.path.join("/status_files", username)
-        if os.path.exists(lock_path):
-            with open(lock_path) as f :
-                last_timestamp=float(f.read())
-            if time.time() < last_timestamp + 60:
-                return fail(status="FAILURE",
-                            reason="You can only submit one job per minute")
-        with open(lock_path, "w") as f:
-            f.write(str(time.time()))
-
     elif master_repo:
         username="staff"
-        lock_path = None
     else:
-        return fail(status="FAILURE",
-                    reason=f"{repo} is not repo for this class.")
+        return None, fail(status="FAILURE",
+                          reason=f"{repo} is not repo for this class.")
+
+    return (data, username), None
+
+def resolve_commit(repo, branch):
+    """
+    The commit at the head of `branch`, or None if we can't tell.
+    """
+    try:
+        out = subprocess.check_output(["git", "ls-remote", "--heads", authenticated_repo(repo), branch], stderr=subprocess.DEVNULL, timeout=30)
+    except Exception as e:
+        log.warning(f"Couldn't find the head of {branch} in {repo}: {e}")
+        return None
+    heads = [l.split() for l in out.decode("utf8").splitlines()]
+    heads = [sha for sha, ref in heads if ref == f"refs/heads/{branch}"]
+    return heads[0] if heads else None
+
+def job_is_running(job_id):
+    from .DataStore import DataStore
+    job_data = DataStore().pull(job_id)
+    return job_data is not None and job_data['status'] in ['PREPARING', 'SUBMITTED', 'STARTED']
+
+def running_job_for(key):
+    """
+    The id of the job that's running for `key`, or None.
+    """
+    with jobs_in_flight.locked() as jobs:
+        now = time.time()
+        for k in [k for k, (job_id, started) in jobs.items() if now - started > int(os.environ['UNIVERSAL_TIMEOUT_SEC'])]:
+            del jobs[k]
+        entry = jobs.get(key)
+    # Ask the datastore after we let go of the lock, so we don't make
+    # everyone else wait for it.
+    if entry and job_is_running(entry[0]):
+        return entry[0]
+    return None
+
+def start_git_job(data, username):
+    """
+    Start a job for a git request, or join the one that's already running
+    for the same commit.  Returns the job's id and None, or None and a
+    failure response.
+    """
+    commit = resolve_commit(data['repo'], data['branch'])
+    key = commit and json.dumps([data['repo'], data['branch'], commit, data['command']])
+
+    if key:
+        job_id = running_job_for(key)
+        if job_id:
+            log.info(f"Sharing job {job_id} with a request for the same commit")
+            return job_id, None
+
+    if username != "staff":
+        wait = submission_limiter.take(username)
+        if wait:
+            return None, fail(status="FAILURE",
+                              reason=f"You are submitting jobs too quickly.  You can submit another one in {wait:.0f} seconds.")
+
+    # Build the commit we checked, even if the branch moves on before we clone it.
+    job_id, failure = guarded(start_job, username, build_and_submit, username, dict(data, commit=commit))
+    if key and job_id:
+        # If two requests for the same commit get here at once, they each
+        # get a job, and the later one gets shared from now on.
+        with jobs_in_flight.locked() as jobs:
+            jobs[key] = [job_id, time.time()]
+    return job_id, failure
+
+@app.route('/jobs/submit',methods=["POST"])
+def submit_gitjob():
+    r, failure = read_git_request()
+    if failure:
+        return failure
+    data, username = r
+
+#        if submission.lab_spec.repo not in os.environ['VALID_LAB_STARTER_REPOS']:
+#            raise UserError(f"Repo {submission.lab_spec.repo} is not one of the repos that is permitted for this lab.  You are probably submitting the wrong repo or to the wrong lab.")
+
+    job_id, failure = start_git_job(data, username)
+    if failure:
+        return failure
 
+    result, failure = guarded(wait_for_remote_job, job_id, wait_for_completion=lambda seconds: completions.wait(job_id, seconds))
+    if failure:
+        return failure
 
+    if data.get('format') == "envelope":
+        return envelope_response(result)
+    return json.dumps(dict(status="SUCCESS",
+                           result=result._asdict()))
+
+def build_and_submit(username, data, job_id, reply_topic=None):
     os.makedirs("/jobs", exist_ok=True)
     with tempfile.TemporaryDirectory(dir="/jobs/") as work_dir:
+        submission = build_submission(work_dir, username=username, repo=data['repo'], branch=data['branch'], commit=data.get('commit'), pristine=True, command=data['command'])
+        submit_remote_job(submission, job_id=job_id, reply_topic=reply_topic)
+
+@app.route('/jobs/async/submit', methods=["POST"])
+def submit_gitjob_async():
+    """
+    Like /jobs/submit, but returns the job's id as soon as we've
+    accepted it.  Follow it with /jobs/<id>/status and /jobs/<id>/result.
+    """
+    r, failure = read_git_request()
+    if failure:
+        return failure
+    data, username = r
+
+    job_id, failure = start_git_job(data, username)
+    if failure:
+        return failure
+    return json.dumps(dict(status="SUBMITTED", job_id=job_id))
+
+@app.route('/jobs/async/submit-envelope', methods=["POST"])
+def submit_envelope_async():
+    """
+    Like /jobs/submit-envelope, but returns the job's id right away.
+    """
+    log.warning(f"Got envelope from {request.remote_addr}")
+    submission, failure = guarded(read_envelope, request.stream, Submission)
+    if failure:
+        return failure
+    submission.username += f"({request.remote_addr})"
+
+    job_id, failure = guarded(start_job, submission.username, submit_remote_job, submission)
+    if failure:
+        return failure
+    return json.dumps(dict(status="SUBMITTED", job_id=job_id))
+
+@app.route('/jobs/<job_id>/status', methods=["GET"])
+def job_status(job_id):
+    """
+    Is the job done?  `status` is COMPLETED, RUNNING, or FAILURE (with a
+    `reason`).  With `?wait=N`, wait up to N seconds for it to finish
+    before answering.
+    """
+    from .DataStore import DataStore
+    if not JOB_ID.match(job_id):
+        return fail(status="FAILURE", reason=f"'{job_id}' is not a job id."), 404
+
+    ds = DataStore()
+    deadline = time.time() + min(request.args.get('wait', 0, type=float), MAX_LONG_POLL_SEC)
+    while True:
+        job_data, failure = guarded(poll_remote_job, job_id, ds)
+        if failure:
+            return failure
+        if job_data:
+            return json.dumps(dict(status="COMPLETED", job_status=job_data['status']))
+        if time.time() >= deadline:
+            return json.dumps(dict(status="RUNNING", job_status=ds.pull(job_id)['status']))
+        completions.wait(job_id, min(deadline - time.time(), COMPLETION_POLL_INTERVAL_SEC))
+
+@app.route('/jobs/<job_id>/result', methods=["GET"])
+def job_result(job_id):
+    """
+    The result of a finished job, as an envelope (or JSON, with `?format=json`).
+    If it timed out or failed, the failure instead.
+    """
+    if not JOB_ID.match(job_id):
+        return fail(status="FAILURE", reason=f"'{job_id}' is not a job id."), 404
 
-        try:
-            submission = build_submission(work_dir, username=username, repo=repo, branch=branch, pristine=True, command=command)
-
-#            if submission.lab_spec.repo not in os.environ['VALID_LAB_STARTER_REPOS']:
-#                raise UserError(f"Repo {submission.lab_spec.repo} is not one of the repos that is permitted for this lab.  You are probably submitting the wrong repo or to the wrong lab.")
-
-            result = run_submission_remotely(submission)#, daemon=True)
-
-        except UserError as e:
-            if debug:
-                raise
-            return fail(status="FAILURE",
-                        reason=f"{traceback.format_exc()}\nA user error occurred with your job.  There is probably something wrong with your submission: {repr(e)}")
-        except ArchlabError as e:
-            if debug:
-                raise
-            return fail(status="FAILURE",
-                        reason=f"{traceback.format_exc()}\nSomething unexpected went wrong in autograder.  Probably not your fault.: {repr(e)}")
-        except Exception as e:
-            if debug:
-                raise
-            return fail(status="FAILURE",
-                        reason=f"{traceback.format_exc()}\nAn exception occurred.  Probably not your fault: {repr(e)}.")
-        finally:
-            pass
+    job_data, failure = guarded(poll_remote_job, job_id)
+    if failure:
+        return failure
+    if not job_data:
+        return fail(status="FAILURE", reason=f"Job {job_id} hasn't finished yet."), 409
 
+    result, failure = guarded(collect_remote_result, job_id, job_data)
+    if failure:
+        return failure
+
+    if request.args.get('format') == "json":
         return json.dumps(dict(status="SUCCESS",
                                result=result._asdict()))
+    return envelope_response(result)
 
-def main():
-    app.run(debug=True, host='0.0.0.0')
-    
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Accept jobs over http and hand them to the runners.')
+    parser.add_argument('--port', default=5000, type=int, help="Port to listen on (default = 5000)")
+    parser.add_argument('--workers', default=int(os.environ.get("PROXY_WORKERS", 4)), type=int, help="How many worker processes (default = $PROXY_WORKERS or 4)")
+    parser.add_argument('--threads', default=int(os.environ.get("PROXY_THREADS", 32)), type=int,
+                        help="Threads per worker.  Each waiting client holds one (default = $PROXY_THREADS or 32)")
+    parser.add_argument('--shared-state', default=os.environ.get("PROXY_SHARED_STATE_DIR"),
+                        help="Where the workers keep what they share: rate limits and the jobs that are running (default = $PROXY_SHARED_STATE_DIR or the archlab cache dir)")
+    parser.add_argument('--dev-server', action='store_true', default=False, help="Use flask's development server instead of gunicorn")
+    if argv == None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    if args.dev_server:
+        app.run(debug=True, host='0.0.0.0', port=args.port)
+        return
+
+    os.environ['PROXY_SHARED_STATE_DIR'] = args.shared_state or archlab_cache_dir("proxy")
+    os.execvp("gunicorn", ["gunicorn",
+                           "--bind", f"0.0.0.0:{args.port}",
+                           "--worker-class", "gthread",
+                           "--workers", str(args.workers),
+                           "--threads", str(args.threads),
+                           "ArchLab.runlab_proxy:app"])
+
+def test_async_jobs():
+    import datetime
+    import pytz
+    from .DataStore import DataStore
+    client = app.test_client()
+    assert client.get("/jobs/not-a-job/status").status_code == 404
+
+    def broken(job_id, reply_topic):
+        raise UserError("your code is bad")
+
+    with environment(UNIVERSAL_TIMEOUT_SEC="60", PUBSUB_TOPIC=os.environ.get("PUBSUB_TOPIC", "proxy-test")):
+        job_id = start_job("a@b.c", broken)
+        status = json.loads(client.get(f"/jobs/{job_id}/status?wait=10").data)
+        assert status['status'] == "FAILURE"
+        assert "your code is bad" in status['reason']
+
+        ds = DataStore()
+        job_id = str(uuid())
+        ds.push(job_id, output='', status='STARTED', username="a@b.c")
+        start = time.time()
+        status = json.loads(client.get(f"/jobs/{job_id}/status?wait=1").data)
+        assert time.time() - start >= 1
+        assert status == dict(status="RUNNING", job_status="STARTED")
+        assert client.get(f"/jobs/{job_id}/result").status_code == 409
+
+        ds.update(job_id, status='COMPLETED')
+        assert json.loads(client.get(f"/jobs/{job_id}/status?wait=10").data)['status'] == "COMPLETED"
+
+        # A job that hit the lab's time limit still has a result.
+        ds.update(job_id, submission_status=SubmissionResult.TIMEOUT)
+        assert json.loads(client.get(f"/jobs/{job_id}/status").data)['status'] == "COMPLETED"
+
+        # Asking about a job we gave up on reports that, and leaves its record alone.
+        record_timeout(job_id, ds)
+        for i in range(2):
+            result = json.loads(client.get(f"/jobs/{job_id}/result").data)
+            assert result['status'] == "FAILURE" and "ran for more than" in result['reason']
+        assert ds.pull(job_id)['timed_out_by_submitter']
+
+        # If no one is around to notice a job run too long, asking about it does.
+        job_id = str(uuid())
+        ds.push(job_id, output='', status='STARTED', username="a@b.c")
+        ds.update(job_id, submitted_utc=datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds=61))
+        status = json.loads(client.get(f"/jobs/{job_id}/status").data)
+        assert status['status'] == "FAILURE" and "ran for more than" in status['reason']
+        assert ds.pull(job_id)['timed_out_by_submitter']
+
+        # We hear when a job finishes, rather than waiting for the next poll.
+        from .PubSub import Publisher
+        job_id = str(uuid())
+        ds.push(job_id, output='', status='STARTED', username="a@b.c", reply_topic=completions.start())
+        def finish():
+            time.sleep(0.5)
+            ds.update(job_id, status='COMPLETED')
+            Publisher(topic=ds.pull(job_id)['reply_topic'], create_if_missing=False).publish(json.dumps(dict(job_id=job_id, status="COMPLETED")))
+        threading.Thread(target=finish).start()
+        start = time.time()
+        assert json.loads(client.get(f"/jobs/{job_id}/status?wait=30").data)['status'] == "COMPLETED"
+        assert time.time() - start < COMPLETION_POLL_INTERVAL_SEC
+
+def test_git_job_sharing(monkeypatch):
+    from .DataStore import DataStore
+    built = {} # job id -> commit
+    monkeypatch.setattr(sys.modules[__name__], "build_and_submit", lambda username, data, job_id, reply_topic: built.update({job_id: data['commit']}))
+    monkeypatch.setattr(sys.modules[__name__], "submission_limiter", TokenBucket(burst=1, refill_sec=60))
+    monkeypatch.setattr(sys.modules[__name__], "jobs_in_flight", SharedState())
+
+    # We don't hold the lock while we talk to the datastore.
+    def is_running(job_id, job_is_running=job_is_running):
+        assert not jobs_in_flight.lock.locked()
+        return job_is_running(job_id)
+    monkeypatch.setattr(sys.modules[__name__], "job_is_running", is_running)
+
+    def git(*args):
+        subprocess.check_call(["git", "-c", "user.name=a", "-c", "user.email=a@b.c"] + list(args), cwd=repo, stdout=subprocess.DEVNULL)
+
+    with tempfile.TemporaryDirectory() as d, environment(UNIVERSAL_TIMEOUT_SEC="60", PUBSUB_TOPIC=os.environ.get("PUBSUB_TOPIC", "proxy-test")):
+        repo = os.path.join(d, "CSE142", "lab-alice")
+        os.makedirs(repo)
+        git("init", "-q", "-b", "main")
+        git("commit", "-q", "--allow-empty", "-m", "one")
+        data = dict(repo=repo, branch="main", command=["true"])
+
+        # Clicking twice shares the job, and doesn't count against the limit.
+        first, failure = start_git_job(data, "alice")
+        assert failure is None
+        assert start_git_job(data, "alice") == (first, None)
+        assert start_git_job(dict(data, command=["false"]), "alice")[0] is None
+
+        # A new commit is a new job, but alice has to wait.
+        git("commit", "-q", "--allow-empty", "-m", "two")
+        job_id, failure = start_git_job(data, "alice")
+        assert job_id is None and "too quickly" in failure
+        second, failure = start_git_job(data, "staff")
+        assert second != first
+
+        # Once it's done, submitting again starts a new job.
+        DataStore().update(second, status="COMPLETED")
+        third, failure = start_git_job(data, "staff")
+        assert third not in [first, second]
+
+        deadline = time.time() + 10
+        while len(built) < 3 and time.time() < deadline:
+            time.sleep(0.1)
+        assert set(built) == set([first, second, third])
+
+        # Each job builds the commit it was started for.
+        head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo).decode("utf8").strip()
+        assert built[first] != head and built[second] == built[third] == head
@@ -13,6 +13,8 @@ def main(argv=None):
     parser.add_argument('--fail-fast', action='store_true', default=False, help="stop on first error")
     parser.add_argument('--no-daemon', action='store_false', default=True, dest='daemon', help="Don't start your own daemon")
     parser.add_argument('--test', default=None, help="Just run this test")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help="Run this many tests at once, each in its own copy of the lab (default = 1)")
+    parser.add_argument('--log-dir', default=None, help="With --jobs, put each test's log here")
     args = parser.parse_args(sys.argv[1:])
     
     log.basicConfig(format="{} %(levelname)-8s [%(filename)s:%(lineno)d]  %(message)s".format(platform.node()) if True else "%(levelname)-8s %(message)s",
@@ -21,7 +23,7 @@ def main(argv=None):
     lab = LabSpec.load(".")
     if not args.daemon:
         os.environ['SUPRESS_LOCAL_DAEMON'] = 'yes'
-    result = lab.run_meta_regressions(failfast=args.fail_fast, test_name=args.test)
+    result = lab.run_meta_regressions(failfast=args.fail_fast, test_name=args.test, jobs=args.jobs, log_dir=args.log_dir)
     if len(result.errors) + len(result.failures) > 0:
         return 1
     else: